@@ -3,193 +3,456 @@ import os
 import uuid
 import asyncio
 import time
-from fastapi import APIRouter, HTTPException, Request
-from app.config import S3_BUCKET
-from app.models import ReplaceBackgroundRelightInput
-from app.utils import send_async_generation_request, download_image, upload_bytes_to_s3
-from app.logging_utils import setup_logging, get_correlation_id
+import json
+import math
+from io import BytesIO
+from typing import Optional, Tuple
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from pydantic import ValidationError
+from app.config import (
+    S3_BUCKET,
+    STABILITY_API_HOST,
+    INPUT_FETCH_TIMEOUT,
+    RESULT_CACHE_ENABLED,
+    BATCH_MAX_ITEMS,
+    BATCH_MAX_CONCURRENCY,
+    PREPROCESS_ENABLED,
+    OUTPUT_TRANSCODE_ENABLED,
+    OUTPUT_THUMBNAIL_SIZES,
+    OUTPUT_CACHE_CONTROL,
+    OUTPUT_PRESIGNED_URLS,
+    STORAGE_PRESIGN_EXPIRES,
+    STORAGE_MAX_UPLOAD_BYTES,
+    REQUEST_TIMEOUT_HEADER
+)
+from app.models import ReplaceBackgroundRelightInput, ReplaceBackgroundRelightJobInput, UploadRequest
+from app.jobs import Job, get_job_store
+from app.result_cache import result_cache, result_fingerprint
+from app.imaging import CONTENT_TYPES, InvalidImage, postprocess_output, preprocess_input
+from app.scheduler import AdmissionRejected, generation_scheduler
+from app.resilience import CircuitOpenError
+from app.deadlines import (
+    CLIENT_DISCONNECT,
+    DEADLINE,
+    Deadline,
+    DeadlineExceeded,
+    check_deadline,
+    deadline_scope,
+    request_timeout,
+    time_remaining,
+    without_deadline
+)
+from app.pools import run_in_thread
+from app.stability import get_stability_client
+from app.storage import InvalidObjectURL, LocalStorage, ObjectLocation, download_image, get_storage, presign_download, upload_bytes_to_s3
+from app.utils import SpooledBody, send_async_generation_request, spool_response_body, body_size
+from app.logging_utils import setup_logging, get_correlation_id, get_monitoring_log_writer, Lazy
+from app.tracing import span, start_trace
 from app.metrics import (
     IMAGE_PROCESSING_DURATION,
+    INPUT_FETCH_DURATION,
     IMAGE_SIZE,
     S3_OPERATION_DURATION,
     STABILITY_API_DURATION,
-    VENDOR_REQUESTS,
-    ERROR_COUNTER
+    ERROR_COUNTER,
+    labelled,
+    count_vendor_request
 )
 
 router = APIRouter()
 logger = setup_logging("app.api")
 
-REPLACE_BACKGROUND_RELIGHT_ENDPOINT = "https://api.stability.ai/v2beta/stable-image/edit/replace-background-and-relight"
+REPLACE_BACKGROUND_RELIGHT_ENDPOINT = f"{STABILITY_API_HOST}/v2beta/stable-image/edit/replace-background-and-relight"
 
-@router.post("/replace-background-relight")
-async def replace_background_relight(request: Request, input: ReplaceBackgroundRelightInput):
-    correlation_id = get_correlation_id()
-    start_time = time.time()
-    vendor_id = input.username or "anonymous"
-    
-    logger.info("Received request", extra={
+# Input images of a request: (model field, metric/error suffix, log description).
+INPUT_ASSETS = (
+    ("subject_image", "subject", "subject image"),
+    ("background_reference", "background", "background image"),
+    ("light_reference", "light", "light reference image"),
+)
+
+async def download_input(url, shared_downloads: Optional[dict] = None) -> BytesIO:
+    """
+    Downloads an input image in a worker thread.
+
+    With `shared_downloads` (a dict owned by the caller, e.g. one per batch),
+    each distinct URL is downloaded once and every user gets its own buffer
+    over the same bytes.
+    """
+    if shared_downloads is None:
+        return await run_in_thread("download_input", download_image, url)
+    key = str(url)
+    task = shared_downloads.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_in_thread("download_input", lambda: download_image(url).read()))
+        # Mark failures as retrieved even if every waiter was cancelled.
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        shared_downloads[key] = task
+    # Shielded so one waiter being cancelled does not abort the download for the others.
+    return BytesIO(await asyncio.shield(task))
+
+async def fetch_input_asset(field: str, asset: str, description: str, url, correlation_id: str, vendor_id: str, shared_downloads: Optional[dict] = None):
+    """Downloads one input image, recording its timing, size and errors under the asset's own labels."""
+    start = time.perf_counter()
+    try:
+        async with asyncio.timeout(time_remaining(INPUT_FETCH_TIMEOUT)):
+            with span(f"download_{asset}"):
+                content = await download_input(url, shared_downloads)
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e, correlation_id, vendor_id)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        # A timeout cut short by the request's own deadline is not the input's fault.
+        check_deadline("download")
+        labelled(IMAGE_PROCESSING_DURATION, operation_type=f"download_{asset}").observe(time.perf_counter() - start)
+        labelled(ERROR_COUNTER, error_type=f"download_{asset}", vendor_id=vendor_id).inc()
+        detail = str(e) or f"Timed out downloading {description} after {INPUT_FETCH_TIMEOUT} seconds"
+        logger.error(f"Error downloading {description}", extra={
+            "correlation_id": correlation_id,
+            "vendor_id": vendor_id,
+            "error": detail
+        })
+        raise HTTPException(status_code=400, detail=detail)
+    labelled(IMAGE_PROCESSING_DURATION, operation_type=f"download_{asset}").observe(time.perf_counter() - start)
+    labelled(IMAGE_SIZE, operation_type=asset).observe(body_size(content))
+    logger.info(f"Downloaded {description}", extra={
         "correlation_id": correlation_id,
         "vendor_id": vendor_id,
-        "input": input.model_dump()
+        field: url
     })
-    
-    VENDOR_REQUESTS.labels(vendor_id=vendor_id, operation_type="replace_background_relight").inc()
-    
+    if not PREPROCESS_ENABLED:
+        return content
+
+    # Validate, downscale and normalize in the process pool before spending upload bandwidth and quota.
+    start = time.perf_counter()
     try:
-        # Download input images from S3/public URLs using async wrappers.
-        with IMAGE_PROCESSING_DURATION.labels(operation_type="download_subject").time():
-            try:
-                subject_file = await asyncio.to_thread(download_image, input.subject_image)
-                IMAGE_SIZE.labels(operation_type="subject").observe(len(subject_file))
-                logger.info("Downloaded subject image", extra={
-                    "correlation_id": correlation_id,
-                    "vendor_id": vendor_id,
-                    "subject_image": input.subject_image
-                })
-            except Exception as e:
-                ERROR_COUNTER.labels(error_type="download_subject", vendor_id=vendor_id).inc()
-                logger.error("Error downloading subject image", extra={
-                    "correlation_id": correlation_id,
-                    "vendor_id": vendor_id,
-                    "error": str(e)
-                })
-                raise HTTPException(status_code=400, detail=str(e))
-        
-        files = {
-            "subject_image": ("subject_image", subject_file, "application/octet-stream")
-        }
-        
-        if input.background_reference:
-            with IMAGE_PROCESSING_DURATION.labels(operation_type="download_background").time():
-                try:
-                    background_file = await asyncio.to_thread(download_image, input.background_reference)
-                    IMAGE_SIZE.labels(operation_type="background").observe(len(background_file))
-                    files["background_reference"] = ("background_reference", background_file, "application/octet-stream")
-                    logger.info("Downloaded background image", extra={
-                        "correlation_id": correlation_id,
-                        "vendor_id": vendor_id,
-                        "background_reference": input.background_reference
-                    })
-                except Exception as e:
-                    ERROR_COUNTER.labels(error_type="download_background", vendor_id=vendor_id).inc()
-                    logger.error("Error downloading background image", extra={
-                        "correlation_id": correlation_id,
-                        "vendor_id": vendor_id,
-                        "error": str(e)
-                    })
-                    raise HTTPException(status_code=400, detail=str(e))
-        
-        if input.light_reference:
-            with IMAGE_PROCESSING_DURATION.labels(operation_type="download_light").time():
+        with span(f"preprocess_{asset}"):
+            content = await preprocess_input(content, asset)
+    except InvalidImage as e:
+        content.close()
+        labelled(ERROR_COUNTER, error_type=f"invalid_{asset}", vendor_id=vendor_id).inc()
+        logger.error(f"Invalid {description}", extra={
+            "correlation_id": correlation_id,
+            "vendor_id": vendor_id,
+            "error": str(e)
+        })
+        raise HTTPException(status_code=400, detail=f"Invalid {description}: {e}")
+    finally:
+        labelled(IMAGE_PROCESSING_DURATION, operation_type=f"preprocess_{asset}").observe(time.perf_counter() - start)
+    return content
+
+async def fetch_input_images(input: ReplaceBackgroundRelightInput, correlation_id: str, vendor_id: str, shared_downloads: Optional[dict] = None) -> dict:
+    """
+    Downloads every input image the request references concurrently and returns
+    them as multipart file entries for the Stability API.
+
+    The first failing download cancels the remaining ones and its HTTPException
+    is raised unchanged.
+    """
+    start = time.perf_counter()
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = {
+                field: group.create_task(fetch_input_asset(field, asset, description, getattr(input, field), correlation_id, vendor_id, shared_downloads))
+                for field, asset, description in INPUT_ASSETS
+                if getattr(input, field)
+            }
+    except ExceptionGroup as eg:
+        raise eg.exceptions[0]
+    finally:
+        INPUT_FETCH_DURATION.observe(time.perf_counter() - start)
+    return {
+        field: (field, task.result(), "application/octet-stream")
+        for field, task in tasks.items()
+    }
+
+def admission_error(e: AdmissionRejected, correlation_id: str, vendor_id: str) -> HTTPException:
+    """Turns a scheduler rejection into a 429 response with a Retry-After hint."""
+    labelled(ERROR_COUNTER, error_type="rate_limited", vendor_id=vendor_id).inc()
+    logger.warning("Request rejected by admission control", extra={
+        "correlation_id": correlation_id,
+        "vendor_id": vendor_id,
+        "reason": e.reason
+    })
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+
+def upstream_unavailable(e: CircuitOpenError, correlation_id: str, vendor_id: str) -> HTTPException:
+    """Turns an open circuit breaker into a 503 response with a Retry-After hint."""
+    labelled(ERROR_COUNTER, error_type=f"circuit_open_{e.endpoint}", vendor_id=vendor_id).inc()
+    logger.warning("Failing fast while upstream is unavailable", extra={
+        "correlation_id": correlation_id,
+        "vendor_id": vendor_id,
+        "endpoint": e.endpoint,
+        "retry_after": e.retry_after
+    })
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+
+def deadline_error(e: DeadlineExceeded, correlation_id: str, vendor_id: str) -> HTTPException:
+    """Turns an abandoned request into a 504 (deadline passed) or 499 (client went away) response."""
+    labelled(ERROR_COUNTER, error_type=e.reason, vendor_id=vendor_id).inc()
+    logger.warning("Abandoned request", extra={
+        "correlation_id": correlation_id,
+        "vendor_id": vendor_id,
+        "stage": e.stage,
+        "reason": e.reason
+    })
+    return HTTPException(status_code=504 if e.reason == DEADLINE else 499, detail=str(e))
+
+async def run_with_deadline(request: Request, coro, correlation_id: str, vendor_id: str):
+    """
+    Runs a request's processing under its deadline and cancels it as soon as
+    the client disconnects or the deadline passes.
+
+    The budget comes from the REQUEST_TIMEOUT_HEADER request header or
+    REQUEST_TIMEOUT. Steps running in worker threads cannot be cancelled, so
+    they check the shared deadline and stop at their next checkpoint.
+    """
+    deadline = Deadline(request_timeout(request.headers.get(REQUEST_TIMEOUT_HEADER)))
+    with deadline_scope(deadline):
+        task = asyncio.ensure_future(coro)
+
+    async def watch_disconnect():
+        # The body has been read already, so the next message only comes when the client goes away.
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        deadline.cancel(CLIENT_DISCONNECT)
+        task.cancel()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        async with asyncio.timeout(deadline.remaining()):
+            return await task
+    except TimeoutError:
+        if deadline.reason != DEADLINE:
+            raise
+        deadline.cancel(DEADLINE)
+        raise deadline_error(DeadlineExceeded(deadline.stage, DEADLINE), correlation_id, vendor_id)
+    except asyncio.CancelledError:
+        if deadline.cancel_reason != CLIENT_DISCONNECT or asyncio.current_task().cancelling():
+            raise
+        raise deadline_error(DeadlineExceeded(deadline.stage, CLIENT_DISCONNECT), correlation_id, vendor_id)
+    except DeadlineExceeded as e:
+        raise deadline_error(e, correlation_id, vendor_id)
+    finally:
+        watcher.cancel()
+
+async def generate_and_store(input: ReplaceBackgroundRelightInput, files: dict, correlation_id: str, vendor_id: str) -> str:
+    """Runs the Stability generation for downloaded inputs and uploads the result, returning its S3 URL."""
+    # Prepare parameters for the Stability API.
+    # With transcoding on, Stability returns lossless PNG and the requested format is encoded here.
+    params = {
+        "output_format": "png" if OUTPUT_TRANSCODE_ENABLED else input.output_format,
+        "background_prompt": input.background_prompt,
+        "foreground_prompt": input.foreground_prompt,
+        "negative_prompt": input.negative_prompt,
+        "preserve_original_subject": input.preserve_original_subject,
+        "original_background_depth": input.original_background_depth,
+        "keep_original_background": input.keep_original_background,
+        "seed": input.seed
+    }
+    if input.light_source_direction != "none":
+        params["light_source_direction"] = input.light_source_direction
+    if input.light_source_direction != "none" or input.light_reference:
+        params["light_source_strength"] = input.light_source_strength
+
+    logger.info("Prepared Stability API parameters", extra={
+        "correlation_id": correlation_id,
+        "vendor_id": vendor_id,
+        "params": params
+    })
+
+    # Call the asynchronous generation API once the scheduler grants an outbound slot.
+    try:
+        async with generation_scheduler.slot(vendor_id):
+            with labelled(STABILITY_API_DURATION, operation_type="generation").time():
                 try:
-                    light_file = await asyncio.to_thread(download_image, input.light_reference)
-                    IMAGE_SIZE.labels(operation_type="light").observe(len(light_file))
-                    files["light_reference"] = ("light_reference", light_file, "application/octet-stream")
-                    logger.info("Downloaded light reference image", extra={
+                    api_response = await send_async_generation_request(REPLACE_BACKGROUND_RELIGHT_ENDPOINT, params, files)
+                    logger.info("Received response from Stability API", extra={
                         "correlation_id": correlation_id,
                         "vendor_id": vendor_id,
-                        "light_reference": input.light_reference
+                        "status_code": api_response.status_code
                     })
+                except CircuitOpenError as e:
+                    raise upstream_unavailable(e, correlation_id, vendor_id)
+                except DeadlineExceeded:
+                    raise
                 except Exception as e:
-                    ERROR_COUNTER.labels(error_type="download_light", vendor_id=vendor_id).inc()
-                    logger.error("Error downloading light reference image", extra={
+                    labelled(ERROR_COUNTER, error_type="stability_api", vendor_id=vendor_id).inc()
+                    logger.error("Error during generation API call", extra={
                         "correlation_id": correlation_id,
                         "vendor_id": vendor_id,
                         "error": str(e)
                     })
-                    raise HTTPException(status_code=400, detail=str(e))
-        
-        # Prepare parameters for the Stability API.
-        params = {
-            "output_format": input.output_format,
-            "background_prompt": input.background_prompt,
-            "foreground_prompt": input.foreground_prompt,
-            "negative_prompt": input.negative_prompt,
-            "preserve_original_subject": input.preserve_original_subject,
-            "original_background_depth": input.original_background_depth,
-            "keep_original_background": input.keep_original_background,
-            "seed": input.seed
-        }
-        if input.light_source_direction != "none":
-            params["light_source_direction"] = input.light_source_direction
-        if input.light_source_direction != "none" or input.light_reference:
-            params["light_source_strength"] = input.light_source_strength
-
-        logger.info("Prepared Stability API parameters", extra={
+                    raise HTTPException(status_code=500, detail=str(e))
+    except AdmissionRejected as e:
+        raise admission_error(e, correlation_id, vendor_id)
+
+    if api_response.status_code != 200:
+        # Reading the (error) body also releases the pooled connection.
+        await api_response.aread()
+        labelled(ERROR_COUNTER, error_type="stability_api_error", vendor_id=vendor_id).inc()
+        logger.error("Stability API error", extra={
             "correlation_id": correlation_id,
             "vendor_id": vendor_id,
-            "params": params
+            "status_code": api_response.status_code,
+            "response": api_response.text
         })
-        
-        # Call the asynchronous generation API.
-        with STABILITY_API_DURATION.labels(operation_type="generation").time():
-            try:
-                api_response = await asyncio.to_thread(send_async_generation_request, REPLACE_BACKGROUND_RELIGHT_ENDPOINT, params, files)
-                logger.info("Received response from Stability API", extra={
-                    "correlation_id": correlation_id,
-                    "vendor_id": vendor_id,
-                    "status_code": api_response.status_code
-                })
-            except Exception as e:
-                ERROR_COUNTER.labels(error_type="stability_api", vendor_id=vendor_id).inc()
-                logger.error("Error during generation API call", extra={
-                    "correlation_id": correlation_id,
-                    "vendor_id": vendor_id,
-                    "error": str(e)
-                })
-                raise HTTPException(status_code=500, detail=str(e))
-        
-        if api_response.status_code != 200:
-            ERROR_COUNTER.labels(error_type="stability_api_error", vendor_id=vendor_id).inc()
-            logger.error("Stability API error", extra={
+        raise HTTPException(status_code=api_response.status_code, detail=f"Stability API error: {api_response.text}")
+
+    finish_reason = api_response.headers.get("finish-reason")
+    if finish_reason == 'CONTENT_FILTERED':
+        # The filtered image is never read; close it so its connection goes back to the pool.
+        await api_response.aclose()
+        labelled(ERROR_COUNTER, error_type="nsfw_filter", vendor_id=vendor_id).inc()
+        logger.error("Generation failed NSFW classifier", extra={
+            "correlation_id": correlation_id,
+            "vendor_id": vendor_id
+        })
+        raise HTTPException(status_code=400, detail="Generation failed NSFW classifier")
+
+    # Create a unique filename.
+    unique_part = str(uuid.uuid4())
+    if input.username:
+        filename = f"{input.username}_{unique_part}.{input.output_format}"
+    else:
+        filename = f"{unique_part}.{input.output_format}"
+    object_name = f"transformed_images/{filename}"
+    logger.info("Generated unique filename", extra={
+        "correlation_id": correlation_id,
+        "vendor_id": vendor_id,
+        "unique_filename": filename
+    })
+
+    # Stream the result out of the Stability response and into S3 without holding it all in memory.
+    body = None
+    try:
+        body = await spool_response_body(api_response)
+        content, thumbnails = body.rewind(), {}
+        if OUTPUT_TRANSCODE_ENABLED or OUTPUT_THUMBNAIL_SIZES:
+            with labelled(IMAGE_PROCESSING_DURATION, operation_type="postprocess").time(), span("postprocess"):
+                transcoded, thumbnails = await postprocess_output(
+                    content, input.output_format, OUTPUT_TRANSCODE_ENABLED, OUTPUT_THUMBNAIL_SIZES
+                )
+            labelled(IMAGE_SIZE, operation_type="upstream_output").observe(body.size)
+            if transcoded is not None:
+                content = BytesIO(transcoded)
+    except Exception as e:
+        if body is not None:
+            body.close()
+        labelled(ERROR_COUNTER, error_type="output_read", vendor_id=vendor_id).inc()
+        logger.error("Error reading generated image", extra={
+            "correlation_id": correlation_id,
+            "vendor_id": vendor_id,
+            "error": str(e)
+        })
+        raise HTTPException(status_code=502, detail=f"Error reading generated image: {e}")
+
+    with labelled(S3_OPERATION_DURATION, operation_type="upload").time(), span("upload", thumbnails=len(thumbnails)):
+        try:
+            # Do not upload a result nobody is waiting for any more.
+            check_deadline("upload")
+            content_type = CONTENT_TYPES[input.output_format]
+            # Measured first: the transfer manager closes the file once it is uploaded.
+            size = body_size(content)
+            uploads = [
+                run_in_thread("upload_output", upload_bytes_to_s3, content, S3_BUCKET, object_name, content_type, OUTPUT_CACHE_CONTROL)
+            ] + [
+                run_in_thread("upload_thumbnail", upload_bytes_to_s3, thumbnail, S3_BUCKET, f"transformed_images/thumbnails/{thumb_size}/{filename}", content_type, OUTPUT_CACHE_CONTROL)
+                for thumb_size, thumbnail in thumbnails.items()
+            ]
+            s3_url, *_ = await asyncio.gather(*uploads)
+            labelled(IMAGE_SIZE, operation_type="output").observe(size)
+            logger.info("Uploaded image to S3", extra={
                 "correlation_id": correlation_id,
                 "vendor_id": vendor_id,
-                "status_code": api_response.status_code,
-                "response": api_response.text
+                "s3_url": s3_url,
+                "size": size,
+                "thumbnails": len(thumbnails)
             })
-            raise HTTPException(status_code=api_response.status_code, detail=f"Stability API error: {api_response.text}")
-        
-        finish_reason = api_response.headers.get("finish-reason")
-        if finish_reason == 'CONTENT_FILTERED':
-            ERROR_COUNTER.labels(error_type="nsfw_filter", vendor_id=vendor_id).inc()
-            logger.error("Generation failed NSFW classifier", extra={
+        except CircuitOpenError as e:
+            raise upstream_unavailable(e, correlation_id, vendor_id)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            labelled(ERROR_COUNTER, error_type="s3_upload", vendor_id=vendor_id).inc()
+            logger.error("Error uploading image to S3", extra={
                 "correlation_id": correlation_id,
-                "vendor_id": vendor_id
+                "vendor_id": vendor_id,
+                "error": str(e)
             })
-            raise HTTPException(status_code=400, detail="Generation failed NSFW classifier")
-        
-        # Create a unique filename.
-        unique_part = str(uuid.uuid4())
-        if input.username:
-            filename = f"{input.username}_{unique_part}.{input.output_format}"
-        else:
-            filename = f"{unique_part}.{input.output_format}"
-        object_name = f"transformed_images/{filename}"
-        logger.info("Generated unique filename", extra={
-            "correlation_id": correlation_id,
-            "vendor_id": vendor_id,
-            "unique_filename": filename
-        })
-        
-        # Upload the transformed image to S3 asynchronously.
-        with S3_OPERATION_DURATION.labels(operation_type="upload").time():
-            try:
-                s3_url = await asyncio.to_thread(upload_bytes_to_s3, api_response.content, S3_BUCKET, object_name)
-                IMAGE_SIZE.labels(operation_type="output").observe(len(api_response.content))
-                logger.info("Uploaded image to S3", extra={
-                    "correlation_id": correlation_id,
-                    "vendor_id": vendor_id,
-                    "s3_url": s3_url
-                })
-            except Exception as e:
-                ERROR_COUNTER.labels(error_type="s3_upload", vendor_id=vendor_id).inc()
-                logger.error("Error uploading image to S3", extra={
-                    "correlation_id": correlation_id,
-                    "vendor_id": vendor_id,
-                    "error": str(e)
-                })
-                raise HTTPException(status_code=500, detail=str(e))
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            body.close()
+    
+    return s3_url
+
+def result_body(s3_url: str) -> dict:
+    """Response body for a stored result, with a presigned download URL when OUTPUT_PRESIGNED_URLS is on."""
+    body = {"s3_url": s3_url}
+    if OUTPUT_PRESIGNED_URLS:
+        body["download_url"] = presign_download(s3_url)
+    return body
+
+async def process_replace_background_relight(input: ReplaceBackgroundRelightInput, correlation_id: str, vendor_id: str, shared_downloads: Optional[dict] = None) -> Tuple[str, Optional[str]]:
+    """
+    Runs the full download -> generate -> upload pipeline for one request.
+
+    Returns the S3 URL of the result and the result cache status (None when
+    the result cache does not apply to the request). `shared_downloads` lets
+    several requests reuse the same input image downloads.
+    """
+    # Fail fast, before any downloads, while the Stability API is known to be down.
+    retry_after = get_stability_client().breaker.retry_after()
+    if retry_after is not None:
+        raise upstream_unavailable(CircuitOpenError("stability", retry_after), correlation_id, vendor_id)
+
+    # Download all input images from S3/public URLs concurrently.
+    files = await fetch_input_images(input, correlation_id, vendor_id, shared_downloads)
+
+    if not (RESULT_CACHE_ENABLED and input.seed != 0):
+        return await generate_and_store(input, files, correlation_id, vendor_id), None
+
+    # Deterministic request: reuse (or join) a previous identical generation.
+    cache_key = await run_in_thread("result_fingerprint", result_fingerprint, input, files)
+    # Identical requests may join this generation, so it is not bound to this request's deadline.
+    s3_url, cache_status = await result_cache.get_or_create(
+        cache_key, lambda: without_deadline(generate_and_store(input, files, correlation_id, vendor_id))
+    )
+    logger.info("Result cache lookup", extra={
+        "correlation_id": correlation_id,
+        "vendor_id": vendor_id,
+        "result_cache": cache_status
+    })
+    return s3_url, cache_status
+
+@router.post("/replace-background-relight")
+async def replace_background_relight(request: Request, response: Response, input: ReplaceBackgroundRelightInput):
+    correlation_id = get_correlation_id()
+    start_time = time.time()
+    vendor_id = input.username or "anonymous"
+    
+    logger.info("Received request", extra={
+        "correlation_id": correlation_id,
+        "vendor_id": vendor_id,
+        "input": Lazy(input.model_dump, mode="json")
+    })
+    
+    count_vendor_request(vendor_id, "replace_background_relight")
+    
+    # Turn the vendor away early, before any downloads, if it is over its limits.
+    try:
+        generation_scheduler.admit(vendor_id)
+    except AdmissionRejected as e:
+        raise admission_error(e, correlation_id, vendor_id)
+    
+    try:
+        s3_url, cache_status = await run_with_deadline(
+            request, process_replace_background_relight(input, correlation_id, vendor_id), correlation_id, vendor_id
+        )
+        if cache_status:
+            response.headers["X-Result-Cache"] = cache_status
         
         processing_time = time.time() - start_time
         logger.info("Request completed", extra={
@@ -198,14 +461,245 @@ async def replace_background_relight(request: Request, input: ReplaceBackgroundR
             "processing_time": processing_time,
             "s3_url": s3_url
         })
+        await record_monitoring_log(input, correlation_id, start_time, "Request completed", s3_url=s3_url)
         
-        return {"s3_url": s3_url}
+        return result_body(s3_url)
         
     except Exception as e:
-        ERROR_COUNTER.labels(error_type="unknown", vendor_id=vendor_id).inc()
+        labelled(ERROR_COUNTER, error_type="unknown", vendor_id=vendor_id).inc()
         logger.error("Unexpected error", extra={
             "correlation_id": correlation_id,
             "vendor_id": vendor_id,
             "error": str(e)
         })
+        await record_monitoring_log(
+            input, correlation_id, start_time, str(getattr(e, "detail", e)),
+            level="ERROR", status_code=getattr(e, "status_code", 500)
+        )
         raise
+
+async def record_monitoring_log(input: ReplaceBackgroundRelightInput, correlation_id: str, start_time: float, message: str, **fields):
+    """Queues a MonitoringLog row for a finished request when the database sink is configured."""
+    writer = get_monitoring_log_writer()
+    if writer is None:
+        return
+    with span("monitoring_log"):
+        await writer.log(
+            user_id=input.username,
+            vendor_id=input.username or "anonymous",
+            endpoint="/replace-background-relight",
+            correlation_id=correlation_id,
+            message=message,
+            latency_ms=int((time.time() - start_time) * 1000),
+            **fields
+        )
+
+async def run_replace_background_relight_job(job: Job) -> dict:
+    """Job runner for queued replace-background-relight requests."""
+    input = ReplaceBackgroundRelightInput(**job.input)
+    correlation_id = get_correlation_id()
+    vendor_id = input.username or "anonymous"
+    start_time = time.time()
+    # Jobs outlive the submitting request, so they get their own trace under its request id.
+    with start_trace("job.replace_background_relight", correlation_id=correlation_id, job_id=job.job_id):
+        logger.info("Started job", extra={
+            "correlation_id": correlation_id,
+            "vendor_id": vendor_id,
+            "job_id": job.job_id
+        })
+        s3_url, _ = await process_replace_background_relight(input, correlation_id, vendor_id)
+        logger.info("Job completed", extra={
+            "correlation_id": correlation_id,
+            "vendor_id": vendor_id,
+            "job_id": job.job_id,
+            "processing_time": time.time() - start_time,
+            "s3_url": s3_url
+        })
+    return result_body(s3_url)
+
+@router.post("/jobs/replace-background-relight", status_code=202)
+async def submit_replace_background_relight_job(request: Request, input: ReplaceBackgroundRelightJobInput):
+    """Queues a transformation and returns immediately with a job id to poll."""
+    correlation_id = get_correlation_id()
+    vendor_id = input.username or "anonymous"
+    count_vendor_request(vendor_id, "replace_background_relight_job")
+    # Refuse before queueing, so a vendor over its limits cannot pile up jobs instead.
+    try:
+        generation_scheduler.admit(vendor_id)
+    except AdmissionRejected as e:
+        raise admission_error(e, correlation_id, vendor_id)
+    job = await get_job_store().submit(
+        input.model_dump(mode="json", exclude={"callback_url"}),
+        run_replace_background_relight_job,
+        callback_url=str(input.callback_url) if input.callback_url else None
+    )
+    logger.info("Accepted job", extra={
+        "vendor_id": vendor_id,
+        "job_id": job.job_id
+    })
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        "status_url": str(request.url_for("get_job", job_id=job.job_id))
+    }
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await get_job_store().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+def parse_batch_body(body: bytes, content_type: str) -> list:
+    """Parses a batch body given either as a JSON array or as NDJSON (one object per line)."""
+    try:
+        if "ndjson" in content_type or "jsonlines" in content_type:
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch body: {e}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Batch body must be a JSON array or NDJSON")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items")
+    return items
+
+async def run_batch_item(index: int, item, semaphore: asyncio.Semaphore, shared_downloads: dict, deadline: Deadline) -> dict:
+    """Validates and processes one batch item under the batch's deadline, returning its result line."""
+    try:
+        input = ReplaceBackgroundRelightInput.model_validate(item)
+    except ValidationError as e:
+        return {"index": index, "status": "failed", "status_code": 422, "detail": json.loads(e.json(include_url=False))}
+
+    vendor_id = input.username or "anonymous"
+    count_vendor_request(vendor_id, "replace_background_relight_batch")
+    correlation_id = f"{get_correlation_id()}:{index}"
+    # Each item is one generation and counts against the vendor's limits like a single request.
+    try:
+        generation_scheduler.admit(vendor_id)
+    except AdmissionRejected as e:
+        e = admission_error(e, correlation_id, vendor_id)
+        return {"index": index, "status": "failed", "status_code": e.status_code, "detail": e.detail,
+                "retry_after": int(e.headers["Retry-After"])}
+    async with semaphore:
+        try:
+            with deadline_scope(deadline):
+                s3_url, _ = await process_replace_background_relight(input, correlation_id, vendor_id, shared_downloads)
+        except DeadlineExceeded as e:
+            e = deadline_error(e, correlation_id, vendor_id)
+            return {"index": index, "status": "failed", "status_code": e.status_code, "detail": e.detail}
+        except HTTPException as e:
+            return {"index": index, "status": "failed", "status_code": e.status_code, "detail": e.detail}
+        except Exception as e:
+            labelled(ERROR_COUNTER, error_type="unknown", vendor_id=vendor_id).inc()
+            logger.error("Unexpected error in batch item", extra={
+                "correlation_id": correlation_id,
+                "vendor_id": vendor_id,
+                "error": str(e)
+            })
+            return {"index": index, "status": "failed", "status_code": 500, "detail": str(e)}
+    return {"index": index, "status": "succeeded", **result_body(s3_url)}
+
+@router.post("/batch/replace-background-relight")
+async def replace_background_relight_batch(request: Request):
+    """
+    Processes many transformations in one call.
+
+    Accepts a JSON array of inputs or NDJSON (Content-Type: application/x-ndjson).
+    Items run with bounded concurrency, share downloads of identical reference
+    images, and their results are streamed back as NDJSON lines in completion
+    order, each tagged with the item's index in the batch. A REQUEST_TIMEOUT_HEADER
+    sent by the client bounds the whole batch.
+    """
+    items = parse_batch_body(await request.body(), request.headers.get("content-type", ""))
+    logger.info("Received batch", extra={"items": len(items)})
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    shared_downloads = {}
+    # REQUEST_TIMEOUT is sized for one request; a batch only gets a time limit when the client asks for one.
+    timeout_header = request.headers.get(REQUEST_TIMEOUT_HEADER)
+    deadline = Deadline(request_timeout(timeout_header) if timeout_header else None)
+
+    async def stream_results():
+        tasks = [
+            asyncio.create_task(run_batch_item(index, item, semaphore, shared_downloads, deadline))
+            for index, item in enumerate(items)
+        ]
+        finished = False
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield json.dumps(await next_result) + "\n"
+            finished = True
+        finally:
+            # The client went away or the stream failed; stop the remaining items, including their worker threads.
+            if not finished:
+                deadline.cancel(CLIENT_DISCONNECT)
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@router.post("/uploads")
+async def create_upload(input: UploadRequest):
+    """
+    Returns a presigned URL the client uploads an input image to with an HTTP
+    PUT, so the bytes go straight to storage. The returned `url` is then
+    passed as an image URL in transformation requests.
+    """
+    extension = input.content_type.split("/", 1)[1]
+    location = ObjectLocation(S3_BUCKET, f"uploads/{uuid.uuid4()}.{extension}")
+    storage = get_storage()
+    upload_url = storage.presign_put(location, input.content_type)
+    logger.info("Issued presigned upload", extra={
+        "vendor_id": input.username or "anonymous",
+        "key": location.key
+    })
+    return {
+        "url": storage.url(location),
+        "upload_url": upload_url,
+        "method": "PUT",
+        "headers": {"Content-Type": input.content_type},
+        "expires_in": STORAGE_PRESIGN_EXPIRES
+    }
+
+def signed_local_object(method: str, bucket: str, key: str, expires: int, signature: str) -> Tuple[LocalStorage, ObjectLocation]:
+    """Checks a presigned request to the local storage backend; only that backend serves objects itself."""
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        raise HTTPException(status_code=404, detail="Not found")
+    location = ObjectLocation(bucket, key)
+    if not storage.verify(method, location, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired signature")
+    return storage, location
+
+@router.get("/storage/{bucket}/{key:path}")
+async def get_stored_object(bucket: str, key: str, expires: int, signature: str):
+    """Serves a presigned download from the local storage backend."""
+    storage, location = signed_local_object("GET", bucket, key, expires, signature)
+    try:
+        path = storage.path(location)
+    except InvalidObjectURL as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Object not found")
+    headers = await run_in_thread("storage_headers", storage.headers, location)
+    return FileResponse(path, media_type=headers.pop("Content-Type", None), headers=headers)
+
+@router.put("/storage/{bucket}/{key:path}")
+async def put_stored_object(request: Request, bucket: str, key: str, expires: int, signature: str):
+    """Accepts a presigned upload to the local storage backend."""
+    storage, location = signed_local_object("PUT", bucket, key, expires, signature)
+    body = SpooledBody()
+    try:
+        async for chunk in request.stream():
+            body.write(chunk)
+            if body.size > STORAGE_MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds {STORAGE_MAX_UPLOAD_BYTES} bytes")
+        await run_in_thread(
+            "storage_write", storage.write, location, body.rewind(), request.headers.get("content-type", "application/octet-stream")
+        )
+    except InvalidObjectURL as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        body.close()
+    return Response(status_code=200, headers={"ETag": body.etag})
@@ -0,0 +1,263 @@
+# app/cache.py
+import hashlib
+import itertools
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+from app.config import (
+    IMAGE_CACHE_MAX_BYTES,
+    IMAGE_CACHE_DISK_DIR,
+    IMAGE_CACHE_DISK_MAX_BYTES,
+    IMAGE_CACHE_REVALIDATE_AFTER,
+)
+from app.metrics import IMAGE_CACHE_HITS, IMAGE_CACHE_MISSES, IMAGE_CACHE_EVICTIONS, IMAGE_CACHE_BYTES
+from app.logging_utils import setup_logging
+
+logger = setup_logging("app.cache")
+
+# Called with the cached ETag (or None); returns (etag, content), or None when
+# the cached ETag is still current.
+Loader = Callable[[Optional[str]], Optional[Tuple[str, bytes]]]
+
+@dataclass
+class _Entry:
+    etag: str
+    size: int
+    validated_at: float
+    data: Optional[bytes] = None  # Memory tier
+    path: Optional[str] = None  # Disk tier
+
+class ImageCache:
+    """
+    Two-tier cache of input images keyed by object key and ETag.
+
+    Entries live in a byte-bounded in-memory LRU. When a disk directory is
+    configured, entries evicted from memory spill to files that are read back
+    through mmap. Entries older than `revalidate_after` seconds are re-checked
+    with a conditional request before being served, and concurrent misses for
+    the same key share a single load. Thread-safe; loads and disk reads and
+    writes run outside the lock.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+        disk_dir: Optional[str] = IMAGE_CACHE_DISK_DIR,
+        disk_max_bytes: int = IMAGE_CACHE_DISK_MAX_BYTES,
+        revalidate_after: float = IMAGE_CACHE_REVALIDATE_AFTER,
+    ):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.revalidate_after = revalidate_after
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._inflight = {}
+        self._spilling = {}  # Entries on their way to the disk tier; still served from memory
+        self._spill_ids = itertools.count()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key: str, loader: Loader) -> bytes:
+        """Returns the content for `key`, loading or revalidating it with `loader` when needed."""
+        with self._lock:
+            entry, tier = self._lookup(key)
+            fresh = entry is not None and time.monotonic() - entry.validated_at < self.revalidate_after
+            if fresh and tier == "memory":
+                IMAGE_CACHE_HITS.labels(tier=tier).inc()
+                return entry.data
+            if not fresh:
+                future, owner = self._claim(key)
+
+        if fresh:
+            # Disk hits are read outside the lock, so they do not stall lookups of other keys.
+            data = self._read_disk(key, entry)
+            if data is not None:
+                IMAGE_CACHE_HITS.labels(tier=tier).inc()
+                return data
+            entry = None
+            with self._lock:
+                future, owner = self._claim(key)
+
+        if not owner:
+            return future.result()
+
+        try:
+            data = self._load(key, entry, loader)
+            future.set_result(data)
+            return data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _claim(self, key: str) -> Tuple[Future, bool]:
+        # Called with the lock held; returns the key's in-flight load and whether the caller runs it.
+        future = self._inflight.get(key)
+        if future is not None:
+            return future, False
+        future = self._inflight[key] = Future()
+        return future, True
+
+    def _load(self, key: str, entry: Optional[_Entry], loader: Loader) -> bytes:
+        result = loader(entry.etag if entry is not None else None)
+        if result is None:
+            data = None
+            with self._lock:
+                # The stored copy is still current; it may have moved tiers meanwhile.
+                current, tier = self._lookup(key)
+                if current is None or current.etag != entry.etag:
+                    current = None
+                else:
+                    current.validated_at = time.monotonic()
+                    data = current.data
+            if current is not None and tier == "disk":
+                data = self._read_disk(key, current)
+            if data is not None:
+                IMAGE_CACHE_HITS.labels(tier=tier).inc()
+                return data
+            # Evicted or unreadable after revalidation; fetch the full object.
+            result = loader(None)
+        etag, data = result
+        with self._lock:
+            IMAGE_CACHE_MISSES.inc()
+            spills = self._store(key, etag, data)
+        self._write_spills(spills)
+        return data
+
+    def _lookup(self, key: str):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key], "memory"
+        if key in self._spilling:
+            return self._spilling[key], "memory"
+        if key in self._disk:
+            self._disk.move_to_end(key)
+            return self._disk[key], "disk"
+        return None, None
+
+    def _read_disk(self, key: str, entry: _Entry) -> Optional[bytes]:
+        """
+        Reads a disk tier entry without holding the lock, or returns None if
+        its file can no longer be read. Readable entries that fit are promoted
+        back to memory unless the key changed while the file was being read.
+        """
+        try:
+            with open(entry.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = mm[:]
+        except (OSError, ValueError) as e:
+            with self._lock:
+                if self._disk.get(key) is entry:
+                    logger.warning(f"Dropping unreadable disk cache entry for {key}: {str(e)}")
+                    self._drop_disk(key)
+                    self._update_gauges()
+            return None
+        if entry.size <= self.max_bytes:
+            spills = []
+            with self._lock:
+                if self._disk.get(key) is entry:
+                    # The disk copy is released by _store.
+                    spills = self._store(key, entry.etag, data, validated_at=entry.validated_at)
+            self._write_spills(spills)
+        return data
+
+    def _store(self, key: str, etag: str, data: bytes, validated_at: Optional[float] = None) -> list:
+        """
+        Called with the lock held. Returns the spills to disk it reserved, which
+        the caller writes with `_write_spills` once it has released the lock.
+        """
+        self._remove(key)
+        entry = _Entry(etag=etag, size=len(data), validated_at=validated_at or time.monotonic())
+        spills = []
+        if entry.size <= self.max_bytes:
+            entry.data = data
+            self._memory[key] = entry
+            self._memory_bytes += entry.size
+            while self._memory_bytes > self.max_bytes:
+                evicted_key, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted.size
+                IMAGE_CACHE_EVICTIONS.labels(tier="memory").inc()
+                spills.append(self._reserve_spill(evicted_key, evicted, evicted.data))
+        else:
+            spills.append(self._reserve_spill(key, entry, data))
+        self._update_gauges()
+        return [spill for spill in spills if spill is not None]
+
+    def _reserve_spill(self, key: str, entry: _Entry, data: bytes):
+        # Called with the lock held. Each spill gets a file name of its own, so a
+        # superseded spill still being written never clobbers a newer one.
+        if not self.disk_dir or entry.size > self.disk_max_bytes:
+            return None
+        name = hashlib.sha256(f"{key}\0{entry.etag}".encode()).hexdigest()
+        pending = _Entry(
+            etag=entry.etag, size=entry.size, validated_at=entry.validated_at, data=data,
+            path=os.path.join(self.disk_dir, f"{name}.{next(self._spill_ids)}"),
+        )
+        self._spilling[key] = pending
+        return key, pending
+
+    def _write_spills(self, spills: list):
+        """Writes reserved spill files without the lock, then adds those still wanted to the disk tier."""
+        for key, pending in spills:
+            tmp_path = f"{pending.path}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(pending.data)
+                os.replace(tmp_path, pending.path)
+                written = True
+            except OSError as e:
+                logger.warning(f"Failed to spill {key} to disk cache: {str(e)}")
+                written = False
+            with self._lock:
+                wanted = self._spilling.get(key) is pending
+                if wanted:
+                    del self._spilling[key]
+                if wanted and written:
+                    pending.data = None
+                    self._disk[key] = pending
+                    self._disk_bytes += pending.size
+                    while self._disk_bytes > self.disk_max_bytes:
+                        evicted_key = next(iter(self._disk))
+                        self._drop_disk(evicted_key)
+                        IMAGE_CACHE_EVICTIONS.labels(tier="disk").inc()
+                    self._update_gauges()
+                    continue
+            # Failed, or the key was stored again or dropped while its file was written.
+            for path in (tmp_path, pending.path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _remove(self, key: str):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= entry.size
+        self._spilling.pop(key, None)
+        self._drop_disk(key)
+
+    def _drop_disk(self, key: str):
+        entry = self._disk.pop(key, None)
+        if entry is None:
+            return
+        self._disk_bytes -= entry.size
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+    def _update_gauges(self):
+        IMAGE_CACHE_BYTES.labels(tier="memory").set(self._memory_bytes)
+        IMAGE_CACHE_BYTES.labels(tier="disk").set(self._disk_bytes)
+
+image_cache = ImageCache()
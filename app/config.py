@@ -4,8 +4,167 @@ from dotenv import load_dotenv
 load_dotenv()  # Loads environment variables from a .env file
 
 STABILITY_KEY = os.getenv("STABILITY_KEY")
-if not STABILITY_KEY:
-    raise RuntimeError("STABILITY_KEY environment variable not set")
 S3_BUCKET = os.getenv("S3_BUCKET")  # Set your S3 bucket name
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
\ No newline at end of file
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+
+# Stability API client settings
+STABILITY_API_HOST = os.getenv("STABILITY_API_HOST", "https://api.stability.ai")
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", 500))  # Max seconds to poll for a result
+STABILITY_MAX_CONNECTIONS = int(os.getenv("STABILITY_MAX_CONNECTIONS", 200))
+STABILITY_MAX_KEEPALIVE = int(os.getenv("STABILITY_MAX_KEEPALIVE", 50))
+STABILITY_HTTP2 = os.getenv("STABILITY_HTTP2", "true").lower() == "true"
+
+# Result polling schedule
+POLL_INITIAL_DELAY = float(os.getenv("POLL_INITIAL_DELAY", 1.0))  # Seconds before the first poll with no history
+POLL_MAX_DELAY = float(os.getenv("POLL_MAX_DELAY", 10.0))
+POLL_BACKOFF_MULTIPLIER = float(os.getenv("POLL_BACKOFF_MULTIPLIER", 1.5))
+POLL_JITTER = float(os.getenv("POLL_JITTER", 0.2))  # Fraction of each delay randomised either way
+
+# Shared S3 client settings
+AWS_DEFAULT_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # Optional override, e.g. a local S3 stand-in
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+S3_RETRY_MODE = os.getenv("S3_RETRY_MODE", "standard")
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 3))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", 5))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", 30))
+
+# Object storage
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")  # "s3" or "local"
+STORAGE_ALLOWED_BUCKETS = os.getenv("STORAGE_ALLOWED_BUCKETS", "")  # Comma-separated input buckets besides S3_BUCKET
+STORAGE_LOCAL_ROOT = os.getenv("STORAGE_LOCAL_ROOT", "storage")  # Directory of the local backend, one subdirectory per bucket
+STORAGE_PUBLIC_URL = os.getenv("STORAGE_PUBLIC_URL", "http://localhost:8000")  # Base URL clients reach this service at
+STORAGE_SIGNING_KEY = os.getenv("STORAGE_SIGNING_KEY")  # Signs local presigned URLs; set the same value on every worker
+STORAGE_PRESIGN_EXPIRES = int(os.getenv("STORAGE_PRESIGN_EXPIRES", 3600))  # Seconds presigned URLs stay valid
+STORAGE_MAX_UPLOAD_BYTES = int(os.getenv("STORAGE_MAX_UPLOAD_BYTES", 50 * 1024 * 1024))  # Local presigned PUT limit
+OUTPUT_PRESIGNED_URLS = os.getenv("OUTPUT_PRESIGNED_URLS", "false").lower() == "true"  # Add a download_url to results
+
+# Request deadlines
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 600))  # Default budget of a synchronous request in seconds; 0 disables
+REQUEST_TIMEOUT_MAX = float(os.getenv("REQUEST_TIMEOUT_MAX", 900))  # Upper bound on budgets asked for by clients
+REQUEST_TIMEOUT_HEADER = os.getenv("REQUEST_TIMEOUT_HEADER", "X-Request-Timeout")  # Seconds the client will wait
+
+# Input image fetching
+INPUT_FETCH_TIMEOUT = float(os.getenv("INPUT_FETCH_TIMEOUT", 60))  # Per-asset download timeout in seconds
+
+# Input image cache
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "true").lower() == "true"
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+IMAGE_CACHE_DISK_DIR = os.getenv("IMAGE_CACHE_DISK_DIR")  # Enables the on-disk tier when set
+IMAGE_CACHE_DISK_MAX_BYTES = int(os.getenv("IMAGE_CACHE_DISK_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+IMAGE_CACHE_REVALIDATE_AFTER = float(os.getenv("IMAGE_CACHE_REVALIDATE_AFTER", 60))  # Seconds before an ETag is re-checked
+
+# Result memoization for deterministic (seed != 0) requests
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "false").lower() == "true"
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 24 * 3600))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 10000))
+
+# Asynchronous job mode
+JOB_EXECUTION = os.getenv("JOB_EXECUTION", "inline")  # "inline" (in the API process) or "queue" (run by python -m app.worker)
+JOB_STORE_BACKEND = os.getenv("JOB_STORE_BACKEND", "sqlite" if JOB_EXECUTION == "queue" else "memory")  # "memory" or "sqlite"
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "jobs.db")  # SQLite database file
+JOB_MAX_CONCURRENCY = int(os.getenv("JOB_MAX_CONCURRENCY", 50))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", 24 * 3600))  # Seconds finished jobs stay queryable
+JOB_CALLBACK_TIMEOUT = float(os.getenv("JOB_CALLBACK_TIMEOUT", 10))
+JOB_CALLBACK_ATTEMPTS = int(os.getenv("JOB_CALLBACK_ATTEMPTS", 3))
+JOB_CALLBACK_ALLOWED_HOSTS = os.getenv("JOB_CALLBACK_ALLOWED_HOSTS", "")  # e.g. "hooks.example.com"; subdomains included. Empty allows any public host
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", 20))  # Jobs each app.worker process runs at once
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))  # A job whose worker stops renewing this long is redelivered
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))  # Deliveries before a repeatedly lost job is failed
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))  # Seconds an idle worker waits before checking the queue again
+JOB_WORKER_METRICS_PORT = int(os.getenv("JOB_WORKER_METRICS_PORT", 9100))  # Prometheus endpoint of app.worker; 0 disables
+
+# Batch submission
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 1000))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 16))  # Items processed at once per batch
+
+# Streaming transfers
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 256 * 1024))
+STREAM_SPOOL_MAX_MEMORY = int(os.getenv("STREAM_SPOOL_MAX_MEMORY", 8 * 1024 * 1024))  # Larger bodies spill to a temp file
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))  # Also used as the part size
+S3_TRANSFER_CONCURRENCY = int(os.getenv("S3_TRANSFER_CONCURRENCY", 4))
+
+# Outbound generation scheduling
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", 50))  # Match the Stability concurrency quota
+SCHEDULER_QUOTA_SHARES = int(os.getenv("SCHEDULER_QUOTA_SHARES", 1))  # Processes splitting that quota; app.server sets it to SERVER_WORKERS
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", 1000))
+VENDOR_MAX_QUEUE = int(os.getenv("VENDOR_MAX_QUEUE", 100))
+VENDOR_RATE = float(os.getenv("VENDOR_RATE", 2))  # Sustained requests per second per vendor; 0 disables the rate limit
+VENDOR_BURST = float(os.getenv("VENDOR_BURST", 20))
+VENDOR_WEIGHTS = os.getenv("VENDOR_WEIGHTS", "")  # e.g. "bigvendor:3,smallvendor:1"; others weigh 1
+
+# MonitoringLog database sink
+MONITORING_LOG_DSN = os.getenv("MONITORING_LOG_DSN")  # Postgres DSN; the sink is disabled when unset
+MONITORING_LOG_BATCH_SIZE = int(os.getenv("MONITORING_LOG_BATCH_SIZE", 500))
+MONITORING_LOG_FLUSH_INTERVAL = float(os.getenv("MONITORING_LOG_FLUSH_INTERVAL", 1.0))
+MONITORING_LOG_MAX_BUFFER = int(os.getenv("MONITORING_LOG_MAX_BUFFER", 10000))  # Rows held in memory at most
+MONITORING_LOG_MAX_WAIT = float(os.getenv("MONITORING_LOG_MAX_WAIT", 0.05))  # Seconds a writer waits for room before dropping
+MONITORING_LOG_USE_COPY = os.getenv("MONITORING_LOG_USE_COPY", "true").lower() == "true"
+
+# Thread pool behind asyncio.to_thread (S3 transfers, file and SQLite I/O)
+THREAD_POOL_WORKERS = int(os.getenv("THREAD_POOL_WORKERS", min(32, (os.cpu_count() or 1) + 4)))  # asyncio's default size
+
+# Image processing worker processes (input preprocessing and output transcoding)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Input image preprocessing
+PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "true").lower() == "true"
+PREPROCESS_MAX_PIXELS = int(os.getenv("PREPROCESS_MAX_PIXELS", 9437184))  # Stability's limit for input images
+PREPROCESS_MIN_SIDE = int(os.getenv("PREPROCESS_MIN_SIDE", 64))
+PREPROCESS_MAX_BYTES = int(os.getenv("PREPROCESS_MAX_BYTES", 10 * 1024 * 1024))  # Larger inputs are re-encoded
+PREPROCESS_QUALITY = int(os.getenv("PREPROCESS_QUALITY", 90))  # JPEG/WebP quality when re-encoding
+
+# Output post-processing
+OUTPUT_TRANSCODE_ENABLED = os.getenv("OUTPUT_TRANSCODE_ENABLED", "false").lower() == "true"  # Request PNG upstream and encode locally
+OUTPUT_QUALITY_PRESET = os.getenv("OUTPUT_QUALITY_PRESET", "balanced")  # "high", "balanced" or "small"
+OUTPUT_THUMBNAIL_SIZES = [int(size) for size in os.getenv("OUTPUT_THUMBNAIL_SIZES", "").split(",") if size.strip()]  # Max side in pixels
+OUTPUT_CACHE_CONTROL = os.getenv("OUTPUT_CACHE_CONTROL", "public, max-age=31536000, immutable")  # Result object names are unique
+
+# Request tracing
+SERVICE_NAME = os.getenv("SERVICE_NAME", "replace-background-relight")
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")  # "none", "console" or "file" (OTLP JSON, one trace per line)
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "traces.jsonl")
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+
+# Metrics
+METRICS_ENABLED = os.getenv("ENABLE_METRICS", "true").lower() in ("true", "1")
+METRICS_MAX_VENDORS = int(os.getenv("METRICS_MAX_VENDORS", 50))  # Distinct vendor_id label values; the rest are "other"
+METRICS_VENDOR_MIN_REQUESTS = int(os.getenv("METRICS_VENDOR_MIN_REQUESTS", 20))  # Requests before a vendor gets its own label
+METRICS_VENDORS = os.getenv("METRICS_VENDORS", "")  # Comma-separated vendors that always get their own label
+
+# Outbound call resilience
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "true").lower() == "true"
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", 0.5))  # Fraction of failed calls that opens a breaker
+BREAKER_SLOW_CALL_RATE = float(os.getenv("BREAKER_SLOW_CALL_RATE", 0.8))  # Fraction of slow calls that opens a breaker
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", 50))  # Recent calls the rates are computed over
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", 10))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", 30))  # Fast-fail period before probing again
+BREAKER_HALF_OPEN_CALLS = int(os.getenv("BREAKER_HALF_OPEN_CALLS", 3))  # Probe calls that must succeed to close
+STABILITY_SLOW_CALL_SECONDS = float(os.getenv("STABILITY_SLOW_CALL_SECONDS", 30))  # Generation submit
+S3_SLOW_CALL_SECONDS = float(os.getenv("S3_SLOW_CALL_SECONDS", 10))
+S3_READ_ATTEMPTS = int(os.getenv("S3_READ_ATTEMPTS", 3))  # Attempts per idempotent S3 read
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", 0.1))  # Retries allowed per request, on average
+S3_HEDGE_ENABLED = os.getenv("S3_HEDGE_ENABLED", "false").lower() == "true"
+S3_HEDGE_DELAY = float(os.getenv("S3_HEDGE_DELAY", 0.2))  # Seconds before a duplicate GET is sent
+S3_HEDGE_BUDGET_RATIO = float(os.getenv("S3_HEDGE_BUDGET_RATIO", 0.05))  # Hedged reads allowed per read, on average
+
+# Profiling and event loop diagnostics
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # Bearer token for the /admin endpoints; they are disabled when unset
+EVENT_LOOP_MONITOR_INTERVAL = float(os.getenv("EVENT_LOOP_MONITOR_INTERVAL", 0.25))  # Seconds between lag probes; 0 disables
+SLOW_CALLBACK_SECONDS = float(os.getenv("SLOW_CALLBACK_SECONDS", 0.1))  # Loop stalls longer than this are logged with the blocking stack
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))  # Longest sampling profile /admin/profile will take
+
+# Production server (python -m app.server)
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 8000))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", os.cpu_count() or 1))  # Each worker has its own pools and limits
+SERVER_DRAIN_TIMEOUT = int(os.getenv("SERVER_DRAIN_TIMEOUT", 60))  # Seconds in-flight requests, then jobs, get to finish on SIGTERM
+SERVER_KEEPALIVE_TIMEOUT = int(os.getenv("SERVER_KEEPALIVE_TIMEOUT", 65))  # Keep above the load balancer's idle timeout
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", 2048))
+SERVER_ACCESS_LOG = os.getenv("SERVER_ACCESS_LOG", "false").lower() == "true"  # Requests are already logged by the API
+
+def validate_config():
+    """Fails startup when settings required to serve requests are missing."""
+    if not STABILITY_KEY:
+        raise RuntimeError("STABILITY_KEY environment variable not set")
@@ -0,0 +1,118 @@
+# app/deadlines.py
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from app.config import REQUEST_TIMEOUT, REQUEST_TIMEOUT_MAX
+from app.metrics import ABANDONED_WORK
+
+DEADLINE = "deadline"
+CLIENT_DISCONNECT = "client_disconnect"
+
+class DeadlineExceeded(Exception):
+    """Raised at a checkpoint once the request's deadline has passed or its client has gone away."""
+
+    def __init__(self, stage: str, reason: str):
+        message = "Request deadline exceeded" if reason == DEADLINE else "Client disconnected"
+        super().__init__(f"{message} before {stage}")
+        self.stage = stage
+        self.reason = reason
+
+class Deadline:
+    """
+    Time budget of one request, shared by everything working on it.
+
+    The current deadline lives in a ContextVar, so tasks and `asyncio.to_thread`
+    workers started for the request see the same instance and can stop at
+    their next checkpoint once it expires or is cancelled.
+    """
+
+    def __init__(self, timeout: Optional[float]):
+        self.expires_at = time.monotonic() + timeout if timeout is not None else None
+        self.cancel_reason: Optional[str] = None
+        self.stage = "start"
+
+    @property
+    def reason(self) -> Optional[str]:
+        """Why work should stop, or None while the request is still wanted."""
+        if self.cancel_reason is not None:
+            return self.cancel_reason
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            return DEADLINE
+        return None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, 0 once cancelled, or None without a time limit."""
+        if self.cancel_reason is not None:
+            return 0.0
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def cancel(self, reason: str = CLIENT_DISCONNECT):
+        """Marks the request as abandoned; work still running stops at its next checkpoint."""
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+            ABANDONED_WORK.labels(stage=self.stage, reason=reason).inc()
+
+    def check(self, stage: str):
+        """Records `stage` as the current step; raises DeadlineExceeded if work should stop."""
+        self.stage = stage
+        reason = self.reason
+        if reason is not None:
+            # Counted once per request, at the stage that first noticed.
+            self.cancel(reason)
+            raise DeadlineExceeded(stage, reason)
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar("deadline", default=None)
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+def time_remaining(limit: Optional[float] = None) -> Optional[float]:
+    """Seconds left before the current deadline, capped at `limit`; None when neither bounds it."""
+    deadline = _current_deadline.get()
+    remaining = deadline.remaining() if deadline is not None else None
+    if remaining is None:
+        return limit
+    return remaining if limit is None else min(limit, remaining)
+
+def deadline_expired() -> bool:
+    """True when the current request's deadline has passed or it was cancelled."""
+    deadline = _current_deadline.get()
+    return deadline is not None and deadline.reason is not None
+
+def check_deadline(stage: str):
+    """Checkpoint for the current request; a no-op outside a deadline scope."""
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.check(stage)
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]):
+    """Runs the block, and the tasks and threads it starts, under `deadline` (None for no deadline)."""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+async def without_deadline(coro):
+    """Awaits `coro` outside any request deadline, for work shared by several requests."""
+    with deadline_scope(None):
+        return await coro
+
+def request_timeout(header_value: Optional[str]) -> Optional[float]:
+    """
+    The budget for a request: the client's own timeout (in seconds) when it
+    sends a valid one, capped at REQUEST_TIMEOUT_MAX, or REQUEST_TIMEOUT.
+    Returns None when no limit applies.
+    """
+    if header_value:
+        try:
+            timeout = float(header_value)
+        except ValueError:
+            timeout = 0
+        if timeout > 0:
+            return min(timeout, REQUEST_TIMEOUT_MAX)
+    return REQUEST_TIMEOUT if REQUEST_TIMEOUT > 0 else None
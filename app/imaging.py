@@ -0,0 +1,257 @@
+# app/imaging.py
+import asyncio
+import math
+import os
+import multiprocessing
+import time
+from io import BytesIO
+from typing import BinaryIO, Dict, Optional, Tuple
+from PIL import Image, ImageOps, UnidentifiedImageError
+from app.config import (
+    IMAGE_WORKERS,
+    PREPROCESS_MAX_PIXELS,
+    PREPROCESS_MIN_SIDE,
+    PREPROCESS_MAX_BYTES,
+    PREPROCESS_QUALITY,
+    OUTPUT_QUALITY_PRESET,
+)
+from app.metrics import IMAGE_PREPROCESS_DURATION, IMAGE_PREPROCESS_RESULTS, IMAGE_POSTPROCESS_DURATION
+from app.pools import InstrumentedProcessPoolExecutor
+
+# Formats the Stability API accepts as-is; anything else Pillow can read is converted to PNG.
+SUPPORTED_FORMATS = ("png", "jpeg", "webp")
+
+CONTENT_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# Encoder settings per output format; "small" trades CPU time for fewer bytes.
+QUALITY_PRESETS = {
+    "high": {
+        "png": {"compress_level": 6},
+        "jpeg": {"quality": 95, "subsampling": 0},
+        "webp": {"quality": 95, "method": 4},
+    },
+    "balanced": {
+        "png": {"compress_level": 9},
+        "jpeg": {"quality": 85, "optimize": True, "progressive": True},
+        "webp": {"quality": 80, "method": 4},
+    },
+    "small": {
+        "png": {"compress_level": 9, "optimize": True},
+        "jpeg": {"quality": 75, "optimize": True, "progressive": True},
+        "webp": {"quality": 70, "method": 6},
+    },
+}
+
+MAGIC_BYTES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+)
+
+ORIENTATION_TAG = 0x0112
+
+class InvalidImage(ValueError):
+    """Raised for input images that are unreadable or cannot be brought within the API's limits."""
+
+def sniff_format(head: bytes) -> Optional[str]:
+    """Identifies an image format from its first bytes, or returns None."""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    for magic, format in MAGIC_BYTES:
+        if head.startswith(magic):
+            return format
+    return None
+
+def preprocess(
+    data: bytes,
+    max_pixels: int = PREPROCESS_MAX_PIXELS,
+    min_side: int = PREPROCESS_MIN_SIDE,
+    max_bytes: int = PREPROCESS_MAX_BYTES,
+    quality: int = PREPROCESS_QUALITY,
+) -> Tuple[Optional[bytes], str, Dict[str, float]]:
+    """
+    Validates an image and brings it within the API's limits. Runs in a worker process.
+
+    Returns (content, format, step timings); content is None when the original
+    bytes can be sent unchanged. The image is fully decoded, so truncated or
+    corrupt files raise InvalidImage here instead of failing upstream.
+    """
+    timings = {}
+    start = time.perf_counter()
+    format = sniff_format(data[:16])
+    if format is None:
+        raise InvalidImage("Unsupported or unrecognized image format")
+    timings["sniff"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        image = Image.open(BytesIO(data))
+        width, height = image.size
+        if min(width, height) < min_side:
+            raise InvalidImage(f"Image is {width}x{height}; both sides must be at least {min_side} pixels")
+        scale = min(1.0, math.sqrt(max_pixels / (width * height)))
+        if scale < 1 and format == "jpeg":
+            # Let the JPEG decoder skip detail we are about to throw away.
+            image.draft(image.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+        image.load()
+    except InvalidImage:
+        raise
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImage(f"Corrupt {format} image: {e}")
+    timings["decode"] = time.perf_counter() - start
+
+    orientation = image.getexif().get(ORIENTATION_TAG, 1)
+    normalize_mode = image.mode not in ("RGB", "RGBA", "L", "LA", "P")
+    if not (scale < 1 or orientation != 1 or normalize_mode or format not in SUPPORTED_FORMATS or len(data) > max_bytes):
+        return None, format, timings
+
+    start = time.perf_counter()
+    if orientation != 1:
+        # Bake the EXIF rotation into the pixels, since metadata is not kept.
+        image = ImageOps.exif_transpose(image)
+        if orientation in (5, 6, 7, 8):
+            width, height = height, width
+    if normalize_mode or (scale < 1 and image.mode == "P"):
+        # Unusual modes (CMYK, 16-bit, ...) are normalized, and palette images would
+        # otherwise be resized with nearest-neighbour sampling.
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    if scale < 1:
+        # Target size from the original dimensions, even if the decoder already reduced them.
+        image = image.resize(
+            (max(1, math.floor(width * scale)), max(1, math.floor(height * scale))),
+            Image.Resampling.LANCZOS
+        )
+    timings["transform"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output_format = format if format in SUPPORTED_FORMATS else "png"
+    if output_format == "jpeg" and image.mode in ("RGBA", "LA"):
+        output_format = "png"
+    buffer = BytesIO()
+    if output_format == "png":
+        image.save(buffer, "PNG", compress_level=6)
+    elif output_format == "jpeg":
+        image.save(buffer, "JPEG", quality=quality)
+    else:
+        image.save(buffer, "WEBP", quality=quality, method=4)
+    timings["encode"] = time.perf_counter() - start
+    content = buffer.getvalue()
+    if len(content) > max_bytes:
+        raise InvalidImage(f"Image is {len(content)} bytes after re-encoding; the limit is {max_bytes}")
+    return content, output_format, timings
+
+def encode_image(image: Image.Image, format: str, preset: str = OUTPUT_QUALITY_PRESET) -> bytes:
+    """Encodes an image in one of the output formats with the preset's settings."""
+    if format == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format.upper(), **QUALITY_PRESETS[preset][format])
+    return buffer.getvalue()
+
+def postprocess(
+    data: bytes,
+    output_format: str,
+    transcode: bool,
+    thumbnail_sizes: Tuple[int, ...] = (),
+    preset: str = OUTPUT_QUALITY_PRESET,
+) -> Tuple[Optional[bytes], Dict[int, bytes], Dict[str, float]]:
+    """
+    Re-encodes a generated image and renders thumbnails. Runs in a worker process.
+
+    Returns (content, thumbnails by size, step timings); content is None when
+    the upstream bytes should be stored as they are, either because
+    `transcode` is off or because they are already smaller in the right format.
+    """
+    timings = {}
+    start = time.perf_counter()
+    image = Image.open(BytesIO(data))
+    image.load()
+    timings["decode"] = time.perf_counter() - start
+
+    content = None
+    if transcode:
+        start = time.perf_counter()
+        content = encode_image(image, output_format, preset)
+        if sniff_format(data[:16]) == output_format and len(content) >= len(data):
+            content = None
+        timings["encode"] = time.perf_counter() - start
+
+    thumbnails = {}
+    start = time.perf_counter()
+    for size in thumbnail_sizes:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.Resampling.LANCZOS)
+        thumbnails[size] = encode_image(thumbnail, output_format, preset)
+    if thumbnail_sizes:
+        timings["thumbnails"] = time.perf_counter() - start
+    return content, thumbnails, timings
+
+_executor: Optional[InstrumentedProcessPoolExecutor] = None
+
+def get_image_executor() -> InstrumentedProcessPoolExecutor:
+    """Returns the process pool used for image work, creating it on first use."""
+    global _executor
+    if _executor is None:
+        # Spawned rather than forked: the service process runs threads (logging, S3 transfers).
+        _executor = InstrumentedProcessPoolExecutor(
+            "image",
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+def _worker_pid(_) -> int:
+    return os.getpid()
+
+def warm_up_image_executor():
+    """Starts every worker process, with its imports, now rather than on the first request."""
+    executor = get_image_executor()
+    list(executor.map(_worker_pid, range(IMAGE_WORKERS)))
+
+def shutdown_image_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+async def preprocess_input(fileobj: BinaryIO, operation_type: str) -> BinaryIO:
+    """
+    Runs `preprocess` for a downloaded input in the process pool and returns
+    the file to send: the original, rewound, or a new buffer with the result.
+    """
+    start = time.perf_counter()
+    data = await asyncio.to_thread(fileobj.read)
+    fileobj.seek(0)
+    try:
+        content, format, timings = await asyncio.get_running_loop().run_in_executor(
+            get_image_executor(), preprocess, data
+        )
+    except InvalidImage:
+        IMAGE_PREPROCESS_RESULTS.labels(operation_type=operation_type, result="rejected").inc()
+        raise
+    total = time.perf_counter() - start
+    for step, duration in timings.items():
+        IMAGE_PREPROCESS_DURATION.labels(step=step).observe(duration)
+    IMAGE_PREPROCESS_DURATION.labels(step="total").observe(total)
+    if content is None:
+        IMAGE_PREPROCESS_RESULTS.labels(operation_type=operation_type, result="unchanged").inc()
+        return fileobj
+    IMAGE_PREPROCESS_RESULTS.labels(operation_type=operation_type, result="reencoded").inc()
+    fileobj.close()
+    return BytesIO(content)
+
+async def postprocess_output(fileobj: BinaryIO, output_format: str, transcode: bool, thumbnail_sizes: Tuple[int, ...]) -> Tuple[Optional[bytes], Dict[int, bytes]]:
+    """Runs `postprocess` for a generated image in the process pool."""
+    data = await asyncio.to_thread(fileobj.read)
+    fileobj.seek(0)
+    content, thumbnails, timings = await asyncio.get_running_loop().run_in_executor(
+        get_image_executor(), postprocess, data, output_format, transcode, tuple(thumbnail_sizes)
+    )
+    for step, duration in timings.items():
+        IMAGE_POSTPROCESS_DURATION.labels(step=step).observe(duration)
+    return content, thumbnails
@@ -0,0 +1,393 @@
+# app/jobs.py
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field, asdict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import httpx
+from app.config import (
+    JOB_EXECUTION,
+    JOB_STORE_BACKEND,
+    JOB_STORE_PATH,
+    JOB_MAX_CONCURRENCY,
+    JOB_RETENTION,
+    JOB_CALLBACK_TIMEOUT,
+    JOB_CALLBACK_ATTEMPTS,
+    JOB_MAX_ATTEMPTS,
+)
+from app.metrics import JOB_QUEUE_DEPTH, JOB_AGE
+from app.models import callback_host_allowed, is_public_address
+from app.logging_utils import setup_logging
+
+logger = setup_logging("app.jobs")
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED_STATUSES = (SUCCEEDED, FAILED)
+
+@dataclass
+class Job:
+    job_id: str
+    input: Dict[str, Any]
+    callback_url: Optional[str] = None
+    status: str = QUEUED
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[Dict[str, Any]] = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    attempts: int = 0  # Times a queue worker has claimed the job
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Public representation returned by the status endpoint and callbacks."""
+        data = asdict(self)
+        data.pop("input")
+        data.pop("callback_url")
+        data.pop("attempts")
+        return data
+
+def job_error(e: BaseException) -> Dict[str, Any]:
+    """The `error` recorded for a job whose runner raised `e`."""
+    return {
+        "status_code": getattr(e, "status_code", 500),
+        "detail": getattr(e, "detail", str(e))
+    }
+
+class JobPersistence(ABC):
+    """Storage interface for job records; implementations must be thread-safe."""
+
+    @abstractmethod
+    def save(self, job: Job) -> None:
+        """Inserts or replaces a job record."""
+
+    @abstractmethod
+    def load(self, job_id: str) -> Optional[Job]:
+        """Returns the job with the given id, or None."""
+
+    @abstractmethod
+    def purge_finished(self, before: float) -> int:
+        """Deletes finished jobs last updated before `before`; returns how many."""
+
+    def close(self) -> None:
+        pass
+
+class InMemoryJobPersistence(JobPersistence):
+    """Keeps jobs in a dict; they are lost when the process exits."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def save(self, job: Job) -> None:
+        with self._lock:
+            self._jobs[job.job_id] = Job(**asdict(job))
+
+    def load(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return Job(**asdict(job)) if job else None
+
+    def purge_finished(self, before: float) -> int:
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.status in FINISHED_STATUSES and job.updated_at < before
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+            return len(expired)
+
+_JOB_COLUMNS = "job_id, status, input, callback_url, result, error, created_at, updated_at, attempts"
+
+class SQLiteJobPersistence(JobPersistence):
+    """
+    Stores jobs in a local SQLite database so their status survives restarts.
+
+    The database doubles as the durable queue of JOB_EXECUTION=queue: API
+    processes insert queued jobs and `python -m app.worker` processes claim
+    them with `claim()`, holding a lease they renew while the job runs.
+    """
+
+    def __init__(self, path: str = JOB_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        # API and worker processes share the file; wait for each other's short write transactions.
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                input TEXT NOT NULL,
+                callback_url TEXT,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL
+            )
+        """)
+        # Databases created before the queue columns existed.
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (("attempts", "INTEGER NOT NULL DEFAULT 0"), ("lease_owner", "TEXT"), ("lease_expires", "REAL")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_updated ON jobs (status, updated_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def _job(row) -> Job:
+        return Job(
+            job_id=row[0], status=row[1], input=json.loads(row[2]), callback_url=row[3],
+            result=json.loads(row[4]) if row[4] else None,
+            error=json.loads(row[5]) if row[5] else None,
+            created_at=row[6], updated_at=row[7], attempts=row[8]
+        )
+
+    def save(self, job: Job) -> None:
+        with self._lock:
+            self._conn.execute(f"""
+                INSERT OR REPLACE INTO jobs ({_JOB_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                job.job_id, job.status, json.dumps(job.input), job.callback_url,
+                json.dumps(job.result) if job.result is not None else None,
+                json.dumps(job.error) if job.error is not None else None,
+                job.created_at, job.updated_at, job.attempts
+            ))
+            self._conn.commit()
+
+    def load(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def purge_finished(self, before: float) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (*FINISHED_STATUSES, before)
+            )
+            self._conn.commit()
+            return cursor.rowcount
+
+    def claim(self, owner: str, lease: float, max_attempts: int = JOB_MAX_ATTEMPTS) -> Optional[Job]:
+        """
+        Takes the oldest queued job, or a running one whose lease has run out,
+        marks it running under `owner` for `lease` seconds and returns it;
+        None when nothing is waiting. Jobs already delivered `max_attempts`
+        times are failed instead of being handed out again.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("""
+                UPDATE jobs SET status = ?, error = ?, updated_at = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE status = ? AND lease_expires < ? AND attempts >= ?
+            """, (
+                FAILED, json.dumps({"status_code": 500, "detail": f"Job was abandoned by its worker {max_attempts} times"}),
+                now, RUNNING, now, max_attempts
+            ))
+            row = self._conn.execute(f"""
+                UPDATE jobs SET status = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ?
+                WHERE job_id = (
+                    SELECT job_id FROM jobs
+                    WHERE status = ? OR (status = ? AND lease_expires < ?)
+                    ORDER BY created_at LIMIT 1
+                )
+                RETURNING {_JOB_COLUMNS}
+            """, (RUNNING, owner, now + lease, now, QUEUED, RUNNING, now)).fetchone()
+            self._conn.commit()
+        return self._job(row) if row is not None else None
+
+    def renew(self, job_id: str, owner: str, lease: float) -> bool:
+        """Extends `owner`'s lease on a running job; False if the lease was lost."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND lease_owner = ? AND status = ?",
+                (time.time() + lease, job_id, owner, RUNNING)
+            )
+            self._conn.commit()
+            return cursor.rowcount == 1
+
+    def finish(self, job: Job, owner: str) -> bool:
+        """Records the final state of a claimed job; False (and nothing written) if `owner` lost the lease."""
+        with self._lock:
+            cursor = self._conn.execute("""
+                UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE job_id = ? AND lease_owner = ?
+            """, (
+                job.status,
+                json.dumps(job.result) if job.result is not None else None,
+                json.dumps(job.error) if job.error is not None else None,
+                job.updated_at, job.job_id, owner
+            ))
+            self._conn.commit()
+            return cursor.rowcount == 1
+
+    def release(self, job_id: str, owner: str) -> None:
+        """Puts a claimed job back in the queue without counting the attempt, e.g. when its worker shuts down."""
+        with self._lock:
+            self._conn.execute("""
+                UPDATE jobs SET status = ?, attempts = attempts - 1, updated_at = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE job_id = ? AND lease_owner = ?
+            """, (QUEUED, time.time(), job_id, owner))
+            self._conn.commit()
+
+    def queue_stats(self) -> Tuple[int, Optional[float]]:
+        """Returns how many jobs are queued and when the oldest of them was created."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM jobs WHERE status = ?", (QUEUED,)
+            ).fetchone()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+# Runs a job and returns its result; raising marks the job as failed.
+JobRunner = Callable[[Job], Awaitable[Dict[str, Any]]]
+
+class JobStore:
+    """
+    Runs submitted jobs in the background of the current process.
+
+    At most `max_concurrency` jobs execute at once; the rest wait as "queued".
+    Every state transition is written through the persistence backend, and the
+    job's callback URL (if any) is notified once it finishes. With `execute`
+    False, jobs are only recorded as queued, for `python -m app.worker`
+    processes to run.
+    """
+
+    def __init__(self, persistence: JobPersistence, max_concurrency: int = JOB_MAX_CONCURRENCY, retention: float = JOB_RETENTION, execute: bool = True):
+        self.persistence = persistence
+        self.retention = retention
+        self.execute = execute
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+
+    async def submit(self, input: Dict[str, Any], runner: JobRunner, callback_url: Optional[str] = None) -> Job:
+        job = Job(job_id=uuid.uuid4().hex, input=input, callback_url=callback_url)
+        await asyncio.to_thread(self.persistence.save, job)
+        await asyncio.to_thread(self.persistence.purge_finished, time.time() - self.retention)
+        if not self.execute:
+            return job
+        JOB_QUEUE_DEPTH.labels(status=QUEUED).inc()
+        task = asyncio.create_task(self._run(job, runner))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await asyncio.to_thread(self.persistence.load, job_id)
+
+    async def _run(self, job: Job, runner: JobRunner):
+        started = False
+        try:
+            async with self._semaphore:
+                started = True
+                JOB_QUEUE_DEPTH.labels(status=QUEUED).dec()
+                JOB_QUEUE_DEPTH.labels(status=RUNNING).inc()
+                try:
+                    await self._transition(job, RUNNING)
+                    result = await runner(job)
+                    await self._transition(job, SUCCEEDED, result=result)
+                except Exception as e:
+                    logger.error("Job %s failed: %s", job.job_id, e)
+                    await self._transition(job, FAILED, error=job_error(e))
+                finally:
+                    JOB_QUEUE_DEPTH.labels(status=RUNNING).dec()
+        finally:
+            if not started:
+                JOB_QUEUE_DEPTH.labels(status=QUEUED).dec()
+        JOB_AGE.labels(status=job.status).observe(job.updated_at - job.created_at)
+        if job.callback_url:
+            await notify_callback(job)
+
+    async def _transition(self, job: Job, status: str, **fields):
+        job.status = status
+        job.updated_at = time.time()
+        for name, value in fields.items():
+            setattr(job, name, value)
+        await asyncio.to_thread(self.persistence.save, job)
+
+    async def close(self, drain_timeout: float = 0):
+        """
+        Waits up to `drain_timeout` seconds for jobs still running in this
+        process, cancels the rest and closes the persistence backend.
+        """
+        if self._tasks and drain_timeout > 0:
+            logger.info(f"Waiting up to {drain_timeout} seconds for {len(self._tasks)} jobs to finish")
+            await asyncio.wait(list(self._tasks), timeout=drain_timeout)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.persistence.close()
+
+async def callback_target_is_public(url: str) -> bool:
+    """
+    True if the callback host is allow-listed or every address it resolves to
+    is public, so a name pointing at an internal service is refused even
+    though it passed input validation.
+    """
+    host = httpx.URL(url).host
+    if callback_host_allowed(host):
+        return True
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, None)
+    except OSError:
+        return False
+    return bool(addresses) and all(is_public_address(address[4][0]) for address in addresses)
+
+async def notify_callback(job: Job):
+    """POSTs the final job status to its callback URL, retrying with backoff."""
+    if not await callback_target_is_public(job.callback_url):
+        logger.error("Not calling back job %s: %s is not a public host", job.job_id, job.callback_url)
+        return
+    async with httpx.AsyncClient(timeout=JOB_CALLBACK_TIMEOUT) as client:
+        for attempt in range(1, JOB_CALLBACK_ATTEMPTS + 1):
+            try:
+                response = await client.post(job.callback_url, json=job.to_dict())
+                if response.is_success:
+                    logger.info(f"Notified callback for job {job.job_id}")
+                    return
+                logger.warning("Callback for job %s returned HTTP %s", job.job_id, response.status_code)
+            except httpx.HTTPError as e:
+                logger.warning("Callback for job %s failed: %s", job.job_id, e)
+            if attempt < JOB_CALLBACK_ATTEMPTS:
+                await asyncio.sleep(2 ** attempt)
+    logger.error("Giving up on callback for job %s after %s attempts", job.job_id, JOB_CALLBACK_ATTEMPTS)
+
+def create_job_persistence() -> JobPersistence:
+    """Builds the persistence backend selected by JOB_STORE_BACKEND."""
+    if JOB_STORE_BACKEND == "sqlite":
+        return SQLiteJobPersistence(JOB_STORE_PATH)
+    if JOB_STORE_BACKEND == "memory":
+        return InMemoryJobPersistence()
+    raise RuntimeError(f"Unknown JOB_STORE_BACKEND: {JOB_STORE_BACKEND}")
+
+_job_store: Optional[JobStore] = None
+
+def get_job_store() -> JobStore:
+    """Returns the process-wide job store, creating it on first use."""
+    global _job_store
+    if _job_store is None:
+        if JOB_EXECUTION not in ("inline", "queue"):
+            raise RuntimeError(f"Unknown JOB_EXECUTION: {JOB_EXECUTION}")
+        persistence = create_job_persistence()
+        if JOB_EXECUTION == "queue" and not isinstance(persistence, SQLiteJobPersistence):
+            raise RuntimeError("JOB_EXECUTION=queue needs JOB_STORE_BACKEND=sqlite")
+        _job_store = JobStore(persistence, execute=JOB_EXECUTION == "inline")
+    return _job_store
+
+async def close_job_store(drain_timeout: float = 0):
+    global _job_store
+    if _job_store is not None:
+        await _job_store.close(drain_timeout)
+        _job_store = None
@@ -1,45 +1,157 @@
 # app/logging_utils.py
 import os
+import asyncio
+import atexit
 import logging
 import json
+import queue
+import threading
 import time
 import uuid
-from datetime import datetime, timezone
+from collections import OrderedDict, deque
+from datetime import date, datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from pythonjsonlogger import jsonlogger
 import asyncpg
 from typing import Optional, Dict, Any
+from app.config import (
+    MONITORING_LOG_DSN,
+    MONITORING_LOG_BATCH_SIZE,
+    MONITORING_LOG_FLUSH_INTERVAL,
+    MONITORING_LOG_MAX_BUFFER,
+    MONITORING_LOG_MAX_WAIT,
+    MONITORING_LOG_USE_COPY,
+)
+from app.metrics import (
+    MONITORING_LOG_BATCH_ROWS,
+    MONITORING_LOG_FLUSH_DURATION,
+    MONITORING_LOG_DROPPED,
+    MONITORING_LOG_BUFFERED,
+)
+from app.tracing import current_ids
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 class DuplicateFilter(logging.Filter):
-    """Filter that eliminates duplicate log messages within a time window."""
+    """
+    Filter that eliminates duplicate log messages within a time window.
+
+    Messages are duplicates when they come from the same call site with the
+    same template (`record.msg` before %-style arguments are applied); text
+    already formatted into the message, as with f-strings, is part of the
+    template. Memory is bounded: at most `max_keys` recent templates are
+    remembered, each as a fixed-size hash, and entries whose window
+    has passed are evicted oldest first. When a message whose duplicates were
+    suppressed logs again, it carries a `suppressed` count; if it never
+    returns, a summary line is logged once its entry is evicted.
+    """
     
-    def __init__(self, timeout=5):
+    def __init__(self, timeout=5, max_keys=1024):
         super().__init__()
         self.timeout = timeout
-        self.last_log = {}
+        self.max_keys = max_keys
+        # key -> [first_logged_at, suppressed_count, record]; ordered oldest first.
+        # The record is kept only while duplicates are being suppressed.
+        self.last_log = OrderedDict()
+        self._lock = threading.Lock()
     
     def filter(self, record):
-        key = (record.module, record.funcName, record.getMessage(), record.levelno)
-        current_time = time.time()
-        if key in self.last_log and (current_time - self.last_log[key] < self.timeout):
-            return False
-        self.last_log[key] = current_time
-        return True
+        if getattr(record, "dedup_summary", False):
+            return True
+        # Keyed on the unformatted template, so messages differing only in their arguments (ids, URLs) collapse.
+        key = hash((record.name, record.funcName, record.lineno, record.levelno, str(record.msg)))
+        current_time = time.monotonic()
+        with self._lock:
+            entry = self.last_log.get(key)
+            if entry is not None and current_time - entry[0] < self.timeout:
+                entry[1] += 1
+                entry[2] = entry[2] or record
+                passed = False
+            else:
+                if entry is not None:
+                    del self.last_log[key]
+                    if entry[1]:
+                        record.suppressed = entry[1]
+                passed = True
+            finished = self._evict(current_time)
+            if passed:
+                self.last_log[key] = [current_time, 0, None]
+        for suppressed, previous in finished:
+            _report_suppressed(previous, suppressed)
+        return passed
+
+    def _evict(self, current_time):
+        """Drops expired entries and any beyond `max_keys`; returns the (count, record) bursts that ended."""
+        finished = []
+        while self.last_log:
+            key, entry = next(iter(self.last_log.items()))
+            if current_time - entry[0] < self.timeout and len(self.last_log) < self.max_keys:
+                break
+            del self.last_log[key]
+            if entry[1]:
+                finished.append((entry[1], entry[2]))
+        return finished
+
+def _report_suppressed(record, suppressed):
+    logger = logging.getLogger(record.name)
+    logger.log(
+        record.levelno,
+        f"Suppressed {suppressed} messages like: {record.getMessage()}",
+        extra={"dedup_summary": True, "suppressed": suppressed}
+    )
+
+class Lazy:
+    """
+    Wraps a callable whose result is only computed when the log line is written,
+    e.g. `extra={"input": Lazy(input.model_dump, mode="json")}`. Nothing is
+    computed when the level is disabled, and otherwise the work happens on the
+    log listener thread rather than the event loop.
+    """
+    __slots__ = ("func", "args", "kwargs")
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+def _json_default(obj):
+    if isinstance(obj, Lazy):
+        return obj()
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    return str(obj)
+
+def _json_dumps(obj, default=None, **kwargs):
+    """Serializes a log record with orjson when it is installed, else the C-accelerated stdlib encoder."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, default=default)
 
 class CustomJsonFormatter(jsonlogger.JsonFormatter):
     """Custom JSON formatter with additional fields"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("json_default", _json_default)
+        kwargs.setdefault("json_serializer", _json_dumps)
+        super().__init__(*args, **kwargs)
     
     def add_fields(self, log_record, record, message_dict):
         super(CustomJsonFormatter, self).add_fields(log_record, record, message_dict)
         
-        # Add timestamp
-        log_record['timestamp'] = datetime.now(timezone.utc).isoformat()
+        # Add timestamp of when the record was created, not when it was written
+        log_record['timestamp'] = datetime.fromtimestamp(record.created, timezone.utc).isoformat()
         
-        # Add correlation ID if not present
-        if not log_record.get('correlation_id'):
-            log_record['correlation_id'] = str(uuid.uuid4())
+        # Correlation ID is null unless the caller or the current trace provided one
+        log_record.setdefault('correlation_id', None)
         
         # Add worker ID
-        log_record['worker_id'] = os.getpid()
+        log_record['worker_id'] = record.process
         
         # Add log level
         log_record['level'] = record.levelname
@@ -53,41 +165,109 @@ class CustomJsonFormatter(jsonlogger.JsonFormatter):
                 if isinstance(value, (str, int, float, bool)) or value is None:
                     log_record[key] = value
 
+class TraceContextFilter(logging.Filter):
+    """Stamps records with the ids of the trace they were logged in; explicit extras win."""
+
+    def filter(self, record):
+        # Runs on the calling thread, where the request's context variables are visible.
+        for key, value in current_ids().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+_trace_context_filter = TraceContextFilter()
+
+class _EnqueueHandler(QueueHandler):
+    """Hands records to the listener thread untouched; formatting happens there."""
+
+    def prepare(self, record):
+        # The queue never leaves this process, so unlike the stdlib default
+        # nothing has to be formatted or made picklable on the calling thread.
+        return record
+
+def _create_output_handler() -> logging.Handler:
+    handler = logging.StreamHandler()
+    handler.setFormatter(CustomJsonFormatter('%(timestamp)s %(level)s %(name)s %(message)s'))
+    
+    # Add duplicate filter
+    dedup_timeout = int(os.getenv("LOG_DEDUP_TIMEOUT", "5"))
+    dedup_max_keys = int(os.getenv("LOG_DEDUP_MAX_KEYS", "1024"))
+    handler.addFilter(DuplicateFilter(timeout=dedup_timeout, max_keys=dedup_max_keys))
+    return handler
+
+_log_queue = queue.SimpleQueue()
+_output_handler: Optional[logging.Handler] = None
+_listener: Optional[QueueListener] = None
+_listener_lock = threading.Lock()
+
+def start_log_listener():
+    """Starts the background thread that formats and writes queued log records."""
+    global _output_handler, _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+        if _output_handler is None:
+            _output_handler = _create_output_handler()
+        _listener = QueueListener(_log_queue, _output_handler, respect_handler_level=True)
+        _listener.start()
+
+def stop_log_listener():
+    """Writes out every queued record and stops the listener thread."""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        _listener = None
+
+def _restart_log_listener_after_fork():
+    # Threads do not survive fork; give the child its own listener.
+    global _listener
+    _listener = None
+    start_log_listener()
+
+atexit.register(stop_log_listener)
+os.register_at_fork(after_in_child=_restart_log_listener_after_fork)
+
 def setup_logging(name: str):
     """
     Set up a logger with structured JSON formatting and duplicate log filtering.
     
+    Records are put on a queue and formatted and written by a background
+    listener thread, so logging from the event loop does not block on I/O.
+    
     Environment variables:
       - LOG_LEVEL: Logging level (default: INFO)
       - LOG_DEDUP_TIMEOUT: Time in seconds to deduplicate duplicate log messages (default: 5)
+      - LOG_DEDUP_MAX_KEYS: Number of recent messages remembered for deduplication (default: 1024)
+      - LOG_QUEUE: Set to "false" to write logs synchronously from the calling thread (default: true)
     """
     log_level = os.getenv("LOG_LEVEL", "INFO")
     logger = logging.getLogger(name)
     logger.handlers.clear()
     logger.setLevel(getattr(logging, log_level))
     
-    # Create console handler with JSON formatting
-    handler = logging.StreamHandler()
-    formatter = CustomJsonFormatter(
-        '%(timestamp)s %(level)s %(name)s %(message)s',
-        timestamp=True
-    )
-    handler.setFormatter(formatter)
-    
-    # Add duplicate filter
-    dedup_timeout = int(os.getenv("LOG_DEDUP_TIMEOUT", "5"))
-    handler.addFilter(DuplicateFilter(timeout=dedup_timeout))
+    if os.getenv("LOG_QUEUE", "true").lower() == "true":
+        start_log_listener()
+        handler = _EnqueueHandler(_log_queue)
+    else:
+        handler = _create_output_handler()
     
     logger.addHandler(handler)
+    logger.addFilter(_trace_context_filter)
     logger.propagate = False
     return logger
 
 def get_correlation_id():
     """Get or create a correlation ID for request tracing"""
-    return str(uuid.uuid4())
+    return current_ids().get("correlation_id") or str(uuid.uuid4())
 
-async def log_to_database(
-    pool: asyncpg.Pool,
+MONITORING_LOG_COLUMNS = (
+    "user_id", "vendor_id", "endpoint", "request_id", "correlation_id",
+    "level", "message", "latency_ms", "status_code", "s3_url", "extra_data"
+)
+
+def monitoring_log_row(
     user_id: Optional[str] = None,
     vendor_id: Optional[str] = None,
     endpoint: str = "unknown",
@@ -99,20 +279,196 @@ async def log_to_database(
     status_code: int = 200,
     s3_url: Optional[str] = None,
     extra_data: Optional[Dict[str, Any]] = None
-) -> None:
-    """Write log entry to the MonitoringLog table"""
+) -> tuple:
+    """Builds a MonitoringLog row with values in MONITORING_LOG_COLUMNS order."""
     if request_id is None:
         request_id = str(uuid.uuid4())
     
     if correlation_id is None:
         correlation_id = get_correlation_id()
     
+    return (
+        user_id, vendor_id, endpoint, request_id, correlation_id,
+        level, message, latency_ms, status_code, s3_url,
+        json.dumps(extra_data) if extra_data else None
+    )
+
+async def log_to_database(
+    pool: asyncpg.Pool,
+    user_id: Optional[str] = None,
+    vendor_id: Optional[str] = None,
+    endpoint: str = "unknown",
+    request_id: str = None,
+    correlation_id: Optional[str] = None,
+    level: str = "INFO",
+    message: str = "",
+    latency_ms: int = 0,
+    status_code: int = 200,
+    s3_url: Optional[str] = None,
+    extra_data: Optional[Dict[str, Any]] = None
+) -> None:
+    """Write a single log entry to the MonitoringLog table (see MonitoringLogWriter for bulk writes)"""
+    row = monitoring_log_row(
+        user_id, vendor_id, endpoint, request_id, correlation_id,
+        level, message, latency_ms, status_code, s3_url, extra_data
+    )
     async with pool.acquire() as conn:
         await conn.execute("""
             INSERT INTO MonitoringLog (
                 user_id, vendor_id, endpoint, request_id, correlation_id,
                 level, message, latency_ms, status_code, s3_url, extra_data
             ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
-        """, user_id, vendor_id, endpoint, request_id, correlation_id,
-            level, message, latency_ms, status_code, s3_url, 
-            json.dumps(extra_data) if extra_data else None)
+        """, *row)
+
+class MonitoringLogWriter:
+    """
+    Buffers MonitoringLog rows in memory and writes them in bulk.
+
+    A background task writes up to `batch_size` rows per round trip, as soon as
+    a full batch is waiting or every `flush_interval` seconds, with COPY (or
+    executemany when `use_copy` is off). At most `max_buffer` rows are held:
+    when the database lags, `log()` waits up to `max_wait` seconds for room and
+    then drops the row, and a failed batch is put back only as far as it fits.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        batch_size: int = MONITORING_LOG_BATCH_SIZE,
+        flush_interval: float = MONITORING_LOG_FLUSH_INTERVAL,
+        max_buffer: int = MONITORING_LOG_MAX_BUFFER,
+        max_wait: float = MONITORING_LOG_MAX_WAIT,
+        use_copy: bool = MONITORING_LOG_USE_COPY,
+    ):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_wait = max_wait
+        self.use_copy = use_copy
+        self._rows = deque()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def log(self, **fields) -> bool:
+        """Queues one row (same fields as log_to_database); returns False if it was dropped."""
+        row = monitoring_log_row(**fields)
+        if len(self._rows) >= self.max_buffer and self.max_wait > 0:
+            try:
+                await asyncio.wait_for(self._wait_for_space(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+        if len(self._rows) >= self.max_buffer:
+            MONITORING_LOG_DROPPED.labels(reason="buffer_full").inc()
+            return False
+        self._rows.append(row)
+        MONITORING_LOG_BUFFERED.set(len(self._rows))
+        if len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def _wait_for_space(self):
+        while len(self._rows) >= self.max_buffer:
+            self._space.clear()
+            await self._space.wait()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Full batches go out immediately; a partial one waits for the interval.
+            flush_all = loop.time() >= deadline
+            if flush_all:
+                deadline = loop.time() + self.flush_interval
+            while self._rows and not self._closing and (flush_all or len(self._rows) >= self.batch_size):
+                if not await self._flush_batch():
+                    # Give the database a moment before retrying.
+                    await asyncio.sleep(self.flush_interval)
+                    break
+
+    async def _flush_batch(self) -> bool:
+        batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+        start = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                if self.use_copy:
+                    await conn.copy_records_to_table("monitoringlog", records=batch, columns=MONITORING_LOG_COLUMNS)
+                else:
+                    await conn.executemany(f"""
+                        INSERT INTO MonitoringLog ({", ".join(MONITORING_LOG_COLUMNS)})
+                        VALUES ({", ".join(f"${i}" for i in range(1, len(MONITORING_LOG_COLUMNS) + 1))})
+                    """, batch)
+        except Exception as e:
+            MONITORING_LOG_FLUSH_DURATION.labels(result="error").observe(time.perf_counter() - start)
+            room = max(0, self.max_buffer - len(self._rows))
+            self._rows.extendleft(reversed(batch[:room]))
+            if len(batch) > room:
+                MONITORING_LOG_DROPPED.labels(reason="flush_failed").inc(len(batch) - room)
+            logger.error(f"Failed to write {len(batch)} MonitoringLog rows: {str(e)}")
+            return False
+        finally:
+            MONITORING_LOG_BUFFERED.set(len(self._rows))
+            self._space.set()
+        MONITORING_LOG_FLUSH_DURATION.labels(result="success").observe(time.perf_counter() - start)
+        MONITORING_LOG_BATCH_ROWS.observe(len(batch))
+        return True
+
+    async def close(self, timeout: float = 10):
+        """Stops the background task and writes out the remaining rows, dropping what cannot be written in time."""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+        try:
+            async with asyncio.timeout(timeout):
+                while self._rows:
+                    if not await self._flush_batch():
+                        break
+        except TimeoutError:
+            pass
+        if self._rows:
+            MONITORING_LOG_DROPPED.labels(reason="shutdown").inc(len(self._rows))
+            logger.error(f"Dropped {len(self._rows)} MonitoringLog rows at shutdown")
+            self._rows.clear()
+            MONITORING_LOG_BUFFERED.set(0)
+
+_monitoring_log_pool: Optional[asyncpg.Pool] = None
+_monitoring_log_writer: Optional[MonitoringLogWriter] = None
+
+async def open_monitoring_log_writer() -> Optional[MonitoringLogWriter]:
+    """Connects the MonitoringLog sink when MONITORING_LOG_DSN is set."""
+    global _monitoring_log_pool, _monitoring_log_writer
+    if not MONITORING_LOG_DSN or _monitoring_log_writer is not None:
+        return _monitoring_log_writer
+    _monitoring_log_pool = await asyncpg.create_pool(MONITORING_LOG_DSN, min_size=1, max_size=2)
+    _monitoring_log_writer = MonitoringLogWriter(_monitoring_log_pool)
+    _monitoring_log_writer.start()
+    return _monitoring_log_writer
+
+def get_monitoring_log_writer() -> Optional[MonitoringLogWriter]:
+    """Returns the MonitoringLog sink, or None when it is not configured."""
+    return _monitoring_log_writer
+
+async def close_monitoring_log_writer():
+    """Flushes buffered rows and closes the sink's connection pool."""
+    global _monitoring_log_pool, _monitoring_log_writer
+    if _monitoring_log_writer is not None:
+        await _monitoring_log_writer.close()
+        _monitoring_log_writer = None
+    if _monitoring_log_pool is not None:
+        await _monitoring_log_pool.close()
+        _monitoring_log_pool = None
+
+logger = setup_logging("app.logging_utils")
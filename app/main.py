@@ -1,34 +1,95 @@
-from fastapi import FastAPI
+import time
+_import_started = time.perf_counter()
+
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response
 from app.api import router
-from app.metrics import setup_metrics
-from app.logging_utils import setup_logging
-from prometheus_fastapi_instrumentator import Instrumentator
+from app.config import SERVER_DRAIN_TIMEOUT, validate_config
+from app.metrics import setup_metrics, mark_process_dead, APP_STARTUP_DURATION
+from app.logging_utils import setup_logging, open_monitoring_log_writer, close_monitoring_log_writer
+from app.imaging import shutdown_image_executor, warm_up_image_executor
+from app.jobs import close_job_store
+from app.pools import install_default_executor
+from app.profiling import admin_router, start_event_loop_monitor, stop_event_loop_monitor
+from app.stability import close_stability_client, get_stability_client
+from app.storage import get_storage
+from app.tracing import TracingMiddleware
 
 logger = setup_logging("app.main")
 
+async def warm_up_clients():
+    """Opens outbound connections and starts image workers concurrently so the first requests do not pay for them."""
+    await asyncio.gather(
+        asyncio.to_thread(get_storage().warm_up),
+        get_stability_client().warm_up(),
+        asyncio.to_thread(warm_up_image_executor),
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup_started = time.perf_counter()
+    validate_config()
+    install_default_executor()
+    await warm_up_clients()
+    await open_monitoring_log_writer()
+    await start_event_loop_monitor()
+    app.state.ready = True
+    startup_duration = time.perf_counter() - startup_started
+    APP_STARTUP_DURATION.labels(phase="import").set(import_duration)
+    APP_STARTUP_DURATION.labels(phase="startup").set(startup_duration)
+    logger.info(
+        f"Worker ready in {import_duration + startup_duration:.2f} seconds "
+        f"(import {import_duration:.2f}s, warm-up {startup_duration:.2f}s)"
+    )
+    yield
+    app.state.ready = False
+    # The server has stopped accepting requests and drained open ones; give running jobs the same grace period.
+    await close_job_store(drain_timeout=SERVER_DRAIN_TIMEOUT)
+    # Release pooled connections held by shared outbound clients.
+    await close_stability_client()
+    await asyncio.to_thread(shutdown_image_executor)
+    await stop_event_loop_monitor()
+    # Write out buffered MonitoringLog rows last so the shutdown above is recorded too.
+    await close_monitoring_log_writer()
+    mark_process_dead()
+
 app = FastAPI(
     title="Image Transformation API",
     description="API for transforming images using Stability AI",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
+app.state.ready = False
 
-# Setup metrics
+# Setup metrics (HTTP instrumentation and the /metrics endpoint)
 setup_metrics(app)
 
-# Minimal Instrumentator setup
-instrumentator = Instrumentator()
-instrumentator.instrument(app).expose(app)
+# Outermost, so the trace and Server-Timing cover the whole request
+app.add_middleware(TracingMiddleware)
 
 # Add health check endpoint
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+# Readiness: only once startup warm-ups are done, and no longer while shutting down
+@app.get("/ready")
+async def readiness_check(response: Response):
+    if not app.state.ready:
+        response.status_code = 503
+        return {"status": "starting"}
+    return {"status": "ready"}
+
 # Include API router
 app.include_router(router, prefix="/api/v1")
 
+# Profiling and event loop diagnostics, only with ADMIN_TOKEN
+app.include_router(admin_router, prefix="/admin")
+
+import_duration = time.perf_counter() - _import_started
 logger.info("Application started")
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    from app.server import main
+    main()
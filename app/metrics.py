@@ -1,6 +1,17 @@
-from prometheus_client import Counter, Histogram, Gauge
+import os
+import threading
+from collections import OrderedDict
+from prometheus_client import Counter, Histogram, Gauge, multiprocess
 from prometheus_fastapi_instrumentator import Instrumentator, metrics
-from prometheus_fastapi_instrumentator.metrics import Info
+from app.config import (
+    METRICS_ENABLED,
+    METRICS_MAX_VENDORS,
+    METRICS_VENDOR_MIN_REQUESTS,
+    METRICS_VENDORS,
+    VENDOR_WEIGHTS,
+)
+
+# Gauges are summed over live worker processes in multiprocess mode (PROMETHEUS_MULTIPROC_DIR).
 
 # Custom metrics
 IMAGE_PROCESSING_DURATION = Histogram(
@@ -9,6 +20,11 @@ IMAGE_PROCESSING_DURATION = Histogram(
     ["operation_type"]
 )
 
+INPUT_FETCH_DURATION = Histogram(
+    "input_fetch_duration_seconds",
+    "Time spent fetching all input images for a request"
+)
+
 IMAGE_SIZE = Histogram(
     "image_size_bytes",
     "Size of processed images",
@@ -24,7 +40,8 @@ S3_OPERATION_DURATION = Histogram(
 STABILITY_API_DURATION = Histogram(
     "stability_api_duration_seconds",
     "Time spent on Stability API calls",
-    ["operation_type"]
+    ["operation_type"],
+    buckets=(0.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)
 )
 
 VENDOR_REQUESTS = Counter(
@@ -39,24 +56,352 @@ ERROR_COUNTER = Counter(
     ["error_type", "vendor_id"]
 )
 
+STABILITY_POLL_COUNT = Histogram(
+    "stability_poll_count",
+    "Number of result polls per Stability generation",
+    ["operation_type"],
+    buckets=(1, 2, 3, 4, 5, 7, 10, 15, 20, 30, 50)
+)
+
+STABILITY_POLL_WASTED_WAIT = Histogram(
+    "stability_poll_wasted_wait_seconds",
+    "Upper bound on time a finished generation waited before being polled",
+    ["operation_type"]
+)
+
+IMAGE_CACHE_HITS = Counter(
+    "image_cache_hits_total",
+    "Input image cache hits",
+    ["tier"]
+)
+
+IMAGE_CACHE_MISSES = Counter(
+    "image_cache_misses_total",
+    "Input image cache misses (object fetched from S3)"
+)
+
+IMAGE_CACHE_EVICTIONS = Counter(
+    "image_cache_evictions_total",
+    "Input image cache evictions",
+    ["tier"]
+)
+
+IMAGE_CACHE_BYTES = Gauge(
+    "image_cache_bytes",
+    "Bytes currently held by the input image cache",
+    ["tier"],
+    multiprocess_mode="livesum"
+)
+
+RESULT_CACHE_REQUESTS = Counter(
+    "result_cache_requests_total",
+    "Result cache lookups for deterministic requests",
+    ["result"]
+)
+
+JOB_QUEUE_DEPTH = Gauge(
+    "job_queue_depth",
+    "Asynchronous jobs that have not finished yet",
+    ["status"],
+    multiprocess_mode="livesum"
+)
+
+JOB_AGE = Histogram(
+    "job_age_seconds",
+    "Time from job submission until it finished",
+    ["status"],
+    buckets=(1, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+)
+
+JOB_QUEUE_LAG = Histogram(
+    "job_queue_lag_seconds",
+    "Time queued jobs waited before a worker claimed them",
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+)
+
+JOB_QUEUE_BACKLOG = Gauge(
+    "job_queue_backlog",
+    "Jobs waiting in the durable queue, as last seen by a worker",
+    multiprocess_mode="livemax"
+)
+
+JOB_QUEUE_OLDEST_AGE = Gauge(
+    "job_queue_oldest_age_seconds",
+    "Age of the oldest job waiting in the durable queue, as last seen by a worker",
+    multiprocess_mode="livemax"
+)
+
+JOB_REDELIVERIES = Counter(
+    "job_redeliveries_total",
+    "Queued jobs claimed again after the worker running them stopped renewing its lease"
+)
+
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    "scheduler_queue_depth",
+    "Generations waiting for an outbound slot per vendor",
+    ["vendor_id"],
+    multiprocess_mode="livesum"
+)
+
+SCHEDULER_WAIT = Histogram(
+    "scheduler_wait_seconds",
+    "Time generations waited for an outbound slot",
+    ["vendor_id"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+
+SCHEDULER_IN_FLIGHT = Gauge(
+    "scheduler_in_flight",
+    "Generations currently holding an outbound slot",
+    multiprocess_mode="livesum"
+)
+
+SCHEDULER_REJECTIONS = Counter(
+    "scheduler_rejections_total",
+    "Requests rejected by admission control",
+    ["vendor_id", "reason"]
+)
+
+MONITORING_LOG_BATCH_ROWS = Histogram(
+    "monitoring_log_batch_rows",
+    "Rows written per MonitoringLog flush",
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+)
+
+MONITORING_LOG_FLUSH_DURATION = Histogram(
+    "monitoring_log_flush_duration_seconds",
+    "Time spent writing one batch of MonitoringLog rows",
+    ["result"]
+)
+
+MONITORING_LOG_DROPPED = Counter(
+    "monitoring_log_dropped_rows_total",
+    "MonitoringLog rows dropped instead of written",
+    ["reason"]
+)
+
+MONITORING_LOG_BUFFERED = Gauge(
+    "monitoring_log_buffered_rows",
+    "MonitoringLog rows waiting to be written",
+    multiprocess_mode="livesum"
+)
+
+IMAGE_PREPROCESS_DURATION = Histogram(
+    "image_preprocess_duration_seconds",
+    "Time spent in each input image preprocessing step",
+    ["step"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+IMAGE_PREPROCESS_RESULTS = Counter(
+    "image_preprocess_results_total",
+    "Input images by preprocessing outcome",
+    ["operation_type", "result"]
+)
+
+IMAGE_POSTPROCESS_DURATION = Histogram(
+    "image_postprocess_duration_seconds",
+    "Time spent in each output image post-processing step",
+    ["step"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+CIRCUIT_BREAKER_STATE = Gauge(
+    "circuit_breaker_state",
+    "Circuit breaker state per outbound endpoint (0 closed, 1 half-open, 2 open)",
+    ["endpoint"],
+    multiprocess_mode="livemax"
+)
+
+CIRCUIT_BREAKER_TRANSITIONS = Counter(
+    "circuit_breaker_transitions_total",
+    "Circuit breaker state changes",
+    ["endpoint", "state"]
+)
+
+CIRCUIT_BREAKER_REJECTIONS = Counter(
+    "circuit_breaker_rejections_total",
+    "Outbound calls failed fast because the breaker was open",
+    ["endpoint"]
+)
+
+OUTBOUND_RETRIES = Counter(
+    "outbound_retries_total",
+    "Retries of idempotent outbound calls",
+    ["endpoint", "result"]
+)
+
+S3_HEDGED_READS = Counter(
+    "s3_hedged_reads_total",
+    "S3 reads that sent a duplicate request after the hedge delay",
+    ["result"]
+)
+
+ABANDONED_WORK = Counter(
+    "abandoned_work_total",
+    "Request work stopped or skipped because its deadline passed or its client disconnected",
+    ["stage", "reason"]
+)
+
+EXECUTOR_WORKERS = Gauge(
+    "executor_workers",
+    "Worker threads or processes of each executor",
+    ["executor"],
+    multiprocess_mode="livesum"
+)
+
+EXECUTOR_BUSY = Gauge(
+    "executor_busy_workers",
+    "Executor workers currently running a task",
+    ["executor"],
+    multiprocess_mode="livesum"
+)
+
+EXECUTOR_QUEUED = Gauge(
+    "executor_queued_tasks",
+    "Tasks submitted to an executor that wait for a free worker",
+    ["executor"],
+    multiprocess_mode="livesum"
+)
+
+CONNECTION_POOL_SIZE = Gauge(
+    "connection_pool_size",
+    "Connections outbound clients may open per pool",
+    ["pool"],
+    multiprocess_mode="livesum"
+)
+
+CONNECTION_POOL_IN_USE = Gauge(
+    "connection_pool_in_use",
+    "Outbound requests currently holding a pooled connection (or HTTP/2 stream)",
+    ["pool"],
+    multiprocess_mode="livesum"
+)
+
+STABILITY_POLLS_IN_FLIGHT = Gauge(
+    "stability_polls_in_flight",
+    "Generations whose results are currently being polled",
+    multiprocess_mode="livesum"
+)
+
+THREAD_QUEUE_WAIT = Histogram(
+    "to_thread_queue_wait_seconds",
+    "Time calls handed to asyncio.to_thread waited for a free thread",
+    ["call"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds",
+    "How late the last event loop probe woke up",
+    multiprocess_mode="livemax"
+)
+
+EVENT_LOOP_STALLS = Counter(
+    "event_loop_slow_callbacks_total",
+    "Event loop stalls longer than SLOW_CALLBACK_SECONDS (a callback kept the loop busy)"
+)
+
+APP_STARTUP_DURATION = Gauge(
+    "app_startup_duration_seconds",
+    "Time this worker took to import the app and to run startup (warm-ups) before serving",
+    ["phase"],
+    multiprocess_mode="livemax"
+)
+
+# Per-handler latency buckets; the latency SLO threshold in prometheus/rules must be one of them.
+HTTP_LATENCY_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+OTHER_VENDOR = "other"
+
+class VendorLabels:
+    """
+    Bounds the number of distinct `vendor_id` label values.
+
+    Vendors in `allowlist` always get their own label. Any other vendor gets
+    one once it has made `min_requests` requests, until `max_vendors` labels
+    are in use; everything else is reported as "other". Request counts are
+    kept for at most `max_candidates` unlabelled vendors (the least recently
+    seen are forgotten), so arbitrary usernames cannot grow memory or series
+    without bound. Labels are never taken back, so series stay continuous.
+    """
+
+    def __init__(self, max_vendors: int, min_requests: int, allowlist=(), max_candidates: int = 1000):
+        self.max_vendors = max_vendors
+        self.min_requests = min_requests
+        self.max_candidates = max_candidates
+        self._labelled = set(allowlist)
+        self._candidates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, vendor_id: str):
+        """Counts one request from the vendor, granting it a label once it qualifies."""
+        if vendor_id in self._labelled or len(self._labelled) >= self.max_vendors:
+            return
+        with self._lock:
+            count = self._candidates.pop(vendor_id, 0) + 1
+            if count >= self.min_requests and len(self._labelled) < self.max_vendors:
+                self._labelled.add(vendor_id)
+                return
+            self._candidates[vendor_id] = count
+            if len(self._candidates) > self.max_candidates:
+                self._candidates.popitem(last=False)
+
+    def label(self, vendor_id: str) -> str:
+        return vendor_id if vendor_id in self._labelled else OTHER_VENDOR
+
+vendor_labels = VendorLabels(
+    METRICS_MAX_VENDORS,
+    METRICS_VENDOR_MIN_REQUESTS,
+    allowlist=[v.strip() for v in METRICS_VENDORS.split(",") if v.strip()]
+    + [item.rpartition(":")[0].strip() for item in VENDOR_WEIGHTS.split(",") if item.strip()],
+)
+
+_children = {}
+
+def labelled(metric, **labels):
+    """
+    Returns the metric's child for these labels, like `metric.labels(...)`.
+
+    Children are cached, so hot paths skip label validation and the metric's
+    lock, and `vendor_id` values are bounded through `vendor_labels`.
+    """
+    if "vendor_id" in labels:
+        labels["vendor_id"] = vendor_labels.label(labels["vendor_id"])
+    key = (metric, *labels.items())
+    child = _children.get(key)
+    if child is None:
+        child = _children.setdefault(key, metric.labels(**labels))
+    return child
+
+def count_vendor_request(vendor_id: str, operation_type: str):
+    """Records a request from a vendor in VENDOR_REQUESTS."""
+    vendor_labels.record(vendor_id)
+    labelled(VENDOR_REQUESTS, vendor_id=vendor_id, operation_type=operation_type).inc()
+
+def mark_process_dead():
+    """Drops this worker's live gauges in multiprocess mode; call when the worker exits."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
 def setup_metrics(app):
     """Setup Prometheus metrics for the application"""
+    if not METRICS_ENABLED:
+        return
     
-    # Initialize the instrumentator
+    # Initialize the instrumentator; in multiprocess mode /metrics aggregates all workers
     instrumentator = Instrumentator(
         should_group_status_codes=False,
         should_ignore_untemplated=True,
-        should_respect_env_var=True,
         should_instrument_requests_inprogress=True,
         excluded_handlers=["/metrics"],
-        env_var_name="ENABLE_METRICS",
         inprogress_name="fastapi_inprogress",
         inprogress_labels=True,
     )
 
     # Add default metrics
-    instrumentator.add(metrics.default())
+    instrumentator.add(metrics.default(latency_lowr_buckets=HTTP_LATENCY_BUCKETS))
 
     # Instrument the app and expose metrics
     instrumentator.instrument(app)
-    instrumentator.expose(app, include_in_schema=True, should_gzip=True) 
\ No newline at end of file
+    instrumentator.expose(app, include_in_schema=True, should_gzip=True)
@@ -1,5 +1,33 @@
-from pydantic import BaseModel, HttpUrl, Field
+import ipaddress
+from pydantic import BaseModel, HttpUrl, Field, field_validator
 from typing import Optional, Literal
+from app.config import JOB_CALLBACK_ALLOWED_HOSTS
+
+def is_public_address(address: str) -> bool:
+    """True for globally routable IP addresses; False for loopback, private, link-local and the like."""
+    try:
+        ip = ipaddress.ip_address(address.strip("[]"))
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+def is_internal_host(host: str) -> bool:
+    """True for IP addresses that are not public and for names that only resolve inside a network."""
+    host = host.strip("[]").rstrip(".").lower()
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        # Single-label names such as "metadata" or "redis" come from local search domains.
+        return "." not in host or host == "localhost" or host.endswith(".localhost")
+    return not is_public_address(host)
+
+def callback_host_allowed(host: str) -> bool:
+    """True if JOB_CALLBACK_ALLOWED_HOSTS lists `host` or a parent domain of it."""
+    host = host.rstrip(".").lower()
+    allowed = {h.strip().lower() for h in JOB_CALLBACK_ALLOWED_HOSTS.split(",") if h.strip()}
+    return any(host == h or host.endswith(f".{h}") for h in allowed)
 
 class ReplaceBackgroundRelightInput(BaseModel):
     # Now expecting URLs instead of arbitrary strings
@@ -20,3 +48,26 @@ class ReplaceBackgroundRelightInput(BaseModel):
     seed: int = 0
     output_format: Literal["webp", "jpeg", "png"] = "png"
     username: Optional[str] = None
+
+class ReplaceBackgroundRelightJobInput(ReplaceBackgroundRelightInput):
+    # Notified with the final job status when the job finishes
+    callback_url: Optional[HttpUrl] = None
+
+    @field_validator("callback_url")
+    @classmethod
+    def callback_url_is_external(cls, url: Optional[HttpUrl]) -> Optional[HttpUrl]:
+        # The service POSTs to this URL from inside the network; keep it off internal hosts.
+        if url is None:
+            return url
+        if url.scheme != "https":
+            raise ValueError("callback_url must be an https URL")
+        if JOB_CALLBACK_ALLOWED_HOSTS:
+            if not callback_host_allowed(url.host):
+                raise ValueError("callback_url host is not allowed")
+        elif is_internal_host(url.host):
+            raise ValueError("callback_url must point at a public host")
+        return url
+
+class UploadRequest(BaseModel):
+    content_type: Literal["image/png", "image/jpeg", "image/webp"] = "image/png"
+    username: Optional[str] = None
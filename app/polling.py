@@ -0,0 +1,87 @@
+# app/polling.py
+import random
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from app.config import POLL_INITIAL_DELAY, POLL_MAX_DELAY, POLL_BACKOFF_MULTIPLIER, POLL_JITTER
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parses a Retry-After header value (delta-seconds or HTTP date) into seconds.
+    Returns None when the header is missing or malformed.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class PollScheduler:
+    """
+    Decides how long to wait between result polls.
+
+    The first poll is scheduled close to the expected completion time learned
+    from previous generations with the same key (an exponentially weighted
+    moving average). After that, delays start short and back off exponentially
+    with jitter, capped at `max_delay`. A server Retry-After hint always wins.
+    """
+
+    def __init__(
+        self,
+        initial_delay: float = POLL_INITIAL_DELAY,
+        max_delay: float = POLL_MAX_DELAY,
+        multiplier: float = POLL_BACKOFF_MULTIPLIER,
+        jitter: float = POLL_JITTER,
+        smoothing: float = 0.3,
+        early_margin: float = 0.1,
+        max_keys: int = 256,
+        rng: Optional[random.Random] = None,
+    ):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.smoothing = smoothing
+        self.early_margin = early_margin
+        self.max_keys = max_keys
+        self._rng = rng or random.Random()
+        self._expected = OrderedDict()
+
+    def _jittered(self, delay: float) -> float:
+        if self.jitter <= 0:
+            return delay
+        return max(0.0, delay * (1 + self._rng.uniform(-self.jitter, self.jitter)))
+
+    def expected_duration(self, key: str) -> Optional[float]:
+        """Returns the learned completion time for a key, if any."""
+        return self._expected.get(key)
+
+    def first_delay(self, key: str) -> float:
+        """Delay before the first poll, aimed just ahead of the expected finish."""
+        expected = self._expected.get(key)
+        if expected is None:
+            return self._jittered(self.initial_delay)
+        return max(self.initial_delay, expected * (1 - self.early_margin))
+
+    def next_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Delay after the `attempt`-th in-progress poll (1-based)."""
+        if retry_after is not None:
+            return retry_after
+        delay = self.initial_delay * (self.multiplier ** (attempt - 1))
+        return self._jittered(min(self.max_delay, delay))
+
+    def record(self, key: str, duration: float):
+        """Feeds an observed completion time back into the per-key estimate."""
+        previous = self._expected.pop(key, None)
+        if previous is None:
+            self._expected[key] = duration
+        else:
+            self._expected[key] = previous + self.smoothing * (duration - previous)
+        while len(self._expected) > self.max_keys:
+            self._expected.popitem(last=False)
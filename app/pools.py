@@ -0,0 +1,186 @@
+# app/pools.py
+import asyncio
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import httpx
+from app.config import THREAD_POOL_WORKERS
+from app.metrics import (
+    CONNECTION_POOL_IN_USE,
+    CONNECTION_POOL_SIZE,
+    EXECUTOR_BUSY,
+    EXECUTOR_QUEUED,
+    EXECUTOR_WORKERS,
+    THREAD_QUEUE_WAIT,
+    labelled,
+)
+
+# Saturation of the pools requests wait on: executors (threads, processes) and outbound connections.
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that reports its size, busy workers and queued tasks under `name`."""
+
+    def __init__(self, name: str, max_workers: int, thread_name_prefix: str = ""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix or name)
+        self.name = name
+        self._busy = EXECUTOR_BUSY.labels(executor=name)
+        self._queued = EXECUTOR_QUEUED.labels(executor=name)
+        self._workers = EXECUTOR_WORKERS.labels(executor=name)
+        self._workers.inc(max_workers)
+        self._released = False
+
+    def submit(self, fn, /, *args, **kwargs):
+        def run():
+            self._queued.dec()
+            self._busy.inc()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._busy.dec()
+
+        self._queued.inc()
+        try:
+            future = super().submit(run)
+        except BaseException:
+            self._queued.dec()
+            raise
+        # A future is only cancelled before it starts, so `run` will never take it off the queue.
+        future.add_done_callback(lambda f: f.cancelled() and self._queued.dec())
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        super().shutdown(wait=wait, cancel_futures=cancel_futures)
+        if not self._released:
+            self._released = True
+            self._workers.dec(self._max_workers)
+
+class InstrumentedProcessPoolExecutor(ProcessPoolExecutor):
+    """
+    ProcessPoolExecutor that reports its size, busy workers and queued tasks under `name`.
+
+    Tasks are not seen starting in the worker processes, so busy and queued
+    are derived from the unfinished tasks and the pool size.
+    """
+
+    def __init__(self, name: str, max_workers: int, **kwargs):
+        super().__init__(max_workers=max_workers, **kwargs)
+        self.name = name
+        self._unfinished = 0
+        self._lock = threading.Lock()
+        self._busy = EXECUTOR_BUSY.labels(executor=name)
+        self._queued = EXECUTOR_QUEUED.labels(executor=name)
+        self._workers = EXECUTOR_WORKERS.labels(executor=name)
+        self._workers.inc(max_workers)
+        self._released = False
+
+    def _track(self, change: int):
+        with self._lock:
+            self._unfinished += change
+            self._busy.set(min(self._unfinished, self._max_workers))
+            self._queued.set(max(0, self._unfinished - self._max_workers))
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = super().submit(fn, *args, **kwargs)
+        self._track(1)
+        future.add_done_callback(lambda _: self._track(-1))
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        super().shutdown(wait=wait, cancel_futures=cancel_futures)
+        if not self._released:
+            self._released = True
+            self._workers.dec(self._max_workers)
+
+def install_default_executor(max_workers: int = THREAD_POOL_WORKERS):
+    """
+    Replaces the running loop's default executor, the one behind
+    `asyncio.to_thread`, with an instrumented pool of `max_workers` threads.
+    Call from startup code running on the loop.
+    """
+    asyncio.get_running_loop().set_default_executor(
+        InstrumentedThreadPoolExecutor("to_thread", max_workers, thread_name_prefix="asyncio")
+    )
+
+async def run_in_thread(call: str, func, /, *args, **kwargs):
+    """
+    `asyncio.to_thread` that records how long `func` waited for a free
+    thread in the `to_thread_queue_wait_seconds` histogram, labelled `call`.
+    """
+    submitted = time.perf_counter()
+
+    def run():
+        labelled(THREAD_QUEUE_WAIT, call=call).observe(time.perf_counter() - submitted)
+        return func(*args, **kwargs)
+    return await asyncio.to_thread(run)
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+class CountingTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps an httpx transport to report connection pool usage under `pool`.
+
+    A request counts as in use from the moment it is sent until its response
+    body is closed, which is as long as it holds its pooled connection.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, pool: str, size: int):
+        self._transport = transport
+        self._in_use = CONNECTION_POOL_IN_USE.labels(pool=pool)
+        self._size = CONNECTION_POOL_SIZE.labels(pool=pool)
+        self._size.inc(size)
+        self._size_held = size
+
+    def _release_once(self):
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._in_use.dec()
+        return release
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._in_use.inc()
+        release = self._release_once()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+        response.stream = _ReleasingStream(response.stream, release)
+        return response
+
+    async def aclose(self):
+        try:
+            await self._transport.aclose()
+        finally:
+            self._size.dec(self._size_held)
+            self._size_held = 0
+
+def count_botocore_connections(client, pool: str):
+    """
+    Reports the connection pool usage of a botocore client under `pool`.
+
+    Every attempt is counted from when its HTTP request is created until
+    botocore decides whether to retry it; streamed bodies read afterwards
+    are not included.
+    """
+    in_use = CONNECTION_POOL_IN_USE.labels(pool=pool)
+    events = client.meta.events
+    service = client.meta.service_model.service_name
+    events.register(f"request-created.{service}", lambda **kwargs: in_use.inc())
+    events.register(f"needs-retry.{service}", lambda **kwargs: in_use.dec())
@@ -0,0 +1,178 @@
+# app/profiling.py
+import asyncio
+import hmac
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+from app.config import ADMIN_TOKEN, EVENT_LOOP_MONITOR_INTERVAL, SLOW_CALLBACK_SECONDS, PROFILE_MAX_SECONDS
+from app.logging_utils import setup_logging
+from app.metrics import EVENT_LOOP_LAG, EVENT_LOOP_STALLS
+
+logger = setup_logging("app.profiling")
+
+class EventLoopMonitor:
+    """
+    Measures event loop lag and catches what blocks the loop.
+
+    A probe task sleeps `interval` seconds at a time and records how late it
+    wakes up in EVENT_LOOP_LAG. A watchdog thread notices when the probe is
+    more than `slow_callback` seconds overdue, meaning a single callback is
+    holding the loop, and logs the loop thread's stack while it is blocked.
+    """
+
+    def __init__(self, interval: float = EVENT_LOOP_MONITOR_INTERVAL, slow_callback: float = SLOW_CALLBACK_SECONDS, history: int = 20):
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.lag = 0.0
+        self.stalls = deque(maxlen=history)
+        self._expected = 0.0
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Starts watching the running loop; call from a coroutine running on it."""
+        self._loop_thread = threading.get_ident()
+        self._expected = time.monotonic() + self.interval
+        self._stop.clear()
+        self._task = asyncio.create_task(self._probe())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=1)
+
+    async def _probe(self):
+        while True:
+            self._expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.monotonic() - self._expected)
+            EVENT_LOOP_LAG.set(self.lag)
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(max(0.01, self.slow_callback / 2)):
+            expected = self._expected
+            overdue = time.monotonic() - expected
+            if overdue < self.slow_callback or reported == expected:
+                continue
+            # Reported once per stall, with the stack of whatever is still running on the loop.
+            reported = expected
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            EVENT_LOOP_STALLS.inc()
+            self.stalls.append({"detected_at": time.time(), "blocked_seconds": round(overdue, 3), "stack": stack})
+            logger.warning(f"Event loop blocked for {overdue:.3f} seconds so far; loop thread stack:\n{stack}")
+
+    def status(self) -> dict:
+        return {
+            "lag_seconds": round(self.lag, 6),
+            "interval": self.interval,
+            "slow_callback_seconds": self.slow_callback,
+            "recent_stalls": list(self.stalls),
+        }
+
+def frame_name(frame) -> str:
+    """`module.qualified_name` of a frame's function, safe for collapsed stack lines."""
+    name = f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_qualname}"
+    return name.replace(";", ":").replace(" ", "_")
+
+def sample_stacks(seconds: float, interval: float, thread_ids: Optional[set] = None) -> Counter:
+    """
+    Samples the stacks of other threads (only `thread_ids` when given) every
+    `interval` seconds for `seconds`. Returns how often each stack was seen,
+    keyed by its collapsed form: thread name, then frames from root to leaf,
+    separated by semicolons.
+    """
+    sampler = threading.get_ident()
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == sampler or (thread_ids is not None and ident not in thread_ids):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}").replace(" ", "_"))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+def format_collapsed(counts: Counter) -> str:
+    """One `stack count` line per stack, the input format of flamegraph.pl, speedscope and inferno."""
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+_monitor: Optional[EventLoopMonitor] = None
+_profiler: Optional[ThreadPoolExecutor] = None
+_profile_lock = threading.Lock()
+
+async def start_event_loop_monitor() -> Optional[EventLoopMonitor]:
+    """Starts the process-wide monitor unless EVENT_LOOP_MONITOR_INTERVAL is 0."""
+    global _monitor
+    if EVENT_LOOP_MONITOR_INTERVAL > 0 and _monitor is None:
+        _monitor = EventLoopMonitor()
+        _monitor.start()
+    return _monitor
+
+async def stop_event_loop_monitor():
+    global _monitor
+    if _monitor is not None:
+        await _monitor.stop()
+        _monitor = None
+
+def require_admin(request: Request):
+    """Lets through requests with `Authorization: Bearer <ADMIN_TOKEN>`; without a token the endpoints do not exist."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
+
+admin_router = APIRouter(dependencies=[Depends(require_admin)], include_in_schema=False)
+
+@admin_router.get("/event-loop")
+async def event_loop_status():
+    """Current event loop lag and the stacks of recent stalls."""
+    if _monitor is None:
+        return {"enabled": False}
+    return {"enabled": True, **_monitor.status()}
+
+@admin_router.get("/profile", response_class=PlainTextResponse)
+async def capture_profile(
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    interval: float = Query(0.01, ge=0.001, le=1),
+    threads: Literal["all", "loop"] = "all",
+):
+    """
+    Samples thread stacks for `seconds` and returns them as collapsed stacks,
+    e.g. `curl ... | flamegraph.pl > profile.svg`. `threads=loop` keeps only
+    the event loop thread. One profile runs at a time.
+    """
+    global _profiler
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already being captured")
+    try:
+        if _profiler is None:
+            # A thread of its own, so profiling a starved to_thread pool does not wait in its queue.
+            _profiler = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profiler")
+        thread_ids = {threading.get_ident()} if threads == "loop" else None
+        logger.info(f"Capturing a {seconds} second profile of {threads} threads")
+        counts = await asyncio.get_running_loop().run_in_executor(_profiler, sample_stacks, seconds, interval, thread_ids)
+    finally:
+        _profile_lock.release()
+    return PlainTextResponse(format_collapsed(counts), headers={"X-Profile-Samples": str(sum(counts.values()))})
@@ -0,0 +1,259 @@
+# app/resilience.py
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from contextlib import contextmanager
+from typing import Callable, Optional, TypeVar
+from app.config import (
+    BREAKER_ENABLED,
+    BREAKER_FAILURE_RATE,
+    BREAKER_SLOW_CALL_RATE,
+    BREAKER_WINDOW,
+    BREAKER_MIN_CALLS,
+    BREAKER_OPEN_SECONDS,
+    BREAKER_HALF_OPEN_CALLS,
+)
+from app.metrics import (
+    CIRCUIT_BREAKER_STATE,
+    CIRCUIT_BREAKER_TRANSITIONS,
+    CIRCUIT_BREAKER_REJECTIONS,
+    OUTBOUND_RETRIES,
+    S3_HEDGED_READS,
+    labelled,
+)
+from app.logging_utils import setup_logging
+
+logger = setup_logging("app.resilience")
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose breaker is open; `retry_after` is in seconds."""
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"{endpoint} is unavailable; retry after {retry_after:.0f} seconds")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """
+    Count-based circuit breaker for one outbound endpoint.
+
+    The outcomes of the last `window` calls are kept. Once at least
+    `min_calls` are known and the share of failures reaches `failure_rate`
+    (or the share of calls slower than `slow_call_duration` reaches
+    `slow_call_rate`), the breaker opens and calls fail fast with
+    CircuitOpenError for `open_duration` seconds. It then lets
+    `half_open_calls` probe calls through: one bad probe re-opens it, and
+    all of them succeeding closes it. Thread-safe.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        slow_call_duration: float,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        slow_call_rate: float = BREAKER_SLOW_CALL_RATE,
+        window: int = BREAKER_WINDOW,
+        min_calls: int = BREAKER_MIN_CALLS,
+        open_duration: float = BREAKER_OPEN_SECONDS,
+        half_open_calls: int = BREAKER_HALF_OPEN_CALLS,
+        enabled: bool = BREAKER_ENABLED,
+    ):
+        self.endpoint = endpoint
+        self.slow_call_duration = slow_call_duration
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+        self.enabled = enabled
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)  # (failed, slow) per call
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+        CIRCUIT_BREAKER_STATE.labels(endpoint=endpoint).set(0)
+
+    def retry_after(self) -> Optional[float]:
+        """Seconds until calls are let through again, or None if they are now."""
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened_at + self.open_duration - time.monotonic()
+                return remaining if remaining > 0 else None
+            if self.state == HALF_OPEN and self._probes >= self.half_open_calls:
+                return self.open_duration
+            return None
+
+    def acquire(self) -> bool:
+        """Admits a call or raises CircuitOpenError; returns True when the call is a probe."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened_at + self.open_duration - time.monotonic()
+                if remaining > 0:
+                    labelled(CIRCUIT_BREAKER_REJECTIONS, endpoint=self.endpoint).inc()
+                    raise CircuitOpenError(self.endpoint, remaining)
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    labelled(CIRCUIT_BREAKER_REJECTIONS, endpoint=self.endpoint).inc()
+                    raise CircuitOpenError(self.endpoint, self.open_duration)
+                self._probes += 1
+                return True
+            return False
+
+    def record(self, failed: bool, duration: Optional[float] = None, probe: bool = False):
+        """
+        Records the outcome of a call. Calls that did not go through `acquire`
+        (probe=False) only count while the breaker is closed.
+        """
+        if not self.enabled:
+            return
+        bad = failed or (duration is not None and duration >= self.slow_call_duration)
+        with self._lock:
+            if probe and self.state == HALF_OPEN:
+                if bad:
+                    self._transition(OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._transition(CLOSED)
+                return
+            if self.state != CLOSED:
+                return
+            self._outcomes.append((failed, bad and not failed))
+            if len(self._outcomes) < self.min_calls:
+                return
+            failures = sum(1 for f, _ in self._outcomes if f)
+            slow = sum(1 for _, s in self._outcomes if s)
+            if failures >= self.failure_rate * len(self._outcomes) or slow >= self.slow_call_rate * len(self._outcomes):
+                self._transition(OPEN)
+
+    def release(self, probe: bool):
+        """Gives back a probe slot for a call that ended without an outcome (e.g. cancelled)."""
+        if probe:
+            with self._lock:
+                if self.state == HALF_OPEN:
+                    self._probes -= 1
+
+    @contextmanager
+    def guard(self, is_failure: Callable[[BaseException], bool] = lambda e: True):
+        """Runs the block as one call through the breaker; exceptions matching `is_failure` count as failures."""
+        probe = self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.record(is_failure(e), time.monotonic() - start, probe)
+            raise
+        except BaseException:
+            self.release(probe)
+            raise
+        self.record(False, time.monotonic() - start, probe)
+
+    def _transition(self, state: str):
+        # Called with the lock held.
+        logger.warning(f"Circuit breaker for {self.endpoint} is now {state}")
+        self.state = state
+        self._outcomes.clear()
+        self._probes = 0
+        self._probe_successes = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        CIRCUIT_BREAKER_STATE.labels(endpoint=self.endpoint).set(STATE_VALUES[state])
+        CIRCUIT_BREAKER_TRANSITIONS.labels(endpoint=self.endpoint, state=state).inc()
+
+class RetryBudget:
+    """
+    Caps extra attempts (retries or hedges) at `ratio` of the calls made.
+
+    Every call deposits `ratio` tokens and every extra attempt spends one, up
+    to `max_tokens` saved, so a failing dependency sees at most about
+    (1 + ratio) times the normal load instead of a multiple of it. Thread-safe.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+def retry_call(
+    func: Callable[[], T],
+    endpoint: str,
+    attempts: int,
+    budget: RetryBudget,
+    is_retryable: Callable[[BaseException], bool],
+    base_delay: float = 0.05,
+) -> T:
+    """Calls `func` (which must be idempotent), retrying retryable errors with jittered backoff while the budget allows."""
+    budget.deposit()
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == attempts or not is_retryable(e):
+                raise
+            if not budget.withdraw():
+                labelled(OUTBOUND_RETRIES, endpoint=endpoint, result="budget_exhausted").inc()
+                raise
+            labelled(OUTBOUND_RETRIES, endpoint=endpoint, result="retried").inc()
+            logger.info(f"Retrying {endpoint} call after error: {str(e)}")
+            time.sleep(base_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+def hedged_call(
+    func: Callable[[], T],
+    delay: float,
+    budget: RetryBudget,
+    executor: Executor,
+    discard: Optional[Callable[[T], None]] = None,
+) -> T:
+    """
+    Calls `func` and, if it has not finished after `delay` seconds and the
+    budget allows, sends an identical second call; the first success wins.
+    `discard` is called with the loser's result once it arrives (e.g. to close
+    a response body). `func` must be idempotent.
+    """
+    budget.deposit()
+    primary = executor.submit(func)
+    done, _ = wait([primary], timeout=delay)
+    if done or not budget.withdraw():
+        return primary.result()
+    S3_HEDGED_READS.labels(result="sent").inc()
+    backup = executor.submit(func)
+    pending = {primary, backup}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((future for future in done if future.exception() is None), None)
+        if winner is None:
+            error = error or next(iter(done)).exception()
+            continue
+        if winner is backup:
+            S3_HEDGED_READS.labels(result="won").inc()
+        if discard is not None:
+            for loser in (done | pending) - {winner}:
+                loser.add_done_callback(lambda f: f.exception() is None and discard(f.result()))
+        return winner.result()
+    raise error
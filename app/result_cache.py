@@ -0,0 +1,97 @@
+# app/result_cache.py
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple
+from app.config import RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES, STREAM_CHUNK_SIZE
+from app.metrics import RESULT_CACHE_REQUESTS
+from app.models import ReplaceBackgroundRelightInput
+
+# Fields that do not influence the generated image. Image URLs are replaced by
+# content hashes, so the same picture under a different URL still matches.
+# `username` stays in: results are stored under the requester's name, so one
+# vendor must never be handed another vendor's URL.
+NON_GENERATION_FIELDS = {"subject_image", "background_reference", "light_reference"}
+
+def result_fingerprint(input: ReplaceBackgroundRelightInput, files: dict) -> str:
+    """
+    Returns a canonical hash of everything that determines a generation's output
+    (the model's generation parameters plus the content of each input image)
+    and of the vendor it is generated for.
+    """
+    digest = hashlib.sha256()
+    fields = input.model_dump(mode="json", exclude=NON_GENERATION_FIELDS)
+    digest.update(json.dumps(fields, sort_keys=True, separators=(",", ":")).encode())
+    for field in sorted(files):
+        _, content, _ = files[field]
+        content_digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in iter(lambda: content.read(STREAM_CHUNK_SIZE), b""):
+            content_digest.update(chunk)
+        content.seek(0)
+        digest.update(field.encode())
+        digest.update(content_digest.digest())
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Maps request fingerprints to the S3 URL of a previously uploaded result.
+
+    Entries expire after `ttl` seconds and the least recently used entries are
+    evicted beyond `max_entries`. Concurrent requests for the same fingerprint
+    share one in-flight generation; it runs as its own task, so a caller going
+    away does not cancel the work for the others. Must be used from one event loop.
+    """
+
+    def __init__(self, ttl: float = RESULT_CACHE_TTL, max_entries: int = RESULT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        url, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return url
+
+    def put(self, key: str, url: str):
+        self._entries[key] = (url, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_create(self, key: str, factory: Callable[[], Awaitable[str]]) -> Tuple[str, str]:
+        """
+        Returns (url, status) where status is "HIT" for a cached result,
+        "COALESCED" when joining an identical in-flight generation, or "MISS".
+        """
+        url = self.get(key)
+        if url is not None:
+            RESULT_CACHE_REQUESTS.labels(result="hit").inc()
+            return url, "HIT"
+
+        task = self._inflight.get(key)
+        if task is not None:
+            status = "COALESCED"
+        else:
+            status = "MISS"
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        RESULT_CACHE_REQUESTS.labels(result=status.lower()).inc()
+        return await asyncio.shield(task), status
+
+    def _finish(self, key: str, task: asyncio.Future):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+result_cache = ResultCache()
@@ -0,0 +1,169 @@
+# app/s3.py
+import threading
+from typing import Callable, Optional, TypeVar
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, ReadTimeoutError
+from app.config import (
+    AWS_ACCESS_KEY_ID,
+    AWS_SECRET_ACCESS_KEY,
+    AWS_DEFAULT_REGION,
+    S3_BUCKET,
+    S3_ENDPOINT_URL,
+    S3_MAX_POOL_CONNECTIONS,
+    S3_RETRY_MODE,
+    S3_MAX_ATTEMPTS,
+    S3_CONNECT_TIMEOUT,
+    S3_READ_TIMEOUT,
+    S3_MULTIPART_THRESHOLD,
+    S3_TRANSFER_CONCURRENCY,
+    S3_SLOW_CALL_SECONDS,
+    S3_READ_ATTEMPTS,
+    RETRY_BUDGET_RATIO,
+    S3_HEDGE_ENABLED,
+    S3_HEDGE_DELAY,
+    S3_HEDGE_BUDGET_RATIO,
+)
+from app.logging_utils import setup_logging
+from app.metrics import CONNECTION_POOL_SIZE
+from app.pools import InstrumentedThreadPoolExecutor, count_botocore_connections
+from app.resilience import CircuitBreaker, RetryBudget, hedged_call, retry_call
+
+logger = setup_logging("app.s3")
+
+# Uploads above the threshold go out as multipart uploads of the same part size.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_THRESHOLD,
+    max_concurrency=S3_TRANSFER_CONCURRENCY
+)
+
+T = TypeVar("T")
+
+_s3_clients = {}
+_s3_read_clients = {}
+_s3_client_lock = threading.Lock()
+
+def create_s3_client(retries: Optional[dict] = None, region: Optional[str] = None):
+    """
+    Creates a new S3 client with a tuned connection pool, retry policy and timeouts.
+
+    Prefer `get_s3_client()`; this is only useful when a separate client is needed.
+    """
+    session = boto3.session.Session(
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=region or AWS_DEFAULT_REGION
+    )
+    config = Config(
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        retries=retries or {"mode": S3_RETRY_MODE, "max_attempts": S3_MAX_ATTEMPTS},
+        connect_timeout=S3_CONNECT_TIMEOUT,
+        read_timeout=S3_READ_TIMEOUT,
+        tcp_keepalive=True
+    )
+    client = session.client("s3", endpoint_url=S3_ENDPOINT_URL, config=config)
+    count_botocore_connections(client, "s3")
+    return client
+
+def _report_pool_size():
+    # Every shared client has a pool of its own.
+    CONNECTION_POOL_SIZE.labels(pool="s3").set(S3_MAX_POOL_CONNECTIONS * (len(_s3_clients) + len(_s3_read_clients)))
+
+def get_s3_client(region: Optional[str] = None):
+    """
+    Returns the process-wide S3 client for `region` (AWS_DEFAULT_REGION when
+    None), creating it on first use.
+
+    boto3 clients are thread-safe, so a single instance per region is shared by
+    every download and upload running in worker threads.
+    """
+    region = None if region == AWS_DEFAULT_REGION else region
+    client = _s3_clients.get(region)
+    if client is None:
+        with _s3_client_lock:
+            client = _s3_clients.get(region)
+            if client is None:
+                logger.info(f"Creating shared S3 client for region {region or AWS_DEFAULT_REGION} (max_pool_connections={S3_MAX_POOL_CONNECTIONS})")
+                client = _s3_clients[region] = create_s3_client(region=region)
+                _report_pool_size()
+    return client
+
+def get_s3_read_client(region: Optional[str] = None):
+    """
+    Returns the process-wide client for idempotent reads made through
+    `resilient_read()`. botocore does not retry on it, so a read is only
+    retried within the retry budget.
+    """
+    region = None if region == AWS_DEFAULT_REGION else region
+    client = _s3_read_clients.get(region)
+    if client is None:
+        with _s3_client_lock:
+            client = _s3_read_clients.get(region)
+            if client is None:
+                client = _s3_read_clients[region] = create_s3_client(
+                    retries={"mode": S3_RETRY_MODE, "total_max_attempts": 1}, region=region
+                )
+                _report_pool_size()
+    return client
+
+def reset_s3_client():
+    """Drops the shared clients so the next calls to `get_s3_client()`/`get_s3_read_client()` build new ones."""
+    with _s3_client_lock:
+        _s3_clients.clear()
+        _s3_read_clients.clear()
+        _report_pool_size()
+
+def is_transient_error(e: BaseException) -> bool:
+    """True for errors that say S3 is struggling (throttling, 5xx, timeouts), not that the request was wrong."""
+    if isinstance(e, (BotocoreConnectionError, ReadTimeoutError)):
+        return True
+    if isinstance(e, ClientError):
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        code = e.response.get("Error", {}).get("Code", "")
+        return status >= 500 or code in ("SlowDown", "Throttling", "ThrottlingException", "RequestTimeout")
+    return False
+
+s3_breaker = CircuitBreaker("s3", slow_call_duration=S3_SLOW_CALL_SECONDS)
+_read_retry_budget = RetryBudget(RETRY_BUDGET_RATIO)
+_hedge_budget = RetryBudget(S3_HEDGE_BUDGET_RATIO)
+_hedge_executor: Optional[InstrumentedThreadPoolExecutor] = None
+
+def _get_hedge_executor() -> InstrumentedThreadPoolExecutor:
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _s3_client_lock:
+            if _hedge_executor is None:
+                _hedge_executor = InstrumentedThreadPoolExecutor("s3_hedge", S3_MAX_POOL_CONNECTIONS, thread_name_prefix="s3-hedge")
+    return _hedge_executor
+
+def resilient_read(func: Callable[[], T], discard: Optional[Callable[[T], None]] = None) -> T:
+    """
+    Runs an idempotent S3 read (which should use `get_s3_read_client()`)
+    through the S3 circuit breaker, with budgeted retries of transient errors
+    and, when S3_HEDGE_ENABLED, a hedged duplicate after S3_HEDGE_DELAY.
+    `discard` releases the result of a hedged request that lost the race.
+    """
+    def attempt():
+        with s3_breaker.guard(is_failure=is_transient_error):
+            if S3_HEDGE_ENABLED:
+                return hedged_call(func, S3_HEDGE_DELAY, _hedge_budget, _get_hedge_executor(), discard)
+            return func()
+    return retry_call(attempt, "s3", S3_READ_ATTEMPTS, _read_retry_budget, is_transient_error)
+
+def warm_up_s3_client():
+    """
+    Creates the shared client and opens a first connection to the bucket so the
+    first request does not pay for credential resolution and the TLS handshake.
+    Failures are logged and ignored; the service can still start.
+    """
+    client = get_s3_client()
+    get_s3_read_client()
+    if not S3_BUCKET:
+        return
+    try:
+        client.head_bucket(Bucket=S3_BUCKET)
+        logger.info(f"Warmed up S3 connection to bucket '{S3_BUCKET}'")
+    except Exception as e:
+        logger.warning(f"S3 warm-up failed for bucket '{S3_BUCKET}': {str(e)}")
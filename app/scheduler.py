@@ -0,0 +1,225 @@
+# app/scheduler.py
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+from app.config import (
+    SCHEDULER_MAX_CONCURRENCY,
+    SCHEDULER_MAX_QUEUE,
+    SCHEDULER_QUOTA_SHARES,
+    VENDOR_MAX_QUEUE,
+    VENDOR_RATE,
+    VENDOR_BURST,
+    VENDOR_WEIGHTS,
+)
+from app.metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_WAIT, SCHEDULER_IN_FLIGHT, SCHEDULER_REJECTIONS, labelled, vendor_labels
+from app.logging_utils import setup_logging
+from app.tracing import span
+
+logger = setup_logging("app.scheduler")
+
+# Idle per-vendor state is pruned once this many vendors are tracked.
+MAX_TRACKED_VENDORS = 10000
+
+def parse_weights(value: str) -> Dict[str, float]:
+    """Parses "vendor:weight,vendor:weight" into a dict."""
+    weights = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        vendor_id, _, weight = item.rpartition(":")
+        weights[vendor_id] = float(weight)
+    return weights
+
+class AdmissionRejected(Exception):
+    """Raised when a request is turned away; `retry_after` is a hint in seconds."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Request rejected ({reason}); retry after {retry_after:.0f} seconds")
+        self.reason = reason
+        self.retry_after = retry_after
+
+def quota_share(quota: int, shares: int = SCHEDULER_QUOTA_SHARES) -> int:
+    """One process's part of a concurrency quota split between `shares` processes; never less than 1."""
+    return max(1, quota // max(1, shares))
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self) -> float:
+        """Takes one token; returns 0 on success or the seconds until one is available."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else math.inf
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+class FairScheduler:
+    """
+    Admission control and weighted fair sharing of outbound generation slots.
+
+    `admit()` applies a per-vendor token bucket and queue limits and raises
+    AdmissionRejected straight away when they are exceeded. `slot()` waits for
+    one of `max_concurrency` global slots. Waiters are queued per vendor and
+    freed slots go to the vendor with the lowest weighted service so far
+    (start-time fair queuing), so a burst from one vendor cannot starve the
+    others. Must be used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        max_queue: int = SCHEDULER_MAX_QUEUE,
+        vendor_max_queue: int = VENDOR_MAX_QUEUE,
+        vendor_rate: float = VENDOR_RATE,
+        vendor_burst: float = VENDOR_BURST,
+        weights: Optional[Dict[str, float]] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.vendor_max_queue = vendor_max_queue
+        self.vendor_rate = vendor_rate
+        self.vendor_burst = vendor_burst
+        self.weights = weights if weights is not None else parse_weights(VENDOR_WEIGHTS)
+        self._running = 0
+        self._queued = 0
+        self._queues: Dict[str, deque] = {}
+        # Metric label of each queue, fixed while it exists so its gauge increments and decrements match.
+        self._queue_labels: Dict[str, str] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._served: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._service_time = 10.0  # EWMA of slot hold time, used for Retry-After hints
+
+    def admit(self, vendor_id: str):
+        """
+        Checks the vendor's rate limit and queue limits; raises AdmissionRejected
+        if exceeded. A `vendor_rate` of 0 turns the rate limit off.
+        """
+        if self.vendor_rate > 0:
+            bucket = self._buckets.get(vendor_id)
+            if bucket is None:
+                self._prune_buckets()
+                bucket = self._buckets[vendor_id] = TokenBucket(self.vendor_rate, self.vendor_burst)
+            wait = bucket.consume()
+            if wait > 0:
+                self._reject(vendor_id, "rate_limited", wait)
+        if len(self._queues.get(vendor_id, ())) >= self.vendor_max_queue:
+            self._reject(vendor_id, "vendor_queue_full", self._queue_wait_estimate())
+        if self._queued >= self.max_queue:
+            self._reject(vendor_id, "queue_full", self._queue_wait_estimate())
+
+    @asynccontextmanager
+    async def slot(self, vendor_id: str):
+        """Holds one outbound slot for the duration of the block."""
+        with span("scheduler_wait"):
+            await self._acquire(vendor_id)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._service_time += 0.2 * ((time.monotonic() - start) - self._service_time)
+            self._release()
+
+    async def _acquire(self, vendor_id: str):
+        queued_at = time.monotonic()
+        if self._running < self.max_concurrency and self._queued == 0:
+            self._start(vendor_id)
+            labelled(SCHEDULER_WAIT, vendor_id=vendor_id).observe(0)
+            return
+        if self._queued >= self.max_queue:
+            self._reject(vendor_id, "queue_full", self._queue_wait_estimate())
+
+        queue = self._queues.get(vendor_id)
+        if not queue:
+            queue = self._queues[vendor_id] = deque()
+            self._queue_labels[vendor_id] = vendor_labels.label(vendor_id)
+            # A vendor that was idle starts at the current virtual time and cannot bank credit.
+            self._served[vendor_id] = max(self._served.get(vendor_id, 0.0), self._virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        self._queued += 1
+        labelled(SCHEDULER_QUEUE_DEPTH, vendor_id=self._queue_labels[vendor_id]).inc()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as we were cancelled; hand it on.
+                self._release()
+            else:
+                self._remove_waiter(vendor_id, waiter)
+            raise
+        labelled(SCHEDULER_WAIT, vendor_id=vendor_id).observe(time.monotonic() - queued_at)
+
+    def _start(self, vendor_id: str):
+        self._running += 1
+        # Virtual time follows the start tag of the work being dispatched.
+        self._virtual_time = max(self._virtual_time, self._served.get(vendor_id, 0.0))
+        self._served[vendor_id] = self._virtual_time + 1 / self.weights.get(vendor_id, 1.0)
+        SCHEDULER_IN_FLIGHT.set(self._running)
+
+    def _release(self):
+        self._running -= 1
+        SCHEDULER_IN_FLIGHT.set(self._running)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._queued:
+            vendor_id = min(self._queues, key=lambda v: self._served[v])
+            queue = self._queues[vendor_id]
+            waiter = queue.popleft()
+            self._queued -= 1
+            self._dequeued(vendor_id, queue)
+            if waiter.done():
+                continue
+            self._start(vendor_id)
+            waiter.set_result(None)
+
+    def _remove_waiter(self, vendor_id: str, waiter: asyncio.Future):
+        queue = self._queues.get(vendor_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self._queued -= 1
+        self._dequeued(vendor_id, queue)
+
+    def _dequeued(self, vendor_id: str, queue: deque):
+        labelled(SCHEDULER_QUEUE_DEPTH, vendor_id=self._queue_labels[vendor_id]).dec()
+        if not queue:
+            del self._queues[vendor_id]
+            del self._queue_labels[vendor_id]
+
+    def _queue_wait_estimate(self) -> float:
+        return (self._queued / max(1, self.max_concurrency) + 1) * self._service_time
+
+    def _reject(self, vendor_id: str, reason: str, retry_after: float):
+        labelled(SCHEDULER_REJECTIONS, vendor_id=vendor_id, reason=reason).inc()
+        logger.warning(f"Rejected request from {vendor_id}: {reason}")
+        raise AdmissionRejected(reason, retry_after)
+
+    def _prune_buckets(self):
+        if len(self._buckets) < MAX_TRACKED_VENDORS:
+            return
+        for vendor_id in [v for v, b in self._buckets.items() if b.full and v not in self._queues]:
+            del self._buckets[vendor_id]
+        for vendor_id in [v for v, served in self._served.items() if served <= self._virtual_time and v not in self._queues]:
+            del self._served[vendor_id]
+
+# SCHEDULER_MAX_CONCURRENCY is the deployment's Stability quota; each server worker gets its share.
+generation_scheduler = FairScheduler(max_concurrency=quota_share(SCHEDULER_MAX_CONCURRENCY))
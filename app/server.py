@@ -0,0 +1,74 @@
+# app/server.py
+"""
+Production entry point: `python -m app.server`.
+
+Runs SERVER_WORKERS uvicorn worker processes behind uvicorn's supervisor.
+On SIGTERM each worker stops accepting connections, lets in-flight requests
+finish for up to SERVER_DRAIN_TIMEOUT seconds, then runs the app's shutdown
+(which gives queued jobs the same grace period and closes shared clients).
+"""
+import os
+import shutil
+import tempfile
+import uvicorn
+from app.config import (
+    SERVER_HOST,
+    SERVER_PORT,
+    SERVER_WORKERS,
+    SERVER_DRAIN_TIMEOUT,
+    SERVER_KEEPALIVE_TIMEOUT,
+    SERVER_BACKLOG,
+    SERVER_ACCESS_LOG,
+)
+
+def prepare_multiprocess_metrics(workers: int):
+    """
+    Gives multi-worker deployments a fresh PROMETHEUS_MULTIPROC_DIR so /metrics
+    aggregates every worker, and empties a configured one (which must exist
+    once set) whatever the worker count. Must run before any worker imports
+    prometheus_client.
+    """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not path:
+        if workers > 1:
+            os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+        return
+    # Files left by a previous run would be summed into the new one.
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+def prepare_job_store(workers: int):
+    """
+    Jobs must be visible to every worker, since any of them may answer a status
+    request. Multi-worker deployments therefore default to the SQLite job store
+    and refuse to start with the in-memory one, which each worker keeps to itself.
+    """
+    if workers <= 1:
+        return
+    backend = os.environ.get("JOB_STORE_BACKEND")
+    if backend is None:
+        os.environ["JOB_STORE_BACKEND"] = "sqlite"
+    elif backend == "memory":
+        raise RuntimeError("JOB_STORE_BACKEND=memory is not shared between workers; use sqlite or SERVER_WORKERS=1")
+
+def main():
+    prepare_multiprocess_metrics(SERVER_WORKERS)
+    prepare_job_store(SERVER_WORKERS)
+    # Workers split the Stability concurrency quota instead of each assuming all of it.
+    os.environ.setdefault("SCHEDULER_QUOTA_SHARES", str(SERVER_WORKERS))
+    # The app is passed by import string so only the workers import it; the supervisor stays small.
+    uvicorn.run(
+        "app.main:app",
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        workers=SERVER_WORKERS,
+        backlog=SERVER_BACKLOG,
+        timeout_keep_alive=SERVER_KEEPALIVE_TIMEOUT,
+        timeout_graceful_shutdown=SERVER_DRAIN_TIMEOUT,
+        access_log=SERVER_ACCESS_LOG,
+        log_level=os.getenv("LOG_LEVEL", "INFO").lower(),
+        lifespan="on",
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+# app/stability.py
+import asyncio
+import time
+from typing import Optional
+from urllib.parse import urlparse
+import httpx
+from app.deadlines import check_deadline, deadline_expired, time_remaining
+from app.config import (
+    STABILITY_KEY,
+    STABILITY_API_HOST,
+    WORKER_TIMEOUT,
+    STABILITY_MAX_CONNECTIONS,
+    STABILITY_MAX_KEEPALIVE,
+    STABILITY_HTTP2,
+    STABILITY_SLOW_CALL_SECONDS,
+)
+from app.logging_utils import setup_logging
+from app.metrics import STABILITY_POLL_COUNT, STABILITY_POLL_WASTED_WAIT, STABILITY_POLLS_IN_FLIGHT
+from app.polling import PollScheduler, parse_retry_after
+from app.pools import CountingTransport
+from app.resilience import CircuitBreaker
+from app.tracing import span
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = setup_logging("app.stability")
+
+class StabilityAPIError(Exception):
+    """An error response or timeout from the Stability API; `status_code` is None for timeouts."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+def is_upstream_failure(e: BaseException) -> bool:
+    """True for errors that say the Stability API is unhealthy (transport errors, 5xx, timeouts)."""
+    if isinstance(e, httpx.TimeoutException) and deadline_expired():
+        # Cut short by our own request deadline; says nothing about the API's health.
+        return False
+    if isinstance(e, httpx.TransportError):
+        return True
+    if isinstance(e, StabilityAPIError):
+        return e.status_code is None or e.status_code >= 500
+    return False
+
+class StabilityClient:
+    """
+    Asynchronous client for the Stability API.
+
+    A single instance holds one pooled httpx session (keep-alive, HTTP/2 when the
+    `h2` package is installed), so many generations can be submitted and polled
+    concurrently from the event loop without parking a thread per request.
+    Submissions go through a circuit breaker that every generation's outcome
+    feeds once, so while the API is failing new generations fail fast with
+    CircuitOpenError.
+    """
+
+    def __init__(
+        self,
+        api_key: str = STABILITY_KEY,
+        base_url: str = STABILITY_API_HOST,
+        timeout: int = WORKER_TIMEOUT,
+        scheduler: Optional[PollScheduler] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.scheduler = scheduler or PollScheduler()
+        self.breaker = breaker or CircuitBreaker("stability", slow_call_duration=STABILITY_SLOW_CALL_SECONDS)
+        if transport is None:
+            transport = httpx.AsyncHTTPTransport(
+                http2=STABILITY_HTTP2 and HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=STABILITY_MAX_CONNECTIONS,
+                    max_keepalive_connections=STABILITY_MAX_KEEPALIVE,
+                ),
+            )
+        self._client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            transport=CountingTransport(transport, "stability", STABILITY_MAX_CONNECTIONS),
+        )
+
+    async def submit(self, host: str, params: dict, files: dict) -> str:
+        """
+        Submits a generation request and returns its generation id.
+
+        Only a failed submission feeds the breaker here; a generation that was
+        accepted gets its outcome recorded once it has been polled (see `generate`).
+        """
+        generation_id, probe, _ = await self._submit(host, params, files)
+        self.breaker.release(probe)
+        return generation_id
+
+    async def _submit(self, host: str, params: dict, files: dict) -> tuple:
+        # Returns the generation id, whether the call is a breaker probe, and how long the submission took.
+        logger.info("Sending REST request to %s with params: %s and files: %s", host, params, list(files))
+        # Nobody will read the result once the request's deadline has passed; do not spend quota on it.
+        check_deadline("submit")
+        remaining = time_remaining()
+        timeout = httpx.USE_CLIENT_DEFAULT if remaining is None else httpx.Timeout(min(60.0, remaining), connect=min(10.0, remaining))
+        probe = self.breaker.acquire()
+        start = time.monotonic()
+        try:
+            with span("stability_submit") as submit_span:
+                response = await self._client.post(
+                    host, headers={"Accept": "application/json"}, files=files, data=params, timeout=timeout
+                )
+                if submit_span is not None:
+                    submit_span.attributes["http.status_code"] = response.status_code
+                if not response.is_success:
+                    logger.error("Received error response: HTTP %s: %s", response.status_code, response.text)
+                    raise StabilityAPIError(f"HTTP {response.status_code}: {response.text}", response.status_code)
+
+            logger.info("Received initial response from generation request.")
+            generation_id = response.json().get("id", None)
+            if generation_id is None:
+                logger.error("No generation id found in response.")
+                raise Exception("Expected id in response")
+        except Exception as e:
+            self.breaker.record(is_upstream_failure(e), time.monotonic() - start, probe)
+            raise
+        except BaseException:
+            self.breaker.release(probe)
+            raise
+        return generation_id, probe, time.monotonic() - start
+
+    async def poll(
+        self, generation_id: str, key: str = "default", probe: bool = False, submit_duration: Optional[float] = None
+    ) -> httpx.Response:
+        """
+        Polls the results endpoint until the generation is no longer in progress.
+        Gives up with DeadlineExceeded as soon as the request it serves has
+        timed out or been abandoned by its client.
+
+        Poll timing comes from the scheduler; `key` groups generations with
+        similar expected durations so the first poll lands near completion.
+        The body of the returned response has not been read yet; the caller
+        must consume or close it.
+
+        The generation's outcome feeds the breaker once: a failure when polling
+        times out or the API errors, a success (timed by `submit_duration`, the
+        submission's duration) when the result arrives. `probe` is what the
+        breaker returned when the generation was submitted.
+        """
+        poll_url = f"{self.base_url}/v2beta/results/{generation_id}"
+        operation_type = key.split(":", 1)[0]
+        logger.info(f"Polling results at {poll_url}")
+        recorded = False
+
+        def record(failed: bool, duration: Optional[float] = None):
+            nonlocal recorded
+            recorded = True
+            self.breaker.record(failed, duration, probe)
+
+        try:
+            with STABILITY_POLLS_IN_FLIGHT.track_inprogress():
+                start = time.monotonic()
+                delay = self.scheduler.first_delay(key)
+                polls = 0
+                while True:
+                    check_deadline("poll")
+                    remaining = self.timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        logger.error(f"Polling timed out after {self.timeout} seconds")
+                        record(failed=True)
+                        raise StabilityAPIError(f"Timeout after {self.timeout} seconds")
+                    delay = min(delay, time_remaining(remaining))
+                    await asyncio.sleep(delay)
+                    check_deadline("poll")
+                    polls += 1
+                    with span("stability_poll", attempt=polls) as poll_span:
+                        request = self._client.build_request("GET", poll_url, headers={"Accept": "*/*"})
+                        try:
+                            response = await self._client.send(request, stream=True)
+                        except httpx.TransportError:
+                            record(failed=True)
+                            raise
+                        if response.status_code != 200:
+                            # Progress and error bodies are small; only the finished image is streamed.
+                            await response.aread()
+                        if poll_span is not None:
+                            poll_span.attributes["http.status_code"] = response.status_code
+                    retry_after = parse_retry_after(response.headers.get("retry-after"))
+                    if response.status_code == 429 and retry_after is not None:
+                        logger.info(f"Rate limited while polling; retrying after {retry_after} seconds")
+                        delay = retry_after
+                        continue
+                    if not response.is_success:
+                        if response.status_code >= 500:
+                            record(failed=True)
+                        logger.error("Polling error: HTTP %s: %s", response.status_code, response.text)
+                        raise StabilityAPIError(f"HTTP {response.status_code}: {response.text}", response.status_code)
+                    if response.status_code != 202:
+                        break
+                    delay = self.scheduler.next_delay(polls, retry_after)
+
+            # Polling is not gated (the generation is already running upstream); the
+            # submission's duration is what the slow-call threshold is tuned for.
+            record(failed=False, duration=submit_duration)
+            self.scheduler.record(key, time.monotonic() - start)
+            STABILITY_POLL_COUNT.labels(operation_type=operation_type).observe(polls)
+            STABILITY_POLL_WASTED_WAIT.labels(operation_type=operation_type).observe(delay)
+            logger.info(f"Polling completed successfully after {polls} polls.")
+            return response
+        finally:
+            if not recorded:
+                # Ended without saying anything about the API's health (deadline, 4xx, cancelled).
+                self.breaker.release(probe)
+
+    async def generate(self, host: str, params: dict, files: dict) -> httpx.Response:
+        """Submits a generation request and waits for its result; the generation feeds the breaker one outcome."""
+        generation_id, probe, duration = await self._submit(host, params, files)
+        return await self.poll(generation_id, key=poll_key(host, params, files), probe=probe, submit_duration=duration)
+
+    async def warm_up(self):
+        """
+        Opens a pooled connection to the API (TLS and HTTP/2 negotiation
+        included) before the first generation needs it. Failures are logged
+        and ignored.
+        """
+        try:
+            await self._client.get(self.base_url, timeout=5.0)
+            logger.info(f"Warmed up connection to {self.base_url}")
+        except httpx.HTTPError as e:
+            logger.warning(f"Stability API warm-up failed: {str(e)}")
+
+    async def aclose(self):
+        await self._client.aclose()
+
+def poll_key(host: str, params: dict, files: dict) -> str:
+    """
+    Groups generations whose completion times are expected to be similar:
+    same operation, same set of input images and same output format.
+    """
+    operation = urlparse(host).path.rstrip("/").rsplit("/", 1)[-1] or "default"
+    return f"{operation}:{','.join(sorted(files))}:{params.get('output_format', '')}"
+
+_client: Optional[StabilityClient] = None
+
+def get_stability_client() -> StabilityClient:
+    """Returns the process-wide Stability client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = StabilityClient()
+    return _client
+
+async def close_stability_client():
+    """Closes the process-wide Stability client and its connection pool."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
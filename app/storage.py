@@ -0,0 +1,397 @@
+# app/storage.py
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import re
+import secrets
+import shutil
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from fastapi import HTTPException
+from io import BytesIO
+from typing import BinaryIO, Optional, Tuple, Union
+from urllib.parse import quote, unquote, urlparse
+from botocore.exceptions import ClientError
+from app.cache import image_cache
+from app.config import (
+    S3_BUCKET,
+    IMAGE_CACHE_ENABLED,
+    STREAM_CHUNK_SIZE,
+    STORAGE_BACKEND,
+    STORAGE_ALLOWED_BUCKETS,
+    STORAGE_LOCAL_ROOT,
+    STORAGE_PUBLIC_URL,
+    STORAGE_SIGNING_KEY,
+    STORAGE_PRESIGN_EXPIRES,
+)
+from app.deadlines import DeadlineExceeded, check_deadline
+from app.logging_utils import setup_logging
+from app.resilience import CircuitOpenError
+from app.s3 import get_s3_client, get_s3_read_client, resilient_read, s3_breaker, is_transient_error, warm_up_s3_client, TRANSFER_CONFIG
+from app.utils import SpooledBody
+
+logger = setup_logging("app.storage")
+
+# Path the API serves local-backend objects under (see app.api).
+LOCAL_STORAGE_PATH = "/api/v1/storage"
+
+# Virtual-hosted ("bucket.s3.region.amazonaws.com") and path-style ("s3.region.amazonaws.com") S3 hosts,
+# including the legacy "s3-region" and dual-stack forms.
+_S3_HOST = re.compile(
+    r"^(?:(?P<bucket>.+)\.)?s3(?:[.-](?:dualstack\.)?(?P<region>[a-z]{2}(?:-[a-z]+)+-\d))?\.amazonaws\.com$"
+)
+_BUCKET_NAME = re.compile(r"^[a-z0-9][a-z0-9.\-]{1,61}[a-z0-9]$")
+
+class InvalidObjectURL(ValueError):
+    """The URL does not name an object this service may read."""
+
+@dataclass(frozen=True)
+class ObjectLocation:
+    bucket: str
+    key: str
+    region: Optional[str] = None  # None means AWS_DEFAULT_REGION
+
+    @property
+    def cache_key(self) -> str:
+        return f"{self.bucket}/{self.key}"
+
+def allowed_buckets() -> set:
+    """Buckets input URLs may point at: S3_BUCKET plus STORAGE_ALLOWED_BUCKETS."""
+    buckets = {bucket.strip() for bucket in STORAGE_ALLOWED_BUCKETS.split(",") if bucket.strip()}
+    if S3_BUCKET:
+        buckets.add(S3_BUCKET)
+    return buckets
+
+def parse_object_url(url: str) -> ObjectLocation:
+    """
+    Works out the bucket, key and region an object URL refers to.
+
+    Understands virtual-hosted and path-style S3 URLs (with or without a
+    region) and the local backend's own URLs under STORAGE_PUBLIC_URL. Any
+    other URL is read as a key in S3_BUCKET, taken from its path. Raises
+    InvalidObjectURL for buckets outside `allowed_buckets()`, so a caller
+    cannot make the service read arbitrary buckets with its credentials.
+    """
+    parsed = urlparse(str(url))
+    path = unquote(parsed.path).lstrip("/")
+    region = None
+    match = _S3_HOST.match(parsed.hostname or "")
+    local_prefix = f"{STORAGE_PUBLIC_URL.rstrip('/')}{LOCAL_STORAGE_PATH}/"
+    if str(url).startswith(local_prefix):
+        bucket, _, key = unquote(str(url)[len(local_prefix):].split("?", 1)[0]).partition("/")
+    elif match:
+        region = match["region"]
+        if match["bucket"]:
+            bucket, key = match["bucket"], path
+        else:
+            bucket, _, key = path.partition("/")
+    else:
+        bucket, key = S3_BUCKET, path
+    if not key:
+        raise InvalidObjectURL(f"No object key in {url}")
+    if bucket not in allowed_buckets():
+        raise InvalidObjectURL(f"Bucket '{bucket}' is not allowed")
+    return ObjectLocation(bucket, key, region)
+
+class StorageBackend(ABC):
+    """Object storage interface; implementations must be thread-safe."""
+
+    @abstractmethod
+    def read(self, location: ObjectLocation, etag: Optional[str] = None) -> Optional[Tuple[str, bytes]]:
+        """
+        Returns the object's (ETag, content), or None when `etag` is given
+        and still current, so revalidating a cached copy is cheap.
+        """
+
+    @abstractmethod
+    def open(self, location: ObjectLocation) -> BinaryIO:
+        """Returns a readable, seekable file over the object without holding it all in memory."""
+
+    @abstractmethod
+    def write(self, location: ObjectLocation, body: BinaryIO, content_type: str, cache_control: Optional[str] = None) -> None:
+        """Stores the readable file `body` as the object."""
+
+    @abstractmethod
+    def url(self, location: ObjectLocation) -> str:
+        """Returns the object's canonical URL, as returned to clients and accepted by `parse_object_url`."""
+
+    @abstractmethod
+    def presign_get(self, location: ObjectLocation, expires: int = STORAGE_PRESIGN_EXPIRES) -> str:
+        """Returns a URL anyone can download the object from for `expires` seconds."""
+
+    @abstractmethod
+    def presign_put(self, location: ObjectLocation, content_type: str, expires: int = STORAGE_PRESIGN_EXPIRES) -> str:
+        """Returns a URL anyone can upload the object to with an HTTP PUT for `expires` seconds."""
+
+    def warm_up(self) -> None:
+        pass
+
+class S3Storage(StorageBackend):
+    """
+    Objects in S3, read through the circuit breaker, retry budget and hedging
+    of `resilient_read()`, with one shared client per region.
+    """
+
+    def read(self, location: ObjectLocation, etag: Optional[str] = None) -> Optional[Tuple[str, bytes]]:
+        logger.info(f"Downloading image from bucket '{location.bucket}', key: {location.key}")
+        kwargs = {"Bucket": location.bucket, "Key": location.key}
+        if etag:
+            kwargs["IfNoneMatch"] = etag
+        def read():
+            # The body is read inside the call so a retried or hedged read returns complete content.
+            response = get_s3_read_client(location.region).get_object(**kwargs)
+            return response['ETag'], response['Body'].read()
+        try:
+            return resilient_read(read)
+        except ClientError as e:
+            if etag and e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 304:
+                logger.info(f"Cached copy of {location.key} is still current")
+                return None
+            raise
+
+    def open(self, location: ObjectLocation) -> BinaryIO:
+        logger.info(f"Streaming image from bucket '{location.bucket}', key: {location.key}")
+        response = resilient_read(
+            lambda: get_s3_read_client(location.region).get_object(Bucket=location.bucket, Key=location.key),
+            discard=lambda loser: loser['Body'].close()
+        )
+        body = SpooledBody()
+        try:
+            for chunk in response['Body'].iter_chunks(STREAM_CHUNK_SIZE):
+                # Runs in a worker thread that outlives a cancelled request; stop reading once it is abandoned.
+                check_deadline("download")
+                body.write(chunk)
+        except BaseException:
+            response['Body'].close()
+            body.close()
+            raise
+        return body.rewind()
+
+    def write(self, location: ObjectLocation, body: BinaryIO, content_type: str, cache_control: Optional[str] = None) -> None:
+        extra_args = {"ContentType": content_type}
+        if cache_control:
+            extra_args["CacheControl"] = cache_control
+        with s3_breaker.guard(is_failure=is_transient_error):
+            get_s3_client(location.region).upload_fileobj(
+                body, location.bucket, location.key,
+                ExtraArgs=extra_args,
+                Config=TRANSFER_CONFIG
+            )
+
+    def url(self, location: ObjectLocation) -> str:
+        return f"https://{location.bucket}.s3.amazonaws.com/{quote(location.key)}"
+
+    def presign_get(self, location: ObjectLocation, expires: int = STORAGE_PRESIGN_EXPIRES) -> str:
+        return get_s3_client(location.region).generate_presigned_url(
+            "get_object", Params={"Bucket": location.bucket, "Key": location.key}, ExpiresIn=expires
+        )
+
+    def presign_put(self, location: ObjectLocation, content_type: str, expires: int = STORAGE_PRESIGN_EXPIRES) -> str:
+        return get_s3_client(location.region).generate_presigned_url(
+            "put_object", Params={"Bucket": location.bucket, "Key": location.key, "ContentType": content_type}, ExpiresIn=expires
+        )
+
+    def warm_up(self) -> None:
+        warm_up_s3_client()
+
+class LocalStorage(StorageBackend):
+    """
+    Objects as files under `root`/<bucket>/<key>, for development, tests and
+    offline benchmarks.
+
+    Whole-object reads go through mmap and writes land in a temporary file
+    that is renamed into place, so readers never see a partial object. Each
+    object's Content-Type and Cache-Control are kept in a JSON sidecar under
+    `root`/.meta (bucket names cannot start with a dot) and served back with it.
+    Presigned URLs point at this service's own /storage routes and carry an
+    HMAC-SHA256 signature of the method, object and expiry time.
+    """
+
+    def __init__(self, root: str = STORAGE_LOCAL_ROOT, public_url: str = STORAGE_PUBLIC_URL, signing_key: Optional[str] = STORAGE_SIGNING_KEY):
+        self.root = os.path.realpath(root)
+        self.public_url = public_url.rstrip("/")
+        if signing_key is None:
+            logger.warning("STORAGE_SIGNING_KEY is not set; local presigned URLs are only valid in this process")
+            self._signing_key = secrets.token_bytes(32)
+        else:
+            self._signing_key = signing_key.encode()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, location: ObjectLocation) -> str:
+        """Returns the file backing an object; raises InvalidObjectURL for names that escape the bucket directory."""
+        if not _BUCKET_NAME.match(location.bucket):
+            raise InvalidObjectURL(f"Invalid bucket name: {location.bucket}")
+        bucket_dir = os.path.join(self.root, location.bucket)
+        path = os.path.realpath(os.path.join(bucket_dir, location.key))
+        if not path.startswith(bucket_dir + os.sep):
+            raise InvalidObjectURL(f"Invalid object key: {location.key}")
+        return path
+
+    def _metadata_path(self, location: ObjectLocation) -> str:
+        return os.path.join(self.root, ".meta", os.path.relpath(self.path(location), self.root)) + ".json"
+
+    def headers(self, location: ObjectLocation) -> dict:
+        """Returns the HTTP headers the object was stored with (Content-Type, Cache-Control); empty if unknown."""
+        try:
+            with open(self._metadata_path(location)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def _replace(path: str, write):
+        # Writes through a temporary file renamed into place, so readers never see a partial file.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @staticmethod
+    def _etag(stat: os.stat_result) -> str:
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    def read(self, location: ObjectLocation, etag: Optional[str] = None) -> Optional[Tuple[str, bytes]]:
+        with open(self.path(location), "rb") as f:
+            stat = os.fstat(f.fileno())
+            current = self._etag(stat)
+            if etag == current:
+                return None
+            if stat.st_size == 0:
+                return current, b""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return current, mm[:]
+
+    def open(self, location: ObjectLocation) -> BinaryIO:
+        return open(self.path(location), "rb")
+
+    def write(self, location: ObjectLocation, body: BinaryIO, content_type: str, cache_control: Optional[str] = None) -> None:
+        headers = {"Content-Type": content_type}
+        if cache_control:
+            headers["Cache-Control"] = cache_control
+        self._replace(self._metadata_path(location), lambda f: f.write(json.dumps(headers).encode()))
+        self._replace(self.path(location), lambda f: shutil.copyfileobj(body, f, STREAM_CHUNK_SIZE))
+
+    def url(self, location: ObjectLocation) -> str:
+        return f"{self.public_url}{LOCAL_STORAGE_PATH}/{location.bucket}/{quote(location.key)}"
+
+    def sign(self, method: str, location: ObjectLocation, expires_at: int) -> str:
+        message = f"{method}\n{location.bucket}\n{location.key}\n{expires_at}".encode()
+        return hmac.new(self._signing_key, message, hashlib.sha256).hexdigest()
+
+    def verify(self, method: str, location: ObjectLocation, expires_at: int, signature: str) -> bool:
+        """True if `signature` was issued by this backend for the request and has not expired."""
+        return expires_at >= time.time() and hmac.compare_digest(self.sign(method, location, expires_at), signature)
+
+    def _presign(self, method: str, location: ObjectLocation, expires: int) -> str:
+        expires_at = int(time.time()) + expires
+        return f"{self.url(location)}?expires={expires_at}&signature={self.sign(method, location, expires_at)}"
+
+    def presign_get(self, location: ObjectLocation, expires: int = STORAGE_PRESIGN_EXPIRES) -> str:
+        return self._presign("GET", location, expires)
+
+    def presign_put(self, location: ObjectLocation, content_type: str, expires: int = STORAGE_PRESIGN_EXPIRES) -> str:
+        return self._presign("PUT", location, expires)
+
+def create_storage() -> StorageBackend:
+    """Builds the storage backend selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "s3":
+        return S3Storage()
+    if STORAGE_BACKEND == "local":
+        return LocalStorage()
+    raise RuntimeError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+_storage: Optional[StorageBackend] = None
+
+def get_storage() -> StorageBackend:
+    """Returns the process-wide storage backend, creating it on first use."""
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
+
+def set_storage(storage: Optional[StorageBackend]):
+    """Replaces the process-wide storage backend; None goes back to STORAGE_BACKEND on next use."""
+    global _storage
+    _storage = storage
+
+def download_image(url: str) -> BinaryIO:
+    """
+    Downloads an image from the bucket and region named by its URL and returns a binary file object.
+
+    Objects are served from the input image cache when enabled (IMAGE_CACHE_ENABLED); otherwise
+    the body is streamed from the storage backend without being held in memory.
+
+    Args:
+        url (str): Object URL (e.g., "https://mybucket.s3.us-east-1.amazonaws.com/path/to/image.jpg")
+
+    Returns:
+        BinaryIO: Readable, seekable file positioned at the start of the image.
+
+    Raises:
+        HTTPException: If the URL is not allowed or the object cannot be downloaded.
+        CircuitOpenError: If S3 reads are failing fast.
+        DeadlineExceeded: If the request was abandoned while streaming the image.
+    """
+    logger.info(f"Starting download for image: {url}")
+    try:
+        location = parse_object_url(url)
+        logger.info(f"Resolved object: bucket '{location.bucket}', key: {location.key}, region: {location.region}")
+        storage = get_storage()
+
+        if IMAGE_CACHE_ENABLED:
+            content = image_cache.get(location.cache_key, lambda etag: storage.read(location, etag))
+            logger.info(f"Downloaded image of size {len(content)} bytes")
+            # BytesIO shares the cached bytes object until written to, so this does not copy.
+            return BytesIO(content)
+
+        return storage.open(location)
+    except (CircuitOpenError, DeadlineExceeded):
+        raise
+    except Exception as e:
+        logger.error("Error downloading image from %s - %s", url, e)
+        raise HTTPException(status_code=400, detail=f"Error downloading image from {url}: {e}")
+
+def upload_bytes_to_s3(
+    content: Union[bytes, BinaryIO],
+    bucket_name: str,
+    object_name: str,
+    content_type: str = "image/png",
+    cache_control: Optional[str] = None,
+) -> str:
+    """
+    Uploads image content (bytes or a readable binary file) through the storage backend and returns the object URL.
+
+    File content is streamed; on S3, bodies of S3_MULTIPART_THRESHOLD bytes or more go out as a multipart upload.
+    """
+    logger.info(f"Uploading file to storage: bucket='{bucket_name}', object_name='{object_name}'")
+    body = BytesIO(content) if isinstance(content, (bytes, bytearray)) else content
+    location = ObjectLocation(bucket_name, object_name)
+    storage = get_storage()
+    try:
+        storage.write(location, body, content_type, cache_control)
+        logger.info("File uploaded successfully.")
+    except (CircuitOpenError, DeadlineExceeded):
+        raise
+    except Exception as e:
+        logger.error("Error uploading file: %s", e)
+        raise HTTPException(status_code=500, detail=f"Failed to upload file: {e}")
+    url = storage.url(location)
+    logger.info(f"Constructed object URL: {url}")
+    return url
+
+def presign_download(url: str) -> str:
+    """Returns a presigned download URL for an object URL returned by `upload_bytes_to_s3`."""
+    storage = get_storage()
+    return storage.presign_get(parse_object_url(url))
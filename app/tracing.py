@@ -0,0 +1,214 @@
+# app/tracing.py
+import atexit
+import json
+import logging
+import queue
+import re
+import secrets
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from logging.handlers import QueueListener
+from typing import Any, Dict, List, Optional
+from app.config import SERVICE_NAME, TRACE_EXPORTER, TRACE_EXPORT_PATH, SERVER_TIMING_ENABLED
+
+# Inbound X-Request-ID values are only honored when they look like an id.
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:\-]{1,128}$")
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: bool = False
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+@dataclass
+class Trace:
+    correlation_id: str
+    trace_id: str = field(default_factory=lambda: secrets.token_hex(16))
+    spans: List[Span] = field(default_factory=list)
+    root: Optional[Span] = None
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+def current_ids() -> Dict[str, str]:
+    """Correlation, trace and span ids of the current context, for log records."""
+    trace = _current_trace.get()
+    if trace is None:
+        return {}
+    ids = {"correlation_id": trace.correlation_id, "trace_id": trace.trace_id}
+    span = _current_span.get()
+    if span is not None:
+        ids["span_id"] = span.span_id
+    return ids
+
+@contextmanager
+def span(name: str, **attributes):
+    """Times a stage of the current trace; does nothing outside a trace."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _current_span.get()
+    current = Span(name, secrets.token_hex(8), parent.span_id if parent else None, time.time_ns(), attributes=attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.error = True
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+        trace.spans.append(current)
+
+@contextmanager
+def start_trace(name: str, correlation_id: Optional[str] = None, **attributes):
+    """Starts a new trace with a root span; it is exported when the block exits."""
+    trace = Trace(correlation_id or str(uuid.uuid4()))
+    trace_token = _current_trace.set(trace)
+    # Spans of an enclosing trace (e.g. the request that queued a job) are not parents here.
+    span_token = _current_span.set(None)
+    try:
+        with span(name, correlation_id=trace.correlation_id, **attributes) as root:
+            trace.root = root
+            yield trace
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        export_trace(trace)
+
+def server_timing(trace: Trace) -> str:
+    """Formats the finished spans of a trace as a Server-Timing header, one entry per stage."""
+    totals = {}
+    for finished in trace.spans:
+        entry = totals.setdefault(finished.name, [0.0, 0])
+        entry[0] += finished.duration_ms
+        entry[1] += 1
+    parts = [
+        f'{name};dur={duration:.1f}' + (f';desc="{count}x"' if count > 1 else "")
+        for name, (duration, count) in totals.items()
+    ]
+    if trace.root is not None:
+        parts.append(f"total;dur={trace.root.duration_ms:.1f}")
+    return ", ".join(parts)
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> list:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+class _OtlpTrace:
+    """Serializes a trace as OTLP/JSON when the exporter thread writes it."""
+
+    def __init__(self, trace: Trace):
+        self.trace = trace
+
+    def __str__(self):
+        trace = self.trace
+        spans = [
+            {
+                "traceId": trace.trace_id,
+                "spanId": finished.span_id,
+                "parentSpanId": finished.parent_id or "",
+                "name": finished.name,
+                "kind": 2 if finished is trace.root else 1,  # SERVER for the root, else INTERNAL
+                "startTimeUnixNano": str(finished.start_ns),
+                "endTimeUnixNano": str(finished.end_ns),
+                "attributes": _otlp_attributes(finished.attributes),
+                "status": {"code": 2 if finished.error else 0},
+            }
+            for finished in trace.spans
+        ]
+        return json.dumps({"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": spans}],
+        }]})
+
+_export_queue = queue.SimpleQueue()
+_export_listener: Optional[QueueListener] = None
+
+def configure_exporter(exporter: str = TRACE_EXPORTER, path: str = TRACE_EXPORT_PATH):
+    """Starts the background writer for finished traces ("console", "file" or "none")."""
+    global _export_listener
+    shutdown_exporter()
+    if exporter == "none":
+        return
+    handler = logging.StreamHandler(sys.stdout) if exporter == "console" else logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _export_listener = QueueListener(_export_queue, handler)
+    _export_listener.start()
+
+def shutdown_exporter():
+    """Writes out queued traces and stops the exporter thread."""
+    global _export_listener
+    if _export_listener is not None:
+        _export_listener.stop()
+        for handler in _export_listener.handlers:
+            handler.close()
+        _export_listener = None
+
+def export_trace(trace: Trace):
+    if _export_listener is not None:
+        _export_queue.put_nowait(logging.makeLogRecord({"msg": _OtlpTrace(trace), "levelno": logging.INFO}))
+
+configure_exporter()
+atexit.register(shutdown_exporter)
+
+class TracingMiddleware:
+    """
+    ASGI middleware that runs each HTTP request in its own trace.
+
+    The correlation id comes from a valid inbound X-Request-ID header or is
+    generated, and is echoed back in X-Request-ID. A Server-Timing header
+    summarizes the stages finished by the time the response starts.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                candidate = value.decode("latin-1")
+                if REQUEST_ID_PATTERN.match(candidate):
+                    request_id = candidate
+                break
+
+        with start_trace("http.request", correlation_id=request_id, **{"http.method": scope["method"], "http.route": scope["path"]}) as trace:
+            async def send_with_headers(message):
+                if message["type"] == "http.response.start":
+                    trace.root.attributes["http.status_code"] = message["status"]
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-request-id", trace.correlation_id.encode("latin-1")))
+                    if SERVER_TIMING_ENABLED:
+                        headers.append((b"server-timing", server_timing(trace).encode("latin-1")))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_headers)
@@ -1,27 +1,101 @@
 # app/utils.py
+import hashlib
 import os
-import json
-import time
-import requests
-import boto3
+import tempfile
 from fastapi import HTTPException
 from io import BytesIO
-from urllib.parse import urlparse
-from app.config import STABILITY_KEY, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET
+from typing import BinaryIO
+from app.config import (
+    STREAM_CHUNK_SIZE,
+    STREAM_SPOOL_MAX_MEMORY,
+    S3_MULTIPART_THRESHOLD,
+)
 from app.logging_utils import setup_logging
+from app.stability import get_stability_client
 
 logger = setup_logging("app.utils")
 
-def send_async_generation_request(host: str, params: dict, files: dict = None):
+class SpooledBody:
+    """
+    Write-once buffer for an object body that is being streamed through the service.
+
+    Data stays in memory up to `max_memory` bytes and moves to an anonymous
+    temporary file beyond that, so peak memory per transfer is bounded. The
+    size and the ETag S3 will assign (MD5, or the multipart form when the body
+    reaches `part_size`) are computed while writing.
+    """
+
+    def __init__(self, max_memory: int = STREAM_SPOOL_MAX_MEMORY, part_size: int = S3_MULTIPART_THRESHOLD):
+        self.max_memory = max_memory
+        self.part_size = part_size
+        self.size = 0
+        self.file = BytesIO()
+        self._md5 = hashlib.md5(usedforsecurity=False)
+        self._part_md5 = hashlib.md5(usedforsecurity=False)
+        self._part_filled = 0
+        self._part_digests = []
+
+    def write(self, chunk: bytes):
+        if isinstance(self.file, BytesIO) and self.size + len(chunk) > self.max_memory:
+            spill = tempfile.TemporaryFile()
+            spill.write(self.file.getbuffer())
+            self.file = spill
+        self.file.write(chunk)
+        self.size += len(chunk)
+        self._md5.update(chunk)
+        view = memoryview(chunk)
+        while view:
+            take = min(len(view), self.part_size - self._part_filled)
+            self._part_md5.update(view[:take])
+            self._part_filled += take
+            view = view[take:]
+            if self._part_filled == self.part_size:
+                self._part_digests.append(self._part_md5.digest())
+                self._part_md5 = hashlib.md5(usedforsecurity=False)
+                self._part_filled = 0
+
+    @property
+    def etag(self) -> str:
+        if self.size < self.part_size:
+            return f'"{self._md5.hexdigest()}"'
+        digests = self._part_digests + ([self._part_md5.digest()] if self._part_filled else [])
+        return f'"{hashlib.md5(b"".join(digests), usedforsecurity=False).hexdigest()}-{len(digests)}"'
+
+    def rewind(self) -> BinaryIO:
+        """Returns the underlying file positioned at the start, ready to be read."""
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+async def spool_response_body(response) -> SpooledBody:
+    """Streams an httpx response body into a SpooledBody and closes the response."""
+    body = SpooledBody()
+    try:
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            body.write(chunk)
+    except BaseException:
+        body.close()
+        raise
+    finally:
+        await response.aclose()
+    return body
+
+def body_size(fileobj: BinaryIO) -> int:
+    """Returns the size of a seekable binary file without reading it."""
+    position = fileobj.tell()
+    size = fileobj.seek(0, os.SEEK_END)
+    fileobj.seek(position)
+    return size
+
+async def send_async_generation_request(host: str, params: dict, files: dict = None):
     """
     Sends an asynchronous generation request to the Stability API.
-    Polls until the generated image is ready.
+    Polls until the generated image is ready without blocking the event loop.
+    The result body is streamed; consume it with `spool_response_body`.
     """
     logger.info(f"Preparing to send generation request to {host}")
-    headers = {
-        "Accept": "application/json",
-        "Authorization": f"Bearer {STABILITY_KEY}"
-    }
     if files is None:
         files = {}
 
@@ -46,91 +120,4 @@ def send_async_generation_request(host: str, params: dict, files: dict = None):
         files["none"] = ''
         logger.info("No files provided; adding placeholder.")
 
-    logger.info(f"Sending REST request to {host} with params: {params} and files: {list(files.keys())}")
-    response = requests.post(host, headers=headers, files=files, data=params)
-    if not response.ok:
-        logger.error(f"Received error response: HTTP {response.status_code}: {response.text}")
-        raise Exception(f"HTTP {response.status_code}: {response.text}")
-
-    logger.info("Received initial response from generation request.")
-    response_dict = json.loads(response.text)
-    generation_id = response_dict.get("id", None)
-    if generation_id is None:
-        logger.error("No generation id found in response.")
-        raise Exception("Expected id in response")
-
-    # Poll until result or timeout.
-    timeout = int(os.getenv("WORKER_TIMEOUT", 500))
-    start = time.time()
-    status_code = 202
-    poll_url = f"https://api.stability.ai/v2beta/results/{generation_id}"
-    logger.info(f"Polling results at {poll_url}")
-    while status_code == 202:
-        logger.info(f"Polling at {poll_url}")
-        response = requests.get(poll_url, headers={**headers, "Accept": "*/*"})
-        if not response.ok:
-            logger.error(f"Polling error: HTTP {response.status_code}: {response.text}")
-            raise Exception(f"HTTP {response.status_code}: {response.text}")
-        status_code = response.status_code
-        time.sleep(10)
-        if time.time() - start > timeout:
-            logger.error(f"Polling timed out after {timeout} seconds")
-            raise Exception(f"Timeout after {timeout} seconds")
-    logger.info("Polling completed successfully.")
-    return response
-
-def download_image(url: str) -> BytesIO:
-    """
-    Downloads an image from an S3 URL using AWS credentials and returns a BytesIO object.
-    
-    Assumes the object is in the bucket defined by S3_BUCKET. Only extracts the object key from the URL.
-    
-    Args:
-        url (str): S3 object URL (e.g., "https://mybucket.s3.us-east-1.amazonaws.com/path/to/image.jpg")
-    
-    Returns:
-        BytesIO: In-memory bytes buffer containing the image.
-    
-    Raises:
-        HTTPException: If the object cannot be downloaded.
-    """
-    
-    logger.info(f"Starting download for image: {url}")
-    try:
-        url = str(url)
-        parsed = urlparse(url)
-        key = parsed.path.lstrip('/')
-        logger.info(f"Extracted S3 key: {key}")
-
-        # Create the S3 client using credentials.
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=os.getenv("AWS_DEFAULT_REGION", "us-east-1")
-        )
-
-        logger.info(f"Downloading image from bucket '{S3_BUCKET}', key: {key}")
-        response = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
-        content = response['Body'].read()
-        logger.info(f"Downloaded image of size {len(content)} bytes")
-        return BytesIO(content)
-    except Exception as e:
-        logger.error(f"Error downloading image from {url} - {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Error downloading image from {url}: {e}")
-
-def upload_bytes_to_s3(content: bytes, bucket_name: str, object_name: str) -> str:
-    """
-    Uploads binary image content to an S3 bucket and returns the object URL.
-    """
-    logger.info(f"Uploading file to S3: bucket='{bucket_name}', object_name='{object_name}'")
-    s3_client = boto3.client('s3')
-    try:
-        s3_client.put_object(Body=content, Bucket=bucket_name, Key=object_name, ContentType='image/png')
-        logger.info("File uploaded successfully to S3.")
-    except Exception as e:
-        logger.error(f"Error uploading file to S3: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to upload file: {e}")
-    url = f"https://{bucket_name}.s3.amazonaws.com/{object_name}"
-    logger.info(f"Constructed S3 URL: {url}")
-    return url
+    return await get_stability_client().generate(host, params, files)
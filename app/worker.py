@@ -0,0 +1,199 @@
+# app/worker.py
+"""
+Queue worker: `python -m app.worker`.
+
+Runs asynchronous jobs submitted while JOB_EXECUTION=queue. API processes
+only record jobs in the SQLite job database (JOB_STORE_PATH); any number of
+worker processes sharing that file claim and run them, so restarting or
+scaling the API does not lose or limit in-flight generations.
+"""
+import asyncio
+import os
+import signal
+import socket
+import time
+import uuid
+from typing import Optional
+from prometheus_client import start_http_server
+from app.config import (
+    JOB_WORKER_CONCURRENCY,
+    JOB_LEASE_SECONDS,
+    JOB_POLL_INTERVAL,
+    JOB_WORKER_METRICS_PORT,
+    SERVER_DRAIN_TIMEOUT,
+    validate_config,
+)
+from app.jobs import RUNNING, FAILED, SUCCEEDED, Job, JobRunner, SQLiteJobPersistence, create_job_persistence, job_error, notify_callback
+from app.logging_utils import setup_logging
+from app.metrics import (
+    JOB_AGE,
+    JOB_QUEUE_DEPTH,
+    JOB_QUEUE_LAG,
+    JOB_QUEUE_BACKLOG,
+    JOB_QUEUE_OLDEST_AGE,
+    JOB_REDELIVERIES,
+    mark_process_dead,
+)
+from app.pools import install_default_executor
+
+logger = setup_logging("app.worker")
+
+class JobWorker:
+    """
+    Claims queued jobs and runs up to `concurrency` of them at once.
+
+    Each claimed job is leased to this worker and the lease is renewed while
+    the job runs. If the worker dies, the lease runs out and another worker
+    claims the job again (up to JOB_MAX_ATTEMPTS deliveries). Final states
+    go to the same database the API reads job status from.
+    """
+
+    def __init__(
+        self,
+        queue: SQLiteJobPersistence,
+        runner: JobRunner,
+        concurrency: int = JOB_WORKER_CONCURRENCY,
+        lease: float = JOB_LEASE_SECONDS,
+        poll_interval: float = JOB_POLL_INTERVAL,
+        worker_id: Optional[str] = None,
+    ):
+        self.queue = queue
+        self.runner = runner
+        self.concurrency = concurrency
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks = set()
+
+    async def run(self, stop: asyncio.Event, drain_timeout: float = 0):
+        """
+        Runs jobs until `stop` is set, then waits up to `drain_timeout` seconds
+        for running jobs and hands the rest back to the queue.
+        """
+        stopped = asyncio.ensure_future(stop.wait())
+        try:
+            while not stop.is_set():
+                if len(self._tasks) >= self.concurrency:
+                    await asyncio.wait({stopped, *self._tasks}, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                job = await self._claim()
+                if job is None:
+                    await asyncio.to_thread(self._report_backlog)
+                    await asyncio.wait({stopped}, timeout=self.poll_interval)
+                    continue
+                task = asyncio.create_task(self._run(job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            stopped.cancel()
+            if self._tasks and drain_timeout > 0:
+                logger.info(f"Waiting up to {drain_timeout} seconds for {len(self._tasks)} jobs to finish")
+                await asyncio.wait(list(self._tasks), timeout=drain_timeout)
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _claim(self) -> Optional[Job]:
+        try:
+            job = await asyncio.to_thread(self.queue.claim, self.worker_id, self.lease)
+        except Exception as e:
+            logger.error(f"Failed to claim a job: {str(e)}")
+            return None
+        if job is None:
+            return None
+        if job.attempts > 1:
+            JOB_REDELIVERIES.inc()
+            logger.warning(f"Job {job.job_id} redelivered (attempt {job.attempts})")
+        else:
+            JOB_QUEUE_LAG.observe(max(0.0, time.time() - job.created_at))
+        return job
+
+    def _report_backlog(self):
+        try:
+            backlog, oldest = self.queue.queue_stats()
+        except Exception as e:
+            logger.error(f"Failed to read queue statistics: {str(e)}")
+            return
+        JOB_QUEUE_BACKLOG.set(backlog)
+        JOB_QUEUE_OLDEST_AGE.set(time.time() - oldest if oldest is not None else 0)
+
+    async def _run(self, job: Job):
+        logger.info(f"Claimed job {job.job_id}")
+        JOB_QUEUE_DEPTH.labels(status=RUNNING).inc()
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            try:
+                job.result = await self.runner(job)
+                job.status = SUCCEEDED
+            except asyncio.CancelledError:
+                # Shutting down: hand the job to another worker rather than waiting for the lease to run out.
+                await asyncio.to_thread(self.queue.release, job.job_id, self.worker_id)
+                logger.info(f"Returned job {job.job_id} to the queue")
+                raise
+            except Exception as e:
+                logger.error(f"Job {job.job_id} failed: {str(e)}")
+                job.status, job.error = FAILED, job_error(e)
+            job.updated_at = time.time()
+            if not await asyncio.to_thread(self.queue.finish, job, self.worker_id):
+                logger.warning(f"Lost the lease on job {job.job_id}; its result was discarded")
+                return
+        finally:
+            heartbeat.cancel()
+            JOB_QUEUE_DEPTH.labels(status=RUNNING).dec()
+        JOB_AGE.labels(status=job.status).observe(job.updated_at - job.created_at)
+        if job.callback_url:
+            await notify_callback(job)
+
+    async def _heartbeat(self, job: Job):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                renewed = await asyncio.to_thread(self.queue.renew, job.job_id, self.worker_id, self.lease)
+            except Exception as e:
+                logger.error(f"Failed to renew the lease on job {job.job_id}: {str(e)}")
+                continue
+            if not renewed:
+                logger.warning(f"Lease on job {job.job_id} was taken over by another worker")
+                return
+
+async def serve():
+    # Imported here so the module stays cheap to import for tests and tooling.
+    from app.api import run_replace_background_relight_job
+    from app.imaging import shutdown_image_executor, warm_up_image_executor
+    from app.stability import close_stability_client, get_stability_client
+    from app.storage import get_storage
+
+    validate_config()
+    install_default_executor()
+    queue = create_job_persistence()
+    if not isinstance(queue, SQLiteJobPersistence):
+        raise RuntimeError("app.worker needs JOB_STORE_BACKEND=sqlite")
+    if JOB_WORKER_METRICS_PORT:
+        start_http_server(JOB_WORKER_METRICS_PORT)
+    await asyncio.gather(
+        asyncio.to_thread(get_storage().warm_up),
+        get_stability_client().warm_up(),
+        asyncio.to_thread(warm_up_image_executor),
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    worker = JobWorker(queue, run_replace_background_relight_job)
+    logger.info(f"Worker {worker.worker_id} running up to {worker.concurrency} jobs from {queue.path}")
+    try:
+        await worker.run(stop, drain_timeout=SERVER_DRAIN_TIMEOUT)
+    finally:
+        await close_stability_client()
+        await asyncio.to_thread(shutdown_image_executor)
+        queue.close()
+        mark_process_dead()
+    logger.info(f"Worker {worker.worker_id} stopped")
+
+def main():
+    asyncio.run(serve())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Throughput and tail latency of /api/v1/replace-background-relight under load.
+
+Starts a fake Stability API and a moto S3 server (or, with --storage local,
+keeps objects in a temporary directory instead), runs the real service under
+uvicorn in a subprocess pointed at them, and drives it with closed-loop
+concurrent clients at each concurrency level. Reports requests per second,
+p50/p95/p99 latency, status codes, and the service process's peak RSS,
+thread count and open sockets:
+
+    pip install "moto[server]"
+    python -m benchmarks.bench_load --concurrency 1,8,32 --duration 10 \\
+        --generation-delay 0.5 --error-rate 0.01 --rate-limit-rate 0.05
+
+The fakes and the load generator share this process, so compare runs made on
+the same machine rather than reading the numbers as absolute capacity.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from io import BytesIO
+import httpx
+
+def process_stats(pid: int) -> dict:
+    """Current RSS (MiB), thread count and open sockets of a process, from /proc."""
+    stats = {"rss_mb": 0.0, "threads": 0, "sockets": 0}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    stats["rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith("Threads:"):
+                    stats["threads"] = int(line.split()[1])
+        fd_dir = f"/proc/{pid}/fd"
+        for fd in os.listdir(fd_dir):
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)).startswith("socket:"):
+                    stats["sockets"] += 1
+            except OSError:
+                pass
+    except OSError:
+        pass
+    return stats
+
+async def sample_stats(pid: int, peaks: dict, interval: float = 0.2):
+    while True:
+        for name, value in process_stats(pid).items():
+            peaks[name] = max(peaks.get(name, 0), value)
+        await asyncio.sleep(interval)
+
+async def client_loop(client, url, payload, deadline, latencies, statuses):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await client.post(url, json=payload)
+            statuses[response.status_code] += 1
+        except httpx.HTTPError as e:
+            statuses[type(e).__name__] += 1
+            continue
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - start)
+
+async def run_level(base_url, payload, concurrency, duration, pid) -> dict:
+    latencies, statuses, peaks = [], Counter(), {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        sampler = asyncio.create_task(sample_stats(pid, peaks))
+        start = time.monotonic()
+        deadline = start + duration
+        await asyncio.gather(*[
+            client_loop(client, "/api/v1/replace-background-relight", payload, deadline, latencies, statuses)
+            for _ in range(concurrency)
+        ])
+        elapsed = time.monotonic() - start
+        sampler.cancel()
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) >= 2 else [float("nan")] * 99
+    return {
+        "concurrency": concurrency,
+        "rps": len(latencies) / elapsed,
+        "p50": quantiles[49],
+        "p95": quantiles[94],
+        "p99": quantiles[98],
+        "statuses": dict(statuses),
+        **peaks,
+    }
+
+def wait_until_healthy(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Service exited during startup")
+        try:
+            if httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("Service did not become healthy")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per concurrency level")
+    parser.add_argument("--generation-delay", type=float, default=0.5, help="Seconds the fake Stability API takes per generation")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of submits that fail with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of Stability calls answered with 429")
+    parser.add_argument("--service-logs", action="store_true", help="Show the service's own log output")
+    parser.add_argument("--image-size", type=int, default=512, help="Side of the square input image in pixels")
+    parser.add_argument("--storage", choices=["s3", "local"], default="s3", help="Storage backend; local needs no moto server")
+    args = parser.parse_args()
+
+    from PIL import Image
+    from benchmarks.servers import FakeS3, ThreadedASGIServer, free_port
+    from tests.fake_stability import create_fake_stability_app
+
+    buffer = BytesIO()
+    Image.effect_noise((args.image_size, args.image_size), 30).convert("RGB").save(buffer, "PNG")
+    s3 = FakeS3().start() if args.storage == "s3" else None
+    storage_dir = tempfile.TemporaryDirectory()
+    stability = ThreadedASGIServer(create_fake_stability_app(
+        polls_until_ready=0,
+        image=buffer.getvalue(),
+        generation_delay=args.generation_delay,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=0,
+    )).start()
+    port = free_port()
+    env = {
+        **os.environ,
+        "STABILITY_KEY": "benchmark",
+        "STABILITY_API_HOST": stability.url,
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "POLL_INITIAL_DELAY": str(max(0.05, args.generation_delay)),
+        "POLL_MAX_DELAY": "1",
+        # One vendor drives all the load; keep admission control out of the measurement.
+        "VENDOR_RATE": "1000000",
+        "VENDOR_BURST": "1000000",
+        "VENDOR_MAX_QUEUE": "1000000",
+        "LOG_LEVEL": "WARNING",
+    }
+    base_url = f"http://127.0.0.1:{port}"
+    if s3 is not None:
+        env.update({"S3_ENDPOINT_URL": s3.url, "S3_BUCKET": s3.bucket})
+        subject_url = s3.put("inputs/subject.png", buffer.getvalue())
+    else:
+        env.update({"STORAGE_BACKEND": "local", "STORAGE_LOCAL_ROOT": storage_dir.name, "STORAGE_PUBLIC_URL": base_url, "S3_BUCKET": "bench"})
+        os.makedirs(os.path.join(storage_dir.name, "bench", "inputs"))
+        with open(os.path.join(storage_dir.name, "bench", "inputs", "subject.png"), "wb") as f:
+            f.write(buffer.getvalue())
+        subject_url = f"{base_url}/api/v1/storage/bench/inputs/subject.png"
+    service = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=None if args.service_logs else subprocess.DEVNULL
+    )
+    try:
+        payload = {
+            "subject_image": subject_url,
+            "background_prompt": "a sunny beach",
+            "username": "loadtest",
+        }
+        wait_until_healthy(base_url, service)
+        print(f"generation delay {args.generation_delay}s, error rate {args.error_rate}, 429 rate {args.rate_limit_rate}, "
+              f"{args.duration:g}s per level")
+        print(f"{'conc':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rss MiB':>8} {'threads':>8} {'sockets':>8}  statuses")
+        for concurrency in (int(level) for level in args.concurrency.split(",")):
+            result = asyncio.run(run_level(base_url, payload, concurrency, args.duration, service.pid))
+            print(f"{result['concurrency']:>5} {result['rps']:8.1f} {result['p50'] * 1000:8.0f} {result['p95'] * 1000:8.0f} "
+                  f"{result['p99'] * 1000:8.0f} {result.get('rss_mb', 0):8.1f} {result.get('threads', 0):8} "
+                  f"{result.get('sockets', 0):8}  {result['statuses']}")
+    finally:
+        service.terminate()
+        service.wait()
+        stability.stop()
+        if s3 is not None:
+            s3.stop()
+        storage_dir.cleanup()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Per-call cost of a typical request log line on the calling (event loop) thread.
+
+Compares writing synchronously from the caller (LOG_QUEUE=false) with the
+queued pipeline, where formatting and I/O happen on the listener thread and the
+request payload is passed as a Lazy extra. Output goes to /dev/null:
+
+    python -m benchmarks.bench_logging --calls 20000
+"""
+import argparse
+import logging
+import os
+import time
+
+def build_input():
+    from app.models import ReplaceBackgroundRelightInput
+    return ReplaceBackgroundRelightInput(
+        subject_image="https://example.com/subject.png",
+        background_prompt="a sunny beach at golden hour",
+        background_reference="https://example.com/backdrop.png",
+        light_source_direction="left",
+        seed=42,
+    )
+
+def run(logger, calls, lazy):
+    from app.logging_utils import Lazy
+    input = build_input()
+    start = time.perf_counter()
+    for i in range(calls):
+        logger.info("Received request", extra={
+            "correlation_id": str(i),
+            "vendor_id": "benchmark",
+            "input": Lazy(input.model_dump, mode="json") if lazy else input.model_dump()
+        })
+    return (time.perf_counter() - start) / calls * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+
+    # Every call is distinct, so the duplicate filter does not hide any of the work.
+    os.environ["LOG_DEDUP_TIMEOUT"] = "0"
+    from app import logging_utils
+
+    devnull = open(os.devnull, "w")
+    results = {}
+
+    os.environ["LOG_QUEUE"] = "false"
+    sync_logger = logging_utils.setup_logging("bench.sync")
+    sync_logger.handlers[0].setStream(devnull)
+    results["sync, eager extras"] = run(sync_logger, args.calls, lazy=False)
+
+    os.environ["LOG_QUEUE"] = "true"
+    queued_logger = logging_utils.setup_logging("bench.queued")
+    logging_utils._output_handler.setStream(devnull)
+    results["queued, lazy extras"] = run(queued_logger, args.calls, lazy=True)
+    drain_start = time.perf_counter()
+    logging_utils.stop_log_listener()
+    drain = time.perf_counter() - drain_start
+
+    queued_logger.setLevel(logging.WARNING)
+    results["queued, level disabled"] = run(queued_logger, args.calls, lazy=True)
+
+    for name, micros in results.items():
+        print(f"{name:>24}: {micros:7.2f} us per call on the caller thread")
+    print(f"listener drained the remaining backlog in {drain * 1000:.0f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Peak RSS per concurrent request: fully buffered transfers vs. the streaming path.
+
+Each simulated request downloads one input image from S3, sends it to a fake
+Stability API, reads back a result of the same size and uploads it to S3.
+"buffered" reads every body into memory the way the service used to;
+"streaming" uses download_image/spool_response_body/upload_bytes_to_s3. Each
+mode runs in its own subprocess so their peak RSS does not mix:
+
+    pip install "moto[server]"
+    python -m benchmarks.bench_memory --size-mb 20 --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+
+def peak_rss_mb() -> float:
+    # VmHWM is per address space; ru_maxrss would include the parent's peak from before exec.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def buffered_request(client, endpoint, bucket, key, index):
+    from io import BytesIO
+    from app.s3 import get_s3_client
+    s3 = get_s3_client()
+    content = await asyncio.to_thread(lambda: s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+    files = {"subject_image": ("subject_image", BytesIO(content), "application/octet-stream")}
+    response = await client.generate(endpoint, {"output_format": "png"}, files)
+    result = await response.aread()
+    await asyncio.to_thread(s3.put_object, Body=result, Bucket=bucket, Key=f"outputs/{index}.png")
+
+async def streaming_request(client, endpoint, bucket, key, index):
+    from app.storage import download_image, upload_bytes_to_s3
+    from app.utils import spool_response_body
+    subject = await asyncio.to_thread(download_image, f"https://{bucket}.s3.amazonaws.com/{key}")
+    files = {"subject_image": ("subject_image", subject, "application/octet-stream")}
+    response = await client.generate(endpoint, {"output_format": "png"}, files)
+    body = await spool_response_body(response)
+    try:
+        await asyncio.to_thread(upload_bytes_to_s3, body.rewind(), bucket, f"outputs/{index}.png")
+    finally:
+        body.close()
+
+async def run_child(mode, concurrency, bucket, key):
+    from app.stability import get_stability_client
+    client = get_stability_client()
+    endpoint = f"{client.base_url}/v2beta/stable-image/edit/replace-background-and-relight"
+    request = buffered_request if mode == "buffered" else streaming_request
+    # Warm up imports, pools and clients before taking the baseline.
+    await request(client, endpoint, bucket, key, "warmup")
+    baseline = peak_rss_mb()
+    await asyncio.gather(*[request(client, endpoint, bucket, key, i) for i in range(concurrency)])
+    peak = peak_rss_mb()
+    await client.aclose()
+    print(json.dumps({"mode": mode, "baseline_mb": baseline, "peak_mb": peak}))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--spool-mb", type=float, default=1, help="STREAM_SPOOL_MAX_MEMORY for the streaming mode")
+    parser.add_argument("--child", choices=["buffered", "streaming"], help=argparse.SUPPRESS)
+    parser.add_argument("--bucket", help=argparse.SUPPRESS)
+    parser.add_argument("--key", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        asyncio.run(run_child(args.child, args.concurrency, args.bucket, args.key))
+        return
+
+    from benchmarks.servers import FakeS3, ThreadedASGIServer
+    from tests.fake_stability import create_fake_stability_app
+
+    size = int(args.size_mb * 1024 * 1024)
+    payload = os.urandom(size)
+    s3 = FakeS3().start()
+    stability = ThreadedASGIServer(create_fake_stability_app(polls_until_ready=1, image=payload)).start()
+    try:
+        s3.put("inputs/subject.png", payload)
+        env = {
+            **os.environ,
+            "STABILITY_KEY": "benchmark",
+            "STABILITY_API_HOST": stability.url,
+            "S3_ENDPOINT_URL": s3.url,
+            "S3_BUCKET": s3.bucket,
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+            "IMAGE_CACHE_ENABLED": "false",
+            "STREAM_SPOOL_MAX_MEMORY": str(int(args.spool_mb * 1024 * 1024)),
+            "S3_MULTIPART_THRESHOLD": str(5 * 1024 * 1024),
+            "POLL_INITIAL_DELAY": "0.05",
+            "LOG_LEVEL": "ERROR",
+        }
+        print(f"{args.concurrency} concurrent requests, {args.size_mb:g} MiB input and output per request")
+        results = {}
+        for mode in ("buffered", "streaming"):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_memory", "--child", mode,
+                 "--concurrency", str(args.concurrency), "--bucket", s3.bucket, "--key", "inputs/subject.png"],
+                env=env, capture_output=True, text=True, check=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            per_request = (result["peak_mb"] - result["baseline_mb"]) / args.concurrency
+            results[mode] = per_request
+            print(f"{mode:>10}: peak RSS {result['peak_mb']:8.1f} MiB  "
+                  f"(+{result['peak_mb'] - result['baseline_mb']:.1f} MiB, {per_request:.1f} MiB per concurrent request)")
+        if results["buffered"] > 0:
+            print(f"streaming uses {(1 - results['streaming'] / results['buffered']) * 100:.0f}% less memory per concurrent request")
+    finally:
+        stability.stop()
+        s3.stop()
+
+if __name__ == "__main__":
+    main()
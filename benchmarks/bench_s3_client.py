@@ -0,0 +1,80 @@
+"""
+Per-request S3 overhead: a fresh boto3 client per call vs. the shared client.
+
+Each simulated request performs three downloads and one upload, matching
+`replace_background_relight`. Runs against a local moto S3 server, so no AWS
+account is needed:
+
+    pip install "moto[server]"
+    python -m benchmarks.bench_s3_client --requests 200
+"""
+import argparse
+import logging
+import os
+import statistics
+import time
+
+os.environ.setdefault("STABILITY_KEY", "benchmark")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+BUCKET = "benchmark-bucket"
+KEYS = ["inputs/subject.png", "inputs/background.png", "inputs/light.png"]
+PAYLOAD = b"\x89PNG\r\n\x1a\n" + os.urandom(256 * 1024)
+
+def per_call_request(endpoint_url):
+    # What app.utils did before: a new client for every download and upload.
+    for key in KEYS:
+        client = boto3.client("s3", endpoint_url=endpoint_url, region_name="us-east-1")
+        client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+    client = boto3.client("s3", endpoint_url=endpoint_url, region_name="us-east-1")
+    client.put_object(Body=PAYLOAD, Bucket=BUCKET, Key="outputs/result.png", ContentType="image/png")
+
+def shared_request(client):
+    for key in KEYS:
+        client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+    client.put_object(Body=PAYLOAD, Bucket=BUCKET, Key="outputs/result.png", ContentType="image/png")
+
+def measure(label, fn, requests):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"{label:>10}: mean {statistics.mean(timings):7.2f} ms  "
+          f"p50 {timings[len(timings) // 2]:7.2f} ms  p95 {timings[int(len(timings) * 0.95)]:7.2f} ms")
+    return statistics.mean(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--port", type=int, default=5055)
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+    endpoint_url = f"http://127.0.0.1:{args.port}"
+    os.environ["S3_ENDPOINT_URL"] = endpoint_url
+    try:
+        setup = boto3.client("s3", endpoint_url=endpoint_url, region_name="us-east-1")
+        setup.create_bucket(Bucket=BUCKET)
+        for key in KEYS:
+            setup.put_object(Body=PAYLOAD, Bucket=BUCKET, Key=key)
+
+        from app.s3 import get_s3_client
+        shared = get_s3_client()
+
+        print(f"{args.requests} requests x (3 downloads + 1 upload), {len(PAYLOAD) // 1024} KiB objects")
+        before = measure("per-call", lambda: per_call_request(endpoint_url), args.requests)
+        after = measure("shared", lambda: shared_request(shared), args.requests)
+        print(f"saved {before - after:.2f} ms per request ({(1 - after / before) * 100:.0f}%)")
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
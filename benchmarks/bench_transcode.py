@@ -0,0 +1,51 @@
+"""
+Bytes saved vs. CPU time for each output format and quality preset.
+
+Encodes one image (a synthetic photo-like 1024x1024 picture by default, or
+--image) with every format/preset combination used by post-processing and
+compares it with the lossless PNG that Stability returns when transcoding
+is enabled:
+
+    python -m benchmarks.bench_transcode --image result.png --repeat 5
+"""
+import argparse
+import time
+from io import BytesIO
+from PIL import Image, ImageFilter
+from app.imaging import QUALITY_PRESETS, encode_image
+
+def synthetic_image(size: int) -> Image.Image:
+    # Smooth regions, sharp detail and sensor-like noise, roughly like a generated photo.
+    base = Image.merge("RGB", (
+        Image.radial_gradient("L").resize((size, size)),
+        Image.linear_gradient("L").resize((size, size)),
+        Image.effect_mandelbrot((size, size), (-2.0, -1.5, 1.0, 1.5), 64),
+    ))
+    noise = Image.effect_noise((size, size), 12).convert("RGB")
+    return Image.blend(base.filter(ImageFilter.GaussianBlur(1)), noise, 0.15)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="Image to encode instead of the synthetic one")
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB") if args.image else synthetic_image(args.size)
+    image.load()
+    baseline = BytesIO()
+    image.save(baseline, "PNG")
+    baseline_size = baseline.tell()
+    print(f"{image.width}x{image.height} image, lossless PNG baseline {baseline_size / 1024:.0f} KiB")
+    print(f"{'format':>6} {'preset':>9} {'KiB':>8} {'saved':>7} {'ms':>8}")
+    for format in ("png", "jpeg", "webp"):
+        for preset in QUALITY_PRESETS:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                content = encode_image(image, format, preset)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            saved = 1 - len(content) / baseline_size
+            print(f"{format:>6} {preset:>9} {len(content) / 1024:8.0f} {saved:7.0%} {elapsed * 1000:8.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Local stand-ins for external services, started in background threads for benchmarks."""
+import logging
+import socket
+import threading
+import time
+import boto3
+import uvicorn
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class ThreadedASGIServer:
+    """Runs an ASGI app under uvicorn on a background thread."""
+
+    def __init__(self, app, port: int = 0):
+        self.port = port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="error"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self._server.should_exit = True
+        self._thread.join()
+
+class FakeS3:
+    """A moto S3 server with one bucket (requires `pip install "moto[server]"`)."""
+
+    def __init__(self, bucket: str = "benchmark-bucket", port: int = 0):
+        from moto.server import ThreadedMotoServer
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.bucket = bucket
+        self.port = port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._server = ThreadedMotoServer(port=self.port, verbose=False)
+
+    def start(self):
+        self._server.start()
+        self.client().create_bucket(Bucket=self.bucket)
+        return self
+
+    def client(self):
+        return boto3.client(
+            "s3", endpoint_url=self.url, region_name="us-east-1",
+            aws_access_key_id="benchmark", aws_secret_access_key="benchmark"
+        )
+
+    def put(self, key: str, data: bytes):
+        self.client().put_object(Bucket=self.bucket, Key=key, Body=data)
+        return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+
+    def stop(self):
+        self._server.stop()
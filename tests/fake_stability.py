@@ -0,0 +1,79 @@
+# tests/fake_stability.py
+import random
+import time
+import uuid
+from typing import Optional
+from fastapi import FastAPI, Request, Response
+
+# Minimal PNG payload returned for every finished generation.
+FAKE_IMAGE = b'\x89PNG\r\n\x1a\n' + b'\x00' * 100
+
+def create_fake_stability_app(
+    polls_until_ready: int = 1,
+    submit_status: int = 200,
+    image: bytes = FAKE_IMAGE,
+    generation_delay: float = 0.0,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    retry_after: int = 1,
+    seed: Optional[int] = None,
+    finish_reason: str = "SUCCESS",
+    result_status: int = 200,
+):
+    """
+    Builds an in-process stand-in for the Stability v2beta API.
+
+    Generations report 202 until they have been polled `polls_until_ready`
+    times and `generation_delay` seconds have passed, and then return `image`
+with `result_status` and the `finish_reason` header.
+    A fraction `error_rate` of submits fail with 500, and a fraction
+    `rate_limit_rate` of submits and polls get 429 with a Retry-After header.
+    The returned app keeps simple counters in `app.state` so tests can assert
+    on how the client talked to it.
+    """
+    app = FastAPI()
+    app.state.generations = {}
+    app.state.submits = 0
+    app.state.polls = 0
+    app.state.errors = 0
+    app.state.rate_limited = 0
+    rng = random.Random(seed)
+
+    def rate_limited():
+        if rate_limit_rate and rng.random() < rate_limit_rate:
+            app.state.rate_limited += 1
+            return Response(status_code=429, content=b'{"errors": ["rate limited"]}', headers={"Retry-After": str(retry_after)})
+        return None
+
+    @app.post("/v2beta/stable-image/edit/{operation}")
+    async def submit(operation: str, request: Request):
+        await request.body()
+        app.state.submits += 1
+        if submit_status != 200:
+            return Response(status_code=submit_status, content=b'{"errors": ["rejected"]}')
+        limited = rate_limited()
+        if limited:
+            return limited
+        if error_rate and rng.random() < error_rate:
+            app.state.errors += 1
+            return Response(status_code=500, content=b'{"errors": ["internal error"]}')
+        generation_id = uuid.uuid4().hex
+        app.state.generations[generation_id] = {"polls": 0, "ready_at": time.monotonic() + generation_delay}
+        return {"id": generation_id}
+
+    @app.get("/v2beta/results/{generation_id}")
+    async def result(generation_id: str):
+        app.state.polls += 1
+        generation = app.state.generations.get(generation_id)
+        if generation is None:
+            return Response(status_code=404, content=b'{"errors": ["not found"]}')
+        limited = rate_limited()
+        if limited:
+            return limited
+        generation["polls"] += 1
+        if generation["polls"] <= polls_until_ready or time.monotonic() < generation["ready_at"]:
+            return Response(status_code=202, content=f'{{"id": "{generation_id}", "status": "in-progress"}}')
+        del app.state.generations[generation_id]
+        return Response(status_code=result_status, content=image, media_type="image/png", headers={"finish-reason": finish_reason})
+
+    return app
@@ -2,6 +2,7 @@
 import os
 from io import BytesIO
 from fastapi.testclient import TestClient
+from PIL import Image
 from app.main import app
 
 client = TestClient(app)
@@ -17,8 +18,17 @@ class DummyResponse:
         if self.status_code >= 400:
             raise Exception(f"HTTP {self.status_code} Error")
 
-# Dummy function to simulate the Stability API call.
-def dummy_send_async_generation_request(host, params, files):
+    # Streaming interface used to pipe the result body into S3.
+    async def aiter_bytes(self, chunk_size=None):
+        chunk_size = chunk_size or len(self.content) or 1
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    async def aclose(self):
+        pass
+
+# Dummy coroutine to simulate the Stability API call.
+async def dummy_send_async_generation_request(host, params, files):
     # Simulate image generation by returning dummy PNG bytes.
     dummy_image_data = b'\x89PNG\r\n\x1a\n' + b'\x00' * 100
     # Include a finish reason header to simulate success.
@@ -26,14 +36,22 @@ def dummy_send_async_generation_request(host, params, files):
     return DummyResponse(dummy_image_data, status_code=200, headers=headers)
 
 # Dummy function to simulate uploading bytes to S3.
-def dummy_upload_bytes_to_s3(content, bucket_name, object_name):
+def dummy_upload_bytes_to_s3(content, bucket_name, object_name, content_type="image/png", cache_control=None):
     # Return a fake S3 URL based on the bucket and object name.
     return f"https://{bucket_name}.s3.amazonaws.com/{object_name}"
 
+# A small but valid PNG, so inputs pass preprocessing.
+def make_png(size=(64, 64)):
+    buffer = BytesIO()
+    Image.new("RGB", size, "white").save(buffer, "PNG")
+    return buffer.getvalue()
+
+DUMMY_PNG = make_png()
+
 # Dummy function to simulate downloading an image.
 def dummy_download_image(url):
     # Return a BytesIO with dummy PNG data.
-    return BytesIO(b'\x89PNG\r\n\x1a\n' + b'\x00' * 100)
+    return BytesIO(DUMMY_PNG)
 
 def test_replace_background_relight(monkeypatch):
     # Patch functions in the utils module.
@@ -61,7 +79,7 @@ def test_replace_background_relight(monkeypatch):
       "username": "user1"
     }
     
-    response = client.post("/replace-background-relight", json=payload)
+    response = client.post("/api/v1/replace-background-relight", json=payload)
     
     # Check that the endpoint returns HTTP 200 and the JSON contains the S3 URL.
     assert response.status_code == 200, f"Unexpected status code: {response.status_code}"
@@ -69,3 +87,293 @@ def test_replace_background_relight(monkeypatch):
     assert "s3_url" in json_resp, "Response JSON does not contain 's3_url'"
     assert json_resp["s3_url"].startswith("https://"), "S3 URL does not start with 'https://'"
 
+def test_input_images_are_downloaded_concurrently(monkeypatch):
+    import threading
+    from app import api
+    # Each download waits for the other two; a sequential fetch would time out here.
+    barrier = threading.Barrier(3, timeout=5)
+
+    def concurrent_download_image(url):
+        barrier.wait()
+        return dummy_download_image(url)
+
+    monkeypatch.setattr(api, "send_async_generation_request", dummy_send_async_generation_request)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", dummy_upload_bytes_to_s3)
+    monkeypatch.setattr(api, "download_image", concurrent_download_image)
+
+    response = client.post("/api/v1/replace-background-relight", json={
+        "subject_image": "https://example.com/example.png",
+        "background_prompt": "a smooth pink pastel backdrop",
+        "background_reference": "https://example.com/backdrop.jpg",
+        "light_reference": "https://example.com/light.png",
+        "light_source_strength": 0.3
+    })
+    assert response.status_code == 200
+
+def test_failed_input_download_returns_its_error(monkeypatch):
+    from app import api
+
+    def failing_download_image(url):
+        if "backdrop" in str(url):
+            raise Exception("background missing")
+        return dummy_download_image(url)
+
+    monkeypatch.setattr(api, "download_image", failing_download_image)
+
+    response = client.post("/api/v1/replace-background-relight", json={
+        "subject_image": "https://example.com/example.png",
+        "background_prompt": "a smooth pink pastel backdrop",
+        "background_reference": "https://example.com/backdrop.jpg"
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"] == "background missing"
+
+def test_corrupt_input_image_is_rejected_before_generation(monkeypatch):
+    from app import api
+    calls = []
+
+    async def counting_send(host, params, files):
+        calls.append(host)
+        return await dummy_send_async_generation_request(host, params, files)
+
+    monkeypatch.setattr(api, "download_image", lambda url: BytesIO(DUMMY_PNG[:40]))
+    monkeypatch.setattr(api, "send_async_generation_request", counting_send)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", dummy_upload_bytes_to_s3)
+
+    response = client.post("/api/v1/replace-background-relight", json={
+        "subject_image": "https://example.com/example.png",
+        "background_prompt": "a beach"
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Invalid subject image")
+    assert calls == []
+
+def test_output_is_transcoded_with_thumbnails_and_content_type(monkeypatch):
+    from app import api
+    requested_formats = []
+    uploads = {}
+
+    async def png_send(host, params, files):
+        requested_formats.append(params["output_format"])
+        return DummyResponse(make_png((256, 256)), headers={"finish-reason": "SUCCESS"})
+
+    def recording_upload(content, bucket_name, object_name, content_type="image/png", cache_control=None):
+        uploads[object_name] = (content_type, cache_control)
+        return dummy_upload_bytes_to_s3(content, bucket_name, object_name)
+
+    monkeypatch.setattr(api, "download_image", dummy_download_image)
+    monkeypatch.setattr(api, "send_async_generation_request", png_send)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", recording_upload)
+    monkeypatch.setattr(api, "OUTPUT_TRANSCODE_ENABLED", True)
+    monkeypatch.setattr(api, "OUTPUT_THUMBNAIL_SIZES", [64])
+
+    response = client.post("/api/v1/replace-background-relight", json={
+        "subject_image": "https://example.com/example.png",
+        "background_prompt": "a beach",
+        "output_format": "webp"
+    })
+    assert response.status_code == 200
+    assert requested_formats == ["png"]
+    filename = response.json()["s3_url"].rsplit("/", 1)[-1]
+    assert uploads[f"transformed_images/{filename}"][0] == "image/webp"
+    assert uploads[f"transformed_images/thumbnails/64/{filename}"][0] == "image/webp"
+    assert "immutable" in uploads[f"transformed_images/{filename}"][1]
+
+def test_vendor_over_its_rate_limit_gets_429(monkeypatch):
+    from app import api
+    from app.scheduler import FairScheduler
+    monkeypatch.setattr(api, "download_image", dummy_download_image)
+    monkeypatch.setattr(api, "send_async_generation_request", dummy_send_async_generation_request)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", dummy_upload_bytes_to_s3)
+    monkeypatch.setattr(api, "generation_scheduler", FairScheduler(vendor_rate=0.1, vendor_burst=1))
+
+    payload = {"subject_image": "https://example.com/example.png", "background_prompt": "a beach", "username": "greedy"}
+    assert client.post("/api/v1/replace-background-relight", json=payload).status_code == 200
+    response = client.post("/api/v1/replace-background-relight", json=payload)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+def test_deterministic_request_is_served_from_result_cache(monkeypatch):
+    from app import api
+    from app.result_cache import ResultCache
+    calls = []
+
+    async def counting_send_async_generation_request(host, params, files):
+        calls.append(params)
+        return await dummy_send_async_generation_request(host, params, files)
+
+    monkeypatch.setattr(api, "RESULT_CACHE_ENABLED", True)
+    monkeypatch.setattr(api, "result_cache", ResultCache())
+    monkeypatch.setattr(api, "send_async_generation_request", counting_send_async_generation_request)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", dummy_upload_bytes_to_s3)
+    monkeypatch.setattr(api, "download_image", dummy_download_image)
+
+    payload = {
+        "subject_image": "https://example.com/example.png",
+        "background_prompt": "a smooth pink pastel backdrop",
+        "seed": 42
+    }
+    first = client.post("/api/v1/replace-background-relight", json={**payload, "username": "user1"})
+    second = client.post("/api/v1/replace-background-relight", json={**payload, "username": "user1"})
+    assert first.headers["X-Result-Cache"] == "MISS"
+    assert second.headers["X-Result-Cache"] == "HIT"
+    assert second.json() == first.json()
+    assert len(calls) == 1
+
+    # Results carry the requester's name; another vendor gets a generation of its own.
+    other = client.post("/api/v1/replace-background-relight", json={**payload, "username": "user2"})
+    assert other.headers["X-Result-Cache"] == "MISS"
+    assert "user2_" in other.json()["s3_url"]
+    assert len(calls) == 2
+
+def test_job_is_submitted_and_completes(monkeypatch):
+    import asyncio
+    import time
+    from app import api, main
+    from app.jobs import JobStore, InMemoryJobPersistence
+    monkeypatch.setattr(main, "warm_up_clients", lambda: asyncio.sleep(0))
+    monkeypatch.setattr(api, "get_job_store", lambda store=JobStore(InMemoryJobPersistence()): store)
+    monkeypatch.setattr(api, "send_async_generation_request", dummy_send_async_generation_request)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", dummy_upload_bytes_to_s3)
+    monkeypatch.setattr(api, "download_image", dummy_download_image)
+
+    with TestClient(app) as job_client:
+        submitted = job_client.post("/api/v1/jobs/replace-background-relight", json={
+            "subject_image": "https://example.com/example.png",
+            "background_prompt": "a smooth pink pastel backdrop"
+        })
+        assert submitted.status_code == 202
+        job_id = submitted.json()["job_id"]
+        assert submitted.json()["status_url"].endswith(f"/api/v1/jobs/{job_id}")
+
+        for _ in range(50):
+            status = job_client.get(f"/api/v1/jobs/{job_id}").json()
+            if status["status"] == "succeeded":
+                break
+            time.sleep(0.05)
+        assert status["status"] == "succeeded"
+        assert status["result"]["s3_url"].startswith("https://")
+        assert job_client.get("/api/v1/jobs/unknown").status_code == 404
+
+def test_job_submission_over_the_vendor_limit_gets_429(monkeypatch):
+    from app import api
+    from app.jobs import JobStore, InMemoryJobPersistence
+    from app.scheduler import FairScheduler
+    submitted = []
+
+    class RecordingJobStore(JobStore):
+        async def submit(self, payload, *args, **kwargs):
+            submitted.append(payload)
+            return await super().submit(payload, *args, **kwargs)
+
+    monkeypatch.setattr(api, "get_job_store", lambda store=RecordingJobStore(InMemoryJobPersistence()): store)
+    monkeypatch.setattr(api, "generation_scheduler", FairScheduler(vendor_rate=0.1, vendor_burst=1))
+    monkeypatch.setattr(api, "send_async_generation_request", dummy_send_async_generation_request)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", dummy_upload_bytes_to_s3)
+    monkeypatch.setattr(api, "download_image", dummy_download_image)
+
+    payload = {"subject_image": "https://example.com/example.png", "background_prompt": "a beach", "username": "greedy"}
+    assert client.post("/api/v1/jobs/replace-background-relight", json=payload).status_code == 202
+    response = client.post("/api/v1/jobs/replace-background-relight", json=payload)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert len(submitted) == 1
+
+def test_job_callback_url_must_be_a_public_https_url():
+    payload = {"subject_image": "https://example.com/example.png", "background_prompt": "a beach"}
+    for callback_url in (
+        "http://example.com/hook",
+        "https://169.254.169.254/latest/meta-data",
+        "https://127.0.0.1:8000/admin/profile",
+        "https://[::1]/hook",
+        "https://10.0.0.5/hook",
+        "https://localhost/hook",
+        "https://metadata/hook",
+    ):
+        response = client.post("/api/v1/jobs/replace-background-relight", json={**payload, "callback_url": callback_url})
+        assert response.status_code == 422, callback_url
+    from app.models import ReplaceBackgroundRelightJobInput
+    accepted = ReplaceBackgroundRelightJobInput.model_validate({**payload, "callback_url": "https://hooks.example.com/done"})
+    assert str(accepted.callback_url) == "https://hooks.example.com/done"
+
+def test_batch_streams_results_and_shares_reference_downloads(monkeypatch):
+    import json
+    from app import api
+    downloads = []
+
+    def counting_download_image(url):
+        downloads.append(str(url))
+        return dummy_download_image(url)
+
+    monkeypatch.setattr(api, "send_async_generation_request", dummy_send_async_generation_request)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", dummy_upload_bytes_to_s3)
+    monkeypatch.setattr(api, "download_image", counting_download_image)
+
+    items = [
+        {"subject_image": f"https://example.com/product{i}.png", "background_prompt": "studio",
+         "background_reference": "https://example.com/backdrop.jpg", "username": "catalog"}
+        for i in range(3)
+    ]
+    items.append({"background_prompt": "missing subject"})
+    body = "\n".join(json.dumps(item) for item in items)
+
+    response = client.post("/api/v1/batch/replace-background-relight", content=body,
+                           headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    results = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda r: r["index"])
+    assert [r["status"] for r in results] == ["succeeded"] * 3 + ["failed"]
+    assert results[3]["status_code"] == 422
+    assert downloads.count("https://example.com/backdrop.jpg") == 1
+    assert len(downloads) == 4
+
+def test_batch_items_over_the_vendor_limit_get_429(monkeypatch):
+    import json
+    from app import api
+    from app.scheduler import FairScheduler
+    monkeypatch.setattr(api, "send_async_generation_request", dummy_send_async_generation_request)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", dummy_upload_bytes_to_s3)
+    monkeypatch.setattr(api, "download_image", dummy_download_image)
+    monkeypatch.setattr(api, "generation_scheduler", FairScheduler(vendor_rate=0.1, vendor_burst=2))
+
+    items = [{"subject_image": f"https://example.com/product{i}.png", "background_prompt": "studio", "username": "greedy"}
+             for i in range(3)]
+    response = client.post("/api/v1/batch/replace-background-relight", json=items)
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(r["status"] for r in results) == ["failed", "succeeded", "succeeded"]
+    rejected = next(r for r in results if r["status"] == "failed")
+    assert rejected["status_code"] == 429
+    assert rejected["retry_after"] >= 1
+
+def test_rejected_results_release_their_stability_connection(monkeypatch):
+    import httpx
+    from prometheus_client import REGISTRY
+    from app import api
+    from app.polling import PollScheduler
+    from app.stability import StabilityClient
+    from tests.fake_stability import create_fake_stability_app
+
+    def in_use():
+        return REGISTRY.get_sample_value("connection_pool_in_use", {"pool": "stability"}) or 0
+
+    monkeypatch.setattr(api, "download_image", dummy_download_image)
+    payload = {"subject_image": "https://example.com/example.png", "background_prompt": "a beach", "username": "filtered-user"}
+    for fake_app, status_code in (
+        (create_fake_stability_app(polls_until_ready=0, finish_reason="CONTENT_FILTERED"), 400),
+        (create_fake_stability_app(polls_until_ready=0, result_status=206), 206),
+    ):
+        stability = StabilityClient(
+            api_key="test-key",
+            base_url="http://stability.test",
+            scheduler=PollScheduler(initial_delay=0, jitter=0),
+            transport=httpx.ASGITransport(app=fake_app),
+        )
+
+        async def generate(host, params, files):
+            return await stability.generate(host, params, files)
+
+        monkeypatch.setattr(api, "send_async_generation_request", generate)
+        baseline = in_use()
+        for _ in range(3):
+            assert client.post("/api/v1/replace-background-relight", json=payload).status_code == status_code
+        assert in_use() == baseline
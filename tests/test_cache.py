@@ -0,0 +1,125 @@
+# test_cache.py
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.cache import ImageCache
+
+class FakeStore:
+    """Stands in for S3: answers conditional fetches and counts calls."""
+    def __init__(self):
+        self.objects = {}
+        self.full_fetches = 0
+        self.conditional_fetches = 0
+
+    def loader(self, key, delay=0):
+        def load(etag):
+            time.sleep(delay)
+            current_etag, data = self.objects[key]
+            if etag is not None:
+                self.conditional_fetches += 1
+                if etag == current_etag:
+                    return None
+            self.full_fetches += 1
+            return current_etag, data
+        return load
+
+def test_lru_evicts_and_spills_to_disk(tmp_path):
+    store = FakeStore()
+    cache = ImageCache(max_bytes=200, disk_dir=str(tmp_path), disk_max_bytes=1000, revalidate_after=60)
+    for name in ("a", "b", "c"):
+        store.objects[name] = (f'"{name}1"', name.encode() * 100)
+        cache.get(name, store.loader(name))
+
+    # "a" was evicted from memory into the disk tier and is served from there.
+    assert "a" in cache._disk and "a" not in cache._memory
+    assert cache.get("a", store.loader("a")) == b"a" * 100
+    assert store.full_fetches == 3
+    assert "a" in cache._memory
+
+def test_disk_hits_are_read_outside_the_lock(tmp_path, monkeypatch):
+    from app import cache as cache_module
+    store = FakeStore()
+    cache = ImageCache(max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000, revalidate_after=60)
+    store.objects["big"] = ('"v1"', b"x" * 500)
+    cache.get("big", store.loader("big"))
+    assert "big" in cache._disk
+    opened_with_lock_held = []
+
+    def checking_open(*args, **kwargs):
+        opened_with_lock_held.append(cache._lock.locked())
+        return open(*args, **kwargs)
+
+    monkeypatch.setattr(cache_module, "open", checking_open, raising=False)
+    assert cache.get("big", store.loader("big")) == b"x" * 500
+    assert opened_with_lock_held == [False]
+    assert store.full_fetches == 1
+
+def test_spills_are_written_outside_the_lock(tmp_path, monkeypatch):
+    from app import cache as cache_module
+    store = FakeStore()
+    cache = ImageCache(max_bytes=200, disk_dir=str(tmp_path), disk_max_bytes=1000, revalidate_after=60)
+    opened_with_lock_held = []
+
+    def checking_open(*args, **kwargs):
+        opened_with_lock_held.append(cache._lock.locked())
+        return open(*args, **kwargs)
+
+    monkeypatch.setattr(cache_module, "open", checking_open, raising=False)
+    for name in ("a", "b", "c"):
+        store.objects[name] = (f'"{name}1"', name.encode() * 100)
+        cache.get(name, store.loader(name))
+
+    # Storing "c" evicted "a" from memory; its file was written once the lock was released.
+    assert opened_with_lock_held == [False]
+    assert "a" in cache._disk and not cache._spilling
+    assert [p.name for p in tmp_path.iterdir()] == [os.path.basename(cache._disk["a"].path)]
+
+def test_stale_entry_is_revalidated_with_etag():
+    store = FakeStore()
+    store.objects["bg"] = ('"v1"', b"old")
+    cache = ImageCache(max_bytes=1000, disk_dir=None, revalidate_after=0)
+
+    assert cache.get("bg", store.loader("bg")) == b"old"
+    assert cache.get("bg", store.loader("bg")) == b"old"
+    assert (store.full_fetches, store.conditional_fetches) == (1, 1)
+
+    store.objects["bg"] = ('"v2"', b"new")
+    assert cache.get("bg", store.loader("bg")) == b"new"
+    assert store.full_fetches == 2
+
+def test_concurrent_misses_share_one_load():
+    store = FakeStore()
+    store.objects["light"] = ('"v1"', b"light")
+    cache = ImageCache(max_bytes=1000, disk_dir=None, revalidate_after=60)
+    start = threading.Barrier(8)
+
+    def fetch():
+        start.wait()
+        return cache.get("light", store.loader("light", delay=0.2))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: fetch(), range(8)))
+
+    assert results == [b"light"] * 8
+    assert store.full_fetches == 1
+
+def test_result_cache_coalesces_identical_generations():
+    import asyncio
+    from app.result_cache import ResultCache
+    cache = ResultCache(ttl=60, max_entries=10)
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "https://bucket.s3.amazonaws.com/result.png"
+
+    async def run():
+        results = await asyncio.gather(*[cache.get_or_create("key", generate) for _ in range(5)])
+        return results, await cache.get_or_create("key", generate)
+
+    results, later = asyncio.run(run())
+    assert len(calls) == 1
+    assert sorted(status for _, status in results) == ["COALESCED"] * 4 + ["MISS"]
+    assert later == ("https://bucket.s3.amazonaws.com/result.png", "HIT")
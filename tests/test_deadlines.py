@@ -0,0 +1,91 @@
+# test_deadlines.py
+import asyncio
+import time
+import pytest
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from starlette.requests import Request
+from app import api
+from app.deadlines import CLIENT_DISCONNECT, Deadline, DeadlineExceeded, deadline_scope, request_timeout
+from app.main import app
+from app.polling import PollScheduler
+from tests.fake_stability import create_fake_stability_app
+from tests.test_api import dummy_download_image
+from tests.test_stability import ENDPOINT, make_client
+
+client = TestClient(app)
+
+def abandoned(stage, reason):
+    return REGISTRY.get_sample_value("abandoned_work_total", {"stage": stage, "reason": reason}) or 0
+
+def test_request_timeout_header_is_capped(monkeypatch):
+    from app import deadlines
+    monkeypatch.setattr(deadlines, "REQUEST_TIMEOUT", 600)
+    monkeypatch.setattr(deadlines, "REQUEST_TIMEOUT_MAX", 900)
+    assert request_timeout("30") == 30
+    assert request_timeout("100000") == 900
+    assert request_timeout("soon") == 600
+    assert request_timeout(None) == 600
+
+def test_polling_is_abandoned_at_the_deadline():
+    # The generation never finishes; without a deadline this would poll for WORKER_TIMEOUT.
+    fake_app = create_fake_stability_app(polls_until_ready=10 ** 6)
+    before = abandoned("poll", "deadline")
+
+    async def run():
+        stability = make_client(fake_app, scheduler=PollScheduler(initial_delay=0.05, max_delay=0.05, jitter=0))
+        try:
+            with deadline_scope(Deadline(0.3)):
+                await stability.generate(ENDPOINT, {}, {"subject_image": ("subject_image", b"img", "application/octet-stream")})
+        finally:
+            await stability.aclose()
+
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(run())
+    assert time.monotonic() - start < 2
+    assert abandoned("poll", "deadline") == before + 1
+
+def test_request_past_its_deadline_returns_504_without_uploading(monkeypatch):
+    async def slow_generation(host, params, files):
+        await asyncio.sleep(5)
+
+    def unexpected_upload(*args, **kwargs):
+        raise AssertionError("abandoned requests must not upload")
+
+    monkeypatch.setattr(api, "send_async_generation_request", slow_generation)
+    monkeypatch.setattr(api, "download_image", dummy_download_image)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", unexpected_upload)
+    start = time.monotonic()
+    response = client.post("/api/v1/replace-background-relight", headers={"X-Request-Timeout": "0.3"}, json={
+        "subject_image": "https://example.com/subject.png",
+        "background_prompt": "a smooth pink pastel backdrop",
+        "username": "deadline-user"
+    })
+    assert response.status_code == 504
+    assert time.monotonic() - start < 2
+
+def test_client_disconnect_cancels_processing():
+    before = abandoned("start", CLIENT_DISCONNECT)
+    cancelled = []
+
+    async def run():
+        async def receive():
+            await asyncio.sleep(0.1)
+            return {"type": "http.disconnect"}
+
+        async def processing():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        request = Request({"type": "http", "method": "POST", "headers": []}, receive)
+        await api.run_with_deadline(request, processing(), "correlation-id", "vendor")
+
+    with pytest.raises(api.HTTPException) as exc_info:
+        asyncio.run(run())
+    assert exc_info.value.status_code == 499
+    assert cancelled == [True]
+    assert abandoned("start", CLIENT_DISCONNECT) == before + 1
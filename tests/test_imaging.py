@@ -0,0 +1,75 @@
+# test_imaging.py
+import asyncio
+from io import BytesIO
+import pytest
+from PIL import Image
+from app.imaging import InvalidImage, preprocess, preprocess_input, sniff_format
+
+def encode(image, format, **params):
+    buffer = BytesIO()
+    image.save(buffer, format, **params)
+    return buffer.getvalue()
+
+def test_sniff_format_from_magic_bytes():
+    image = Image.new("RGB", (8, 8))
+    assert sniff_format(encode(image, "PNG")) == "png"
+    assert sniff_format(encode(image, "JPEG")) == "jpeg"
+    assert sniff_format(encode(image, "WEBP")) == "webp"
+    assert sniff_format(b"<html>not an image</html>") is None
+
+def test_valid_image_within_limits_is_left_unchanged():
+    data = encode(Image.new("RGB", (128, 96), "red"), "PNG")
+    content, format, timings = preprocess(data)
+    assert content is None and format == "png"
+    assert set(timings) == {"sniff", "decode"}
+
+def test_corrupt_or_tiny_images_are_rejected():
+    data = encode(Image.new("RGB", (128, 128), "red"), "PNG")
+    with pytest.raises(InvalidImage):
+        preprocess(data[:len(data) // 2])
+    with pytest.raises(InvalidImage):
+        preprocess(b"GIF89a" + b"\x00" * 10)
+    with pytest.raises(InvalidImage, match="at least 64 pixels"):
+        preprocess(encode(Image.new("RGB", (32, 128)), "PNG"))
+
+def test_oversized_image_is_downscaled():
+    data = encode(Image.new("RGB", (1000, 500), "blue"), "JPEG")
+    content, format, timings = preprocess(data, max_pixels=100000)
+    result = Image.open(BytesIO(content))
+    assert format == "jpeg" and result.format == "JPEG"
+    assert result.width * result.height <= 100000
+    assert abs(result.width / result.height - 2) < 0.05
+    assert "transform" in timings and "encode" in timings
+
+def test_unusual_modes_and_formats_are_normalized():
+    content, format, _ = preprocess(encode(Image.new("CMYK", (64, 64)), "JPEG"))
+    assert format == "jpeg" and Image.open(BytesIO(content)).mode == "RGB"
+    content, format, _ = preprocess(encode(Image.new("RGBA", (64, 64)), "TIFF"))
+    assert format == "png" and Image.open(BytesIO(content)).mode == "RGBA"
+
+def test_exif_rotation_is_applied():
+    image = Image.new("RGB", (200, 100))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotate 90 degrees clockwise when displayed
+    content, _, _ = preprocess(encode(image, "JPEG", exif=exif))
+    assert Image.open(BytesIO(content)).size == (100, 200)
+
+def test_preprocess_input_runs_in_process_pool():
+    data = encode(Image.new("RGB", (400, 400), "green"), "PNG")
+    original = BytesIO(data)
+    result = asyncio.run(preprocess_input(original, "subject"))
+    assert result is original and result.read() == data
+
+def test_postprocess_transcodes_and_renders_thumbnails():
+    from app.imaging import postprocess
+    data = encode(Image.effect_noise((256, 128), 40).convert("RGB"), "PNG")
+    content, thumbnails, timings = postprocess(data, "webp", transcode=True, thumbnail_sizes=(64,))
+    assert sniff_format(content) == "webp" and len(content) < len(data)
+    assert Image.open(BytesIO(thumbnails[64])).size == (64, 32)
+    assert set(timings) == {"decode", "encode", "thumbnails"}
+
+def test_postprocess_keeps_original_when_it_is_already_smaller():
+    from app.imaging import postprocess
+    data = encode(Image.new("RGB", (256, 256), "white"), "PNG", compress_level=9)
+    content, thumbnails, _ = postprocess(data, "png", transcode=True, preset="high")
+    assert content is None and thumbnails == {}
@@ -0,0 +1,116 @@
+# test_jobs.py
+import asyncio
+import time
+from app.jobs import Job, JobStore, InMemoryJobPersistence, SQLiteJobPersistence, FAILED, QUEUED, RUNNING, SUCCEEDED
+from app.worker import JobWorker
+
+def test_sqlite_persistence_round_trip_and_purge(tmp_path):
+    persistence = SQLiteJobPersistence(str(tmp_path / "jobs.db"))
+    job = Job(job_id="job-1", input={"seed": 42}, callback_url="https://example.com/hook")
+    persistence.save(job)
+
+    job.status = SUCCEEDED
+    job.result = {"s3_url": "https://bucket.s3.amazonaws.com/out.png"}
+    persistence.save(job)
+    persistence.close()
+
+    # A new connection (e.g. after a restart) sees the same record.
+    reopened = SQLiteJobPersistence(str(tmp_path / "jobs.db"))
+    assert reopened.load("job-1") == job
+    assert reopened.purge_finished(before=time.time() + 1) == 1
+    assert reopened.load("job-1") is None
+
+def test_close_drains_running_jobs_then_cancels_the_rest():
+    async def quick(job):
+        await asyncio.sleep(0.05)
+        return {"s3_url": "https://bucket.s3.amazonaws.com/quick.png"}
+
+    async def stuck(job):
+        await asyncio.sleep(60)
+
+    async def run():
+        persistence = InMemoryJobPersistence()
+        store = JobStore(persistence)
+        quick_job = await store.submit({}, quick)
+        stuck_job = await store.submit({}, stuck)
+        start = time.monotonic()
+        await store.close(drain_timeout=0.5)
+        return persistence.load(quick_job.job_id), persistence.load(stuck_job.job_id), time.monotonic() - start
+
+    quick_job, stuck_job, elapsed = asyncio.run(run())
+    assert quick_job.status == SUCCEEDED
+    assert stuck_job.status != SUCCEEDED
+    assert 0.5 <= elapsed < 5
+
+def test_sqlite_queue_leases_and_redelivers_lost_jobs(tmp_path):
+    queue = SQLiteJobPersistence(str(tmp_path / "jobs.db"))
+    queue.save(Job(job_id="old", input={}, created_at=1))
+    queue.save(Job(job_id="new", input={}, created_at=2))
+    assert queue.queue_stats() == (2, 1)
+
+    # Oldest first; a claimed job is invisible to other workers while its lease holds.
+    job = queue.claim("worker-a", lease=60)
+    assert (job.job_id, job.status, job.attempts) == ("old", RUNNING, 1)
+    assert queue.claim("worker-b", lease=60).job_id == "new"
+    assert queue.claim("worker-b", lease=60) is None
+
+    # worker-a dies: once its lease runs out the job goes to someone else, and worker-a can no longer finish it.
+    assert queue.renew("old", "worker-a", lease=-1)
+    redelivered = queue.claim("worker-b", lease=60, max_attempts=3)
+    assert (redelivered.job_id, redelivered.attempts) == ("old", 2)
+    job.status = SUCCEEDED
+    assert not queue.finish(job, "worker-a")
+    redelivered.status, redelivered.result = SUCCEEDED, {"s3_url": "https://bucket.s3.amazonaws.com/out.png"}
+    assert queue.finish(redelivered, "worker-b")
+    assert queue.load("old").result == redelivered.result
+
+    # A job lost too many times is failed instead of being handed out again.
+    assert queue.renew("new", "worker-b", lease=-1)
+    assert queue.claim("worker-c", lease=60, max_attempts=1) is None
+    assert queue.load("new").status == FAILED
+
+def test_worker_runs_jobs_submitted_to_the_queue(tmp_path):
+    ran = []
+
+    async def runner(job):
+        ran.append(job.input["n"])
+        if job.input["n"] == 2:
+            raise ValueError("bad input")
+        return {"s3_url": f"https://bucket.s3.amazonaws.com/{job.input['n']}.png"}
+
+    async def run():
+        queue = SQLiteJobPersistence(str(tmp_path / "jobs.db"))
+        # The API side only records jobs when JOB_EXECUTION=queue.
+        store = JobStore(queue, execute=False)
+        jobs = [await store.submit({"n": n}, runner) for n in range(3)]
+        assert {queue.load(job.job_id).status for job in jobs} == {QUEUED}
+
+        worker = JobWorker(SQLiteJobPersistence(str(tmp_path / "jobs.db")), runner, concurrency=2, poll_interval=0.01)
+        stop = asyncio.Event()
+        running = asyncio.create_task(worker.run(stop))
+        while any(queue.load(job.job_id).status not in (SUCCEEDED, FAILED) for job in jobs):
+            await asyncio.sleep(0.01)
+        stop.set()
+        await running
+        return [queue.load(job.job_id) for job in jobs]
+
+    jobs = asyncio.run(run())
+    assert sorted(ran) == [0, 1, 2]
+    assert [job.status for job in jobs] == [SUCCEEDED, SUCCEEDED, FAILED]
+    assert jobs[0].result == {"s3_url": "https://bucket.s3.amazonaws.com/0.png"}
+    assert jobs[2].error == {"status_code": 500, "detail": "bad input"}
+
+def test_callbacks_are_only_sent_to_public_hosts(monkeypatch):
+    import httpx
+    from app.jobs import notify_callback
+    posted = []
+
+    async def recording_post(self, url, **kwargs):
+        posted.append(url)
+        return httpx.Response(200)
+
+    monkeypatch.setattr(httpx.AsyncClient, "post", recording_post)
+    # A name that resolves to an internal address is refused when the callback is sent.
+    asyncio.run(notify_callback(Job(job_id="job-1", input={}, callback_url="https://localhost/hook")))
+    asyncio.run(notify_callback(Job(job_id="job-2", input={}, callback_url="https://169.254.169.254/latest")))
+    assert posted == []
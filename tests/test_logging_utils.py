@@ -0,0 +1,109 @@
+# test_logging_utils.py
+import io
+import json
+import logging
+from app import logging_utils
+from app.logging_utils import CustomJsonFormatter, Lazy, setup_logging, start_log_listener, stop_log_listener
+
+def test_lazy_extra_is_resolved_when_formatted():
+    formatter = CustomJsonFormatter('%(timestamp)s %(level)s %(name)s %(message)s')
+    record = logging.LogRecord("app.test", logging.INFO, __file__, 1, "hello", None, None)
+    record.input = Lazy(dict, seed=7)
+    line = json.loads(formatter.format(record))
+    assert line["message"] == "hello"
+    assert line["input"] == {"seed": 7}
+    assert line["correlation_id"] is None
+    assert line["level"] == "INFO"
+
+def test_disabled_level_skips_lazy_extra(monkeypatch):
+    monkeypatch.setenv("LOG_LEVEL", "WARNING")
+    logger = setup_logging("app.test_disabled")
+    calls = []
+    logger.info("ignored", extra={"input": Lazy(calls.append, 1)})
+    stop_log_listener()
+    start_log_listener()
+    assert calls == []
+
+def test_queued_records_are_written_by_listener(monkeypatch):
+    monkeypatch.setenv("LOG_LEVEL", "INFO")
+    logger = setup_logging("app.test_queue")
+    stream = io.StringIO()
+    start_log_listener()
+    previous = logging_utils._output_handler.setStream(stream)
+    try:
+        logger.info("queued %s", "message", extra={"correlation_id": "abc", "input": Lazy(lambda: {"a": 1})})
+        stop_log_listener()
+    finally:
+        logging_utils._output_handler.setStream(previous)
+        start_log_listener()
+    line = json.loads(stream.getvalue().strip().splitlines()[-1])
+    assert line["message"] == "queued message"
+    assert line["correlation_id"] == "abc"
+    assert line["input"] == {"a": 1}
+
+def make_record(msg, name="app.test_dedup"):
+    return logging.LogRecord(name, logging.INFO, __file__, 10, msg, None, None)
+
+def test_duplicate_filter_reports_suppressed_count(monkeypatch):
+    from app.logging_utils import DuplicateFilter
+    clock = [100.0]
+    monkeypatch.setattr(logging_utils.time, "monotonic", lambda: clock[0])
+    dedup = DuplicateFilter(timeout=5)
+    assert dedup.filter(make_record("poll"))
+    assert not dedup.filter(make_record("poll"))
+    assert not dedup.filter(make_record("poll"))
+    clock[0] += 6
+    record = make_record("poll")
+    assert dedup.filter(record)
+    assert record.suppressed == 2
+
+def test_duplicate_filter_collapses_messages_from_the_same_template(monkeypatch):
+    from app.logging_utils import DuplicateFilter
+    monkeypatch.setattr(logging_utils.time, "monotonic", lambda: 100.0)
+    dedup = DuplicateFilter(timeout=5)
+
+    def polling_error(generation_id):
+        return logging.LogRecord("app.test_dedup", logging.ERROR, __file__, 10, "Polling error for %s: HTTP 500", (generation_id,), None)
+
+    assert dedup.filter(polling_error("gen-1"))
+    assert not dedup.filter(polling_error("gen-2"))
+    # Text formatted before logging is part of the template.
+    assert dedup.filter(make_record("Polling error for gen-3: HTTP 500"))
+
+def test_duplicate_filter_summarizes_bursts_that_end(monkeypatch):
+    from app.logging_utils import DuplicateFilter
+    clock = [100.0]
+    monkeypatch.setattr(logging_utils.time, "monotonic", lambda: clock[0])
+    reports = []
+    monkeypatch.setattr(logging_utils, "_report_suppressed", lambda record, n: reports.append((record.getMessage(), n)))
+    dedup = DuplicateFilter(timeout=5)
+    dedup.filter(make_record("burst"))
+    dedup.filter(make_record("burst"))
+    clock[0] += 6
+    assert dedup.filter(make_record("something else"))
+    assert reports == [("burst", 1)]
+
+def test_duplicate_filter_memory_is_bounded():
+    import tracemalloc
+    from app.logging_utils import DuplicateFilter
+    dedup = DuplicateFilter(timeout=3600, max_keys=1000)
+    record = make_record("")
+    for i in range(1000000):
+        record.msg = f"Downloaded s3://bucket/inputs/{i}.png"
+        dedup.filter(record)
+    assert len(dedup.last_log) == 1000
+
+    tracemalloc.start()
+    try:
+        for i in range(10000):
+            record.msg = f"Downloaded s3://bucket/warmup/{i}.png"
+            dedup.filter(record)
+        baseline = tracemalloc.get_traced_memory()[0]
+        for i in range(100000):
+            record.msg = f"Downloaded s3://bucket/outputs/{i}.png"
+            dedup.filter(record)
+        growth = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+    assert len(dedup.last_log) == 1000
+    assert growth < 16 * 1024
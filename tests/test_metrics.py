@@ -0,0 +1,69 @@
+# test_metrics.py
+import asyncio
+import threading
+import time
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY, Counter
+from app.main import app
+from app.metrics import OTHER_VENDOR, VendorLabels, labelled
+from app.pools import InstrumentedThreadPoolExecutor, run_in_thread
+
+def test_vendor_labels_are_bounded():
+    labels = VendorLabels(max_vendors=3, min_requests=2, allowlist=["partner"], max_candidates=10)
+    for i in range(1000):
+        labels.record(f"one-off-{i}")
+    assert labels.label("one-off-5") == OTHER_VENDOR
+    assert labels.label("partner") == "partner"
+
+    for vendor_id in ("a", "a", "b", "b", "c", "c"):
+        labels.record(vendor_id)
+    # Only two slots were left after the allowlist; later vendors share "other".
+    assert [labels.label(v) for v in ("a", "b", "c")] == ["a", "b", OTHER_VENDOR]
+    assert len(labels._candidates) <= 10
+
+def test_labelled_caches_children_and_bounds_vendor_ids():
+    counter = Counter("test_labelled_total", "Test counter", ["vendor_id", "kind"])
+    child = labelled(counter, vendor_id="unknown-vendor", kind="x")
+    assert labelled(counter, vendor_id="another-unknown", kind="x") is child
+    child.inc()
+    series = {s.labels["vendor_id"] for metric in counter.collect() for s in metric.samples}
+    assert series == {OTHER_VENDOR}
+
+def test_metrics_are_exposed_once():
+    assert [route.path for route in app.routes].count("/metrics") == 1
+    response = TestClient(app).get("/metrics")
+    assert response.status_code == 200
+    assert "vendor_requests_total" in response.text
+
+def test_thread_pool_reports_busy_and_queued_tasks():
+    def usage():
+        return tuple(
+            REGISTRY.get_sample_value(name, {"executor": "test"})
+            for name in ("executor_workers", "executor_busy_workers", "executor_queued_tasks")
+        )
+
+    executor = InstrumentedThreadPoolExecutor("test", max_workers=1)
+    release = threading.Event()
+    running = executor.submit(release.wait)
+    waiting = executor.submit(lambda: None)
+    cancelled = executor.submit(lambda: None)
+    deadline = time.monotonic() + 5
+    while usage()[1] != 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert usage() == (1, 1, 2)
+
+    assert cancelled.cancel()
+    assert usage() == (1, 1, 1)
+    release.set()
+    running.result()
+    waiting.result()
+    executor.shutdown()
+    assert usage() == (0, 0, 0)
+
+def test_run_in_thread_records_queue_wait_per_call():
+    def waits():
+        return REGISTRY.get_sample_value("to_thread_queue_wait_seconds_count", {"call": "test_call"}) or 0
+
+    before = waits()
+    assert asyncio.run(run_in_thread("test_call", sum, [1, 2])) == 3
+    assert waits() == before + 1
@@ -0,0 +1,76 @@
+# test_monitoring_log.py
+import asyncio
+from contextlib import asynccontextmanager
+from app.logging_utils import MONITORING_LOG_COLUMNS, MonitoringLogWriter
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def copy_records_to_table(self, table, records, columns):
+        assert table == "monitoringlog" and tuple(columns) == MONITORING_LOG_COLUMNS
+        await self.pool.write(records)
+
+    async def executemany(self, query, records):
+        await self.pool.write(records)
+
+class FakePool:
+    """Stands in for an asyncpg pool; records each batch and can be made to fail."""
+    def __init__(self):
+        self.batches = []
+        self.failing = False
+
+    async def write(self, records):
+        if self.failing:
+            raise ConnectionError("database unavailable")
+        self.batches.append(list(records))
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield FakeConnection(self)
+
+def test_rows_are_written_in_batches():
+    async def scenario():
+        pool = FakePool()
+        writer = MonitoringLogWriter(pool, batch_size=10, flush_interval=60, max_buffer=100)
+        writer.start()
+        for i in range(25):
+            assert await writer.log(message=f"request {i}")
+        await asyncio.sleep(0.01)
+        # Two full batches go out straight away; the remainder waits for the interval or shutdown.
+        assert [len(batch) for batch in pool.batches] == [10, 10]
+        await writer.close()
+        assert [len(batch) for batch in pool.batches] == [10, 10, 5]
+        messages = [row[MONITORING_LOG_COLUMNS.index("message")] for batch in pool.batches for row in batch]
+        assert messages == [f"request {i}" for i in range(25)]
+
+    asyncio.run(scenario())
+
+def test_partial_batch_is_flushed_on_interval():
+    async def scenario():
+        pool = FakePool()
+        writer = MonitoringLogWriter(pool, batch_size=100, flush_interval=0.02, use_copy=False)
+        writer.start()
+        await writer.log(message="only row")
+        await asyncio.sleep(0.1)
+        assert len(pool.batches) == 1
+        await writer.close()
+
+    asyncio.run(scenario())
+
+def test_rows_are_dropped_when_database_lags():
+    async def scenario():
+        pool = FakePool()
+        pool.failing = True
+        writer = MonitoringLogWriter(pool, batch_size=5, flush_interval=0.01, max_buffer=8, max_wait=0.01)
+        writer.start()
+        results = [await writer.log(message=f"request {i}") for i in range(20)]
+        await asyncio.sleep(0.05)
+        assert results.count(False) > 0
+        assert len(writer._rows) <= 8
+        # Once the database recovers, what was kept is written.
+        pool.failing = False
+        await writer.close()
+        assert 0 < sum(len(batch) for batch in pool.batches) <= 8
+
+    asyncio.run(scenario())
@@ -0,0 +1,57 @@
+# test_profiling.py
+import asyncio
+import threading
+import time
+from fastapi.testclient import TestClient
+from app import profiling
+from app.main import app
+from app.profiling import EventLoopMonitor
+
+client = TestClient(app)
+
+def test_admin_endpoints_need_the_admin_token(monkeypatch):
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", None)
+    assert client.get("/admin/event-loop").status_code == 404
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "secret")
+    assert client.get("/admin/event-loop").status_code == 401
+    assert client.get("/admin/event-loop", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get("/admin/event-loop", headers={"Authorization": "Bearer secret"}).status_code == 200
+
+def test_profile_returns_collapsed_stacks(monkeypatch):
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "secret")
+    stop = threading.Event()
+
+    def busy_loop():
+        while not stop.is_set():
+            sum(range(1000))
+
+    thread = threading.Thread(target=busy_loop, name="busy worker")
+    thread.start()
+    try:
+        response = client.get("/admin/profile?seconds=0.3&interval=0.005", headers={"Authorization": "Bearer secret"})
+    finally:
+        stop.set()
+        thread.join()
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert int(response.headers["X-Profile-Samples"]) == sum(int(line.rsplit(" ", 1)[1]) for line in lines)
+    busy = [line for line in lines if line.startswith("busy_worker;")]
+    assert busy and all("tests.test_profiling.test_profile_returns_collapsed_stacks.<locals>.busy_loop" in line for line in busy)
+
+def test_monitor_reports_the_stack_that_blocks_the_loop():
+    monitor = EventLoopMonitor(interval=0.02, slow_callback=0.05)
+
+    def block_the_loop():
+        time.sleep(0.3)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        block_the_loop()
+        await asyncio.sleep(0.05)
+        await monitor.stop()
+
+    asyncio.run(run())
+    assert len(monitor.stalls) == 1
+    assert "block_the_loop" in monitor.stalls[0]["stack"]
+    assert monitor.lag < 0.05
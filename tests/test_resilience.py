@@ -0,0 +1,173 @@
+# test_resilience.py
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, RetryBudget, hedged_call, retry_call
+from app.polling import PollScheduler
+from app.stability import StabilityClient, StabilityAPIError
+from tests.fake_stability import create_fake_stability_app
+
+client = TestClient(app)
+
+ENDPOINT = "http://stability.test/v2beta/stable-image/edit/replace-background-and-relight"
+
+def make_breaker(**kwargs):
+    options = dict(slow_call_duration=1.0, failure_rate=0.5, slow_call_rate=0.5, window=10, min_calls=4, open_duration=0.05, half_open_calls=2)
+    options.update(kwargs)
+    return CircuitBreaker("test", **options)
+
+def fail(breaker, error=RuntimeError("boom"), is_failure=lambda e: True):
+    with pytest.raises(type(error)):
+        with breaker.guard(is_failure):
+            raise error
+
+def test_breaker_opens_on_failure_rate_and_recovers_after_probes():
+    breaker = make_breaker()
+    for _ in range(2):
+        with breaker.guard():
+            pass
+    fail(breaker)
+    assert breaker.state == CLOSED
+    fail(breaker)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as info:
+        with breaker.guard():
+            pass
+    assert 0 < info.value.retry_after <= 0.05
+    assert breaker.retry_after() is not None
+
+    time.sleep(0.06)
+    assert breaker.retry_after() is None
+    with breaker.guard():
+        pass
+    # One successful probe is not enough to close it again.
+    assert breaker.state == HALF_OPEN
+    with breaker.guard():
+        pass
+    assert breaker.state == CLOSED
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = make_breaker(min_calls=1)
+    fail(breaker)
+    time.sleep(0.06)
+    fail(breaker)
+    assert breaker.state == OPEN
+
+def test_slow_calls_and_client_errors():
+    breaker = make_breaker(slow_call_duration=0.0)
+    for _ in range(4):
+        with breaker.guard():
+            pass
+    assert breaker.state == OPEN
+
+    breaker = make_breaker()
+    for _ in range(10):
+        fail(breaker, ValueError("bad request"), is_failure=lambda e: not isinstance(e, ValueError))
+    assert breaker.state == CLOSED
+
+def test_retries_stop_when_the_budget_is_spent():
+    budget = RetryBudget(ratio=0.0, max_tokens=2)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        raise ConnectionError("reset")
+
+    with pytest.raises(ConnectionError):
+        retry_call(flaky, "test", attempts=5, budget=budget, is_retryable=lambda e: True, base_delay=0)
+    assert len(calls) == 3
+    with pytest.raises(ConnectionError):
+        retry_call(flaky, "test", attempts=5, budget=budget, is_retryable=lambda e: True, base_delay=0)
+    assert len(calls) == 4
+
+def test_hedged_call_returns_the_first_response_and_discards_the_other():
+    release = threading.Event()
+    calls = []
+    discarded = []
+
+    def read():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)
+            return "slow"
+        return "fast"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        result = hedged_call(read, delay=0.01, budget=RetryBudget(ratio=0.0, max_tokens=1), executor=executor, discard=discarded.append)
+        release.set()
+    assert result == "fast"
+    assert discarded == ["slow"]
+
+def test_stability_client_fails_fast_while_the_api_is_down():
+    fake_app = create_fake_stability_app(error_rate=1.0)
+
+    async def run():
+        client = StabilityClient(
+            api_key="test-key",
+            base_url="http://stability.test",
+            transport=httpx.ASGITransport(app=fake_app),
+            breaker=make_breaker(min_calls=2, open_duration=30),
+        )
+        try:
+            for _ in range(2):
+                with pytest.raises(StabilityAPIError):
+                    await client.submit(ENDPOINT, {}, {"subject_image": b"img"})
+            with pytest.raises(CircuitOpenError):
+                await client.submit(ENDPOINT, {}, {"subject_image": b"img"})
+        finally:
+            await client.aclose()
+
+    asyncio.run(run())
+    assert fake_app.state.errors == 2
+
+def test_stability_breaker_counts_each_generation_once():
+    # Every submit is accepted and every result fails, so each generation is one failure.
+    fake_app = create_fake_stability_app(polls_until_ready=0, result_status=500)
+    breaker = make_breaker(failure_rate=1.0, min_calls=4, open_duration=30)
+
+    async def run():
+        client = StabilityClient(
+            api_key="test-key",
+            base_url="http://stability.test",
+            scheduler=PollScheduler(initial_delay=0, jitter=0),
+            transport=httpx.ASGITransport(app=fake_app),
+            breaker=breaker,
+        )
+        try:
+            for attempt in range(4):
+                assert breaker.state == CLOSED, attempt
+                with pytest.raises(StabilityAPIError):
+                    await client.generate(ENDPOINT, {}, {"subject_image": b"img"})
+            assert breaker.state == OPEN
+            with pytest.raises(CircuitOpenError):
+                await client.generate(ENDPOINT, {}, {"subject_image": b"img"})
+        finally:
+            await client.aclose()
+
+    asyncio.run(run())
+    assert fake_app.state.submits == 4
+
+def test_open_stability_breaker_returns_503_before_downloading(monkeypatch):
+    from app import api
+
+    class OpenBreaker:
+        def retry_after(self):
+            return 12.5
+
+    def unexpected_download(url):
+        raise AssertionError("inputs must not be downloaded while the breaker is open")
+
+    monkeypatch.setattr(api, "get_stability_client", lambda: type("Client", (), {"breaker": OpenBreaker()})())
+    monkeypatch.setattr(api, "download_image", unexpected_download)
+    response = client.post("/api/v1/replace-background-relight", json={
+        "subject_image": "https://example.com/subject.png",
+        "background_prompt": "a smooth pink pastel backdrop",
+        "username": "breaker-user"
+    })
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "13"
@@ -0,0 +1,95 @@
+# test_scheduler.py
+import asyncio
+import pytest
+from app.scheduler import AdmissionRejected, FairScheduler, TokenBucket, quota_share
+
+def test_token_bucket_reports_wait_when_empty():
+    bucket = TokenBucket(rate=1, burst=2)
+    assert bucket.consume() == 0
+    assert bucket.consume() == 0
+    wait = bucket.consume()
+    assert 0 < wait <= 1
+
+def test_workers_split_the_concurrency_quota():
+    assert quota_share(50, 1) == 50
+    assert quota_share(50, 4) == 12
+    assert quota_share(2, 8) == 1
+
+def test_vendor_over_rate_is_rejected_with_retry_after():
+    scheduler = FairScheduler(vendor_rate=0.5, vendor_burst=1)
+    scheduler.admit("a")
+    with pytest.raises(AdmissionRejected) as excinfo:
+        scheduler.admit("a")
+    assert excinfo.value.reason == "rate_limited"
+    assert excinfo.value.retry_after > 1
+    # Other vendors have their own bucket.
+    scheduler.admit("b")
+
+def test_zero_vendor_rate_disables_the_rate_limit():
+    scheduler = FairScheduler(vendor_rate=0, vendor_burst=1)
+    for _ in range(5):
+        scheduler.admit("a")
+
+def test_slots_are_shared_fairly_between_vendors():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1, vendor_max_queue=100)
+        order = []
+
+        async def work(vendor_id):
+            async with scheduler.slot(vendor_id):
+                order.append(vendor_id)
+                await asyncio.sleep(0)
+
+        # Vendor "a" floods the queue before "b" shows up with two requests.
+        tasks = [asyncio.create_task(work("a")) for _ in range(6)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(work("b")) for _ in range(2)]
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(scenario())
+    # "b" is served after at most one more "a" each time instead of waiting for the whole backlog.
+    assert order.index("b") <= 2
+    assert order[:5].count("b") == 2
+
+def test_full_queue_rejects_immediately():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+
+        async def work():
+            async with scheduler.slot("a"):
+                await release.wait()
+
+        running = asyncio.create_task(work())
+        queued = asyncio.create_task(work())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as excinfo:
+            scheduler.admit("b")
+        assert excinfo.value.reason == "queue_full"
+        release.set()
+        await asyncio.gather(running, queued)
+        assert scheduler._running == 0 and scheduler._queued == 0
+
+    asyncio.run(scenario())
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1)
+        release = asyncio.Event()
+
+        async def work():
+            async with scheduler.slot("a"):
+                await release.wait()
+
+        running = asyncio.create_task(work())
+        waiting = asyncio.create_task(work())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler._queued == 0
+        release.set()
+        await running
+        assert scheduler._running == 0
+
+    asyncio.run(scenario())
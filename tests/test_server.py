@@ -0,0 +1,36 @@
+# test_server.py
+import os
+import tempfile
+import pytest
+from app.server import prepare_job_store, prepare_multiprocess_metrics
+
+def test_configured_metrics_dir_is_prepared_for_a_single_worker(tmp_path, monkeypatch):
+    path = tmp_path / "prometheus"
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(path))
+    prepare_multiprocess_metrics(1)
+    assert path.is_dir()
+
+    # Files of a previous run are cleared rather than summed into the new one.
+    (path / "counter_123.db").write_bytes(b"stale")
+    prepare_multiprocess_metrics(1)
+    assert list(path.iterdir()) == []
+
+def test_multiple_workers_get_a_metrics_dir_when_none_is_configured(tmp_path, monkeypatch):
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    prepare_multiprocess_metrics(1)
+    assert "PROMETHEUS_MULTIPROC_DIR" not in os.environ
+    prepare_multiprocess_metrics(2)
+    assert os.path.dirname(os.environ["PROMETHEUS_MULTIPROC_DIR"]) == str(tmp_path)
+
+def test_multiple_workers_share_the_sqlite_job_store(monkeypatch):
+    monkeypatch.delenv("JOB_STORE_BACKEND", raising=False)
+    prepare_job_store(1)
+    assert "JOB_STORE_BACKEND" not in os.environ
+    prepare_job_store(4)
+    assert os.environ["JOB_STORE_BACKEND"] == "sqlite"
+
+    # Each worker would only see its own jobs.
+    monkeypatch.setenv("JOB_STORE_BACKEND", "memory")
+    with pytest.raises(RuntimeError):
+        prepare_job_store(4)
@@ -0,0 +1,126 @@
+# test_stability.py
+import asyncio
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+from app.polling import PollScheduler, parse_retry_after
+from app.stability import StabilityClient
+from tests.fake_stability import create_fake_stability_app, FAKE_IMAGE
+
+ENDPOINT = "http://stability.test/v2beta/stable-image/edit/replace-background-and-relight"
+
+def make_client(fake_app, **kwargs):
+    return StabilityClient(
+        api_key="test-key",
+        base_url="http://stability.test",
+        transport=httpx.ASGITransport(app=fake_app),
+        **kwargs
+    )
+
+def test_generate_polls_until_ready():
+    fake_app = create_fake_stability_app(polls_until_ready=2)
+
+    async def run():
+        client = make_client(fake_app, scheduler=PollScheduler(initial_delay=0, jitter=0))
+        try:
+            response = await client.generate(ENDPOINT, {"seed": 1}, {"subject_image": ("subject_image", b"img", "application/octet-stream")})
+            await response.aread()
+            return response
+        finally:
+            await client.aclose()
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert response.content == FAKE_IMAGE
+    assert response.headers["finish-reason"] == "SUCCESS"
+    assert fake_app.state.polls == 3
+
+def test_generation_delay_keeps_result_in_progress():
+    fake_app = create_fake_stability_app(polls_until_ready=0, generation_delay=0.2)
+
+    async def run():
+        client = make_client(fake_app, scheduler=PollScheduler(initial_delay=0.05, max_delay=0.05, jitter=0))
+        try:
+            start = asyncio.get_running_loop().time()
+            response = await client.generate(ENDPOINT, {}, {"subject_image": ("subject_image", b"img", "application/octet-stream")})
+            await response.aread()
+            return response, asyncio.get_running_loop().time() - start
+        finally:
+            await client.aclose()
+
+    response, elapsed = asyncio.run(run())
+    assert response.status_code == 200
+    assert elapsed >= 0.2
+    assert fake_app.state.polls >= 3
+
+def test_many_concurrent_generations_share_one_client():
+    fake_app = create_fake_stability_app(polls_until_ready=3)
+
+    async def run():
+        client = make_client(fake_app, scheduler=PollScheduler(initial_delay=0.01))
+        try:
+            return await asyncio.gather(*[
+                client.generate(ENDPOINT, {}, {"subject_image": ("subject_image", b"img", "application/octet-stream")})
+                for _ in range(500)
+            ])
+        finally:
+            await client.aclose()
+
+    responses = asyncio.run(run())
+    assert all(r.status_code == 200 for r in responses)
+    assert fake_app.state.submits == 500
+
+def test_pool_gauges_follow_polls_and_open_responses():
+    fake_app = create_fake_stability_app(polls_until_ready=2)
+
+    def in_use():
+        return REGISTRY.get_sample_value("connection_pool_in_use", {"pool": "stability"}) or 0
+
+    def polling():
+        return REGISTRY.get_sample_value("stability_polls_in_flight") or 0
+
+    async def run():
+        client = make_client(fake_app, scheduler=PollScheduler(initial_delay=0.05, max_delay=0.05, jitter=0))
+        try:
+            connections, polls = in_use(), polling()
+            task = asyncio.ensure_future(client.generate(ENDPOINT, {}, {"subject_image": ("subject_image", b"img", "application/octet-stream")}))
+            await asyncio.sleep(0.02)
+            while_polling = polling() - polls
+            response = await task
+            # The result body has not been read, so its connection is still taken.
+            while_streaming = in_use() - connections
+            await response.aclose()
+            return while_polling, while_streaming, in_use() - connections, polling() - polls
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == (1, 1, 0, 0)
+
+def test_submit_error_is_raised():
+    fake_app = create_fake_stability_app(submit_status=400)
+
+    async def run():
+        client = make_client(fake_app, scheduler=PollScheduler(initial_delay=0, jitter=0))
+        try:
+            await client.generate(ENDPOINT, {}, {"subject_image": ("subject_image", b"img", "application/octet-stream")})
+        finally:
+            await client.aclose()
+
+    with pytest.raises(Exception, match="HTTP 400"):
+        asyncio.run(run())
+
+def test_poll_scheduler_backs_off_and_honors_retry_after():
+    scheduler = PollScheduler(initial_delay=0.5, max_delay=4, multiplier=2, jitter=0)
+    assert [scheduler.next_delay(n) for n in range(1, 6)] == [0.5, 1, 2, 4, 4]
+    assert scheduler.next_delay(3, retry_after=7) == 7
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after("not-a-date") is None
+
+def test_poll_scheduler_learns_first_poll_from_history():
+    scheduler = PollScheduler(initial_delay=0.5, jitter=0, smoothing=0.5, early_margin=0.1)
+    assert scheduler.first_delay("relight") == 0.5
+    scheduler.record("relight", 20)
+    scheduler.record("relight", 30)
+    assert scheduler.expected_duration("relight") == 25
+    assert scheduler.first_delay("relight") == 22.5
+    assert scheduler.first_delay("other") == 0.5
@@ -0,0 +1,82 @@
+# test_storage.py
+from io import BytesIO
+from urllib.parse import urlparse
+import pytest
+from fastapi.testclient import TestClient
+from app import api, storage
+from app.main import app
+from app.storage import InvalidObjectURL, LocalStorage, ObjectLocation, parse_object_url
+
+client = TestClient(app)
+
+@pytest.fixture
+def buckets(monkeypatch):
+    monkeypatch.setattr(storage, "S3_BUCKET", "outputs")
+    monkeypatch.setattr(api, "S3_BUCKET", "outputs")
+    monkeypatch.setattr(storage, "STORAGE_ALLOWED_BUCKETS", "inputs.eu, inputs")
+
+@pytest.fixture
+def local_storage(tmp_path, buckets, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_PUBLIC_URL", "http://testserver")
+    backend = LocalStorage(str(tmp_path), public_url="http://testserver", signing_key="secret")
+    storage.set_storage(backend)
+    yield backend
+    storage.set_storage(None)
+
+def test_parse_object_url_routes_bucket_and_region(buckets):
+    assert parse_object_url("https://inputs.s3.amazonaws.com/a/b%20c.png") == ObjectLocation("inputs", "a/b c.png")
+    assert parse_object_url("https://inputs.eu.s3.eu-west-1.amazonaws.com/x.png") == ObjectLocation("inputs.eu", "x.png", "eu-west-1")
+    assert parse_object_url("https://s3.us-west-2.amazonaws.com/inputs/x.png") == ObjectLocation("inputs", "x.png", "us-west-2")
+    assert parse_object_url("https://inputs.s3-ap-southeast-2.amazonaws.com/x.png").region == "ap-southeast-2"
+    # Other hosts keep reading the key from the default bucket.
+    assert parse_object_url("https://example.com/x.png") == ObjectLocation("outputs", "x.png")
+    with pytest.raises(InvalidObjectURL):
+        parse_object_url("https://someone-else.s3.amazonaws.com/x.png")
+
+def test_local_storage_round_trip(tmp_path):
+    backend = LocalStorage(str(tmp_path), public_url="http://testserver", signing_key="secret")
+    location = ObjectLocation("inputs", "nested/image.png")
+    backend.write(location, BytesIO(b"image bytes"), "image/png")
+
+    etag, content = backend.read(location)
+    assert content == b"image bytes"
+    assert backend.read(location, etag) is None
+    assert backend.open(location).read() == b"image bytes"
+    assert not [p for p in (tmp_path / "inputs" / "nested").iterdir() if p.suffix == ".tmp"]
+    with pytest.raises(InvalidObjectURL):
+        backend.path(ObjectLocation("inputs", "../outputs/secret.png"))
+
+def test_presigned_upload_and_download(local_storage):
+    response = client.post("/api/v1/uploads", json={"content_type": "image/jpeg"})
+    assert response.status_code == 200
+    upload = response.json()
+    assert urlparse(upload["url"]).path.startswith("/api/v1/storage/outputs/uploads/")
+
+    assert client.put(upload["upload_url"], content=b"jpeg bytes", headers=upload["headers"]).status_code == 200
+    assert storage.download_image(upload["url"]).read() == b"jpeg bytes"
+
+    download_url = storage.presign_download(upload["url"])
+    response = client.get(download_url)
+    assert response.status_code == 200
+    assert response.content == b"jpeg bytes"
+    assert response.headers["content-type"] == "image/jpeg"
+
+def test_local_objects_are_served_with_their_stored_headers(local_storage):
+    location = ObjectLocation("outputs", "transformed_images/result.png")
+    local_storage.write(location, BytesIO(b"webp bytes"), "image/webp", "public, max-age=31536000, immutable")
+    assert local_storage.headers(location) == {"Content-Type": "image/webp", "Cache-Control": "public, max-age=31536000, immutable"}
+
+    response = client.get(local_storage.presign_get(location))
+    assert response.content == b"webp bytes"
+    assert response.headers["content-type"] == "image/webp"
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+
+def test_storage_routes_reject_bad_signatures(local_storage):
+    location = ObjectLocation("outputs", "x.png")
+    local_storage.write(location, BytesIO(b"x"), "image/png")
+    get_url = local_storage.presign_get(location)
+    # A GET signature does not allow uploads, and tampered or expired signatures are refused.
+    assert client.put(get_url, content=b"y").status_code == 403
+    assert client.get(get_url.replace("x.png", "y.png")).status_code == 403
+    assert client.get(local_storage.presign_get(location, expires=-10)).status_code == 403
+    assert client.get(get_url).content == b"x"
@@ -0,0 +1,86 @@
+# test_tracing.py
+import json
+import logging
+from fastapi.testclient import TestClient
+from app import tracing
+from app.logging_utils import TraceContextFilter, get_correlation_id
+from app.main import app
+from tests.test_api import dummy_download_image, dummy_send_async_generation_request, dummy_upload_bytes_to_s3
+
+client = TestClient(app)
+
+PAYLOAD = {
+    "subject_image": "https://example.com/subject.png",
+    "background_prompt": "a smooth pink pastel backdrop",
+    "seed": 7,
+    "output_format": "png",
+    "username": "tracing-user"
+}
+
+def read_traces(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def test_spans_are_nested_and_exported_as_otlp_json(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracing.configure_exporter("file", str(path))
+    try:
+        with tracing.start_trace("request", correlation_id="abc") as trace:
+            assert get_correlation_id() == "abc"
+            with tracing.span("download", asset="subject"):
+                with tracing.span("poll"):
+                    pass
+    finally:
+        tracing.configure_exporter("none")
+
+    [exported] = read_traces(path)
+    spans = {s["name"]: s for s in exported["resourceSpans"][0]["scopeSpans"][0]["spans"]}
+    assert set(spans) == {"request", "download", "poll"}
+    assert {s["traceId"] for s in spans.values()} == {trace.trace_id}
+    assert spans["request"]["parentSpanId"] == ""
+    assert spans["download"]["parentSpanId"] == spans["request"]["spanId"]
+    assert spans["poll"]["parentSpanId"] == spans["download"]["spanId"]
+    assert {"key": "asset", "value": {"stringValue": "subject"}} in spans["download"]["attributes"]
+    assert int(spans["request"]["endTimeUnixNano"]) >= int(spans["poll"]["endTimeUnixNano"])
+
+def test_spans_outside_a_trace_are_ignored():
+    with tracing.span("orphan") as span:
+        assert span is None
+    assert tracing.current_trace() is None
+
+def test_log_records_carry_trace_ids():
+    record = logging.makeLogRecord({"msg": "hello"})
+    explicit = logging.makeLogRecord({"msg": "hello", "correlation_id": "explicit"})
+    with tracing.start_trace("request", correlation_id="abc") as trace:
+        TraceContextFilter().filter(record)
+        TraceContextFilter().filter(explicit)
+    assert (record.correlation_id, record.trace_id) == ("abc", trace.trace_id)
+    assert explicit.correlation_id == "explicit"
+
+def test_request_id_and_server_timing_headers(monkeypatch, tmp_path):
+    from app import api
+    monkeypatch.setattr(api, "send_async_generation_request", dummy_send_async_generation_request)
+    monkeypatch.setattr(api, "upload_bytes_to_s3", dummy_upload_bytes_to_s3)
+    monkeypatch.setattr(api, "download_image", dummy_download_image)
+    monkeypatch.setattr(api, "RESULT_CACHE_ENABLED", False)
+
+    path = tmp_path / "traces.jsonl"
+    tracing.configure_exporter("file", str(path))
+    try:
+        response = client.post("/api/v1/replace-background-relight", json=PAYLOAD, headers={"X-Request-ID": "req-123"})
+    finally:
+        tracing.configure_exporter("none")
+
+    assert response.status_code == 200
+    assert response.headers["x-request-id"] == "req-123"
+    stages = {entry.split(";")[0] for entry in response.headers["server-timing"].split(", ")}
+    assert {"download_subject", "preprocess_subject", "scheduler_wait", "upload", "total"} <= stages
+
+    [exported] = read_traces(path)
+    root = next(s for s in exported["resourceSpans"][0]["scopeSpans"][0]["spans"] if s["name"] == "http.request")
+    assert {"key": "correlation_id", "value": {"stringValue": "req-123"}} in root["attributes"]
+
+def test_invalid_request_id_is_replaced():
+    response = client.get("/health", headers={"X-Request-ID": "bad id\twith spaces"})
+    assert response.headers["x-request-id"] != "bad id\twith spaces"
+    assert len(response.headers["x-request-id"]) == 36
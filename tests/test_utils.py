@@ -0,0 +1,25 @@
+# test_utils.py
+import hashlib
+from io import BytesIO
+from app.utils import SpooledBody, body_size
+
+def test_spooled_body_spills_to_disk_and_computes_s3_etag():
+    data = bytes(range(256)) * 100
+    body = SpooledBody(max_memory=1000, part_size=10000)
+    for start in range(0, len(data), 777):
+        body.write(data[start:start + 777])
+
+    assert not isinstance(body.file, BytesIO)
+    assert body.size == len(data)
+    assert body.rewind().read() == data
+    # Multipart ETag: MD5 of the concatenated part MD5s, suffixed with the part count.
+    parts = [hashlib.md5(data[i:i + 10000]).digest() for i in range(0, len(data), 10000)]
+    assert body.etag == f'"{hashlib.md5(b"".join(parts)).hexdigest()}-3"'
+    assert body_size(body.file) == len(data)
+    body.close()
+
+def test_small_spooled_body_stays_in_memory():
+    body = SpooledBody(max_memory=1000, part_size=10000)
+    body.write(b"png")
+    assert isinstance(body.file, BytesIO)
+    assert body.etag == f'"{hashlib.md5(b"png").hexdigest()}"'